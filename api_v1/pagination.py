@@ -0,0 +1,85 @@
+from base64 import b64decode, b64encode
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from api_v1.utils import parse_int
+
+
+class OpponentsCursorPagination(CursorPagination):
+    """Keyset pagination by id, the page is fetched with a single indexed range query."""
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_page_size(self, request) -> int:
+        """Unlike the default, an invalid page size is an error and not the default page size"""
+        if self.page_size_query_param not in request.query_params:
+            return self.page_size
+        page_size = parse_int(request.query_params[self.page_size_query_param], self.page_size_query_param)
+        if page_size < 1:
+            raise ValidationError(f'{self.page_size_query_param} must be positive')
+        return min(page_size, self.max_page_size)
+
+
+class FightHistoryPagination:
+    """
+    Keyset pagination of finished fights, newest first. The cursor is the (completed_at, id) of the last fight
+    of the page, so every page is a range scan of the fight history indexes, however long the history is.
+    """
+    page_size = 20
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def __init__(self, request):
+        self.request = request
+        self.page_size = self.get_page_size()
+        self.position = self.decode_cursor()
+        self.next_position: tuple[datetime, int] | None = None
+
+    def get_page_size(self) -> int:
+        page_size = parse_int(self.request.GET.get(self.page_size_query_param, str(self.page_size)),
+                              self.page_size_query_param)
+        if page_size < 1:
+            raise ValidationError(f'{self.page_size_query_param} must be positive')
+        return min(page_size, self.max_page_size)
+
+    def decode_cursor(self) -> tuple[datetime, int] | None:
+        cursor = self.request.GET.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            completed_at, pk = b64decode(cursor.encode('ascii'), altchars=b'-_').decode('ascii').split('|')
+            return datetime.fromisoformat(completed_at), int(pk)
+        except (ValueError, UnicodeError):
+            raise NotFound('Invalid cursor')
+
+    def encode_cursor(self, completed_at: datetime, pk: int) -> str:
+        return b64encode(f'{completed_at.isoformat()}|{pk}'.encode('ascii'), altchars=b'-_').decode('ascii')
+
+    def filter_queryset(self, queryset):
+        """Fights after the cursor, one more than the page to know if there's a next page"""
+        if self.position is not None:
+            completed_at, pk = self.position
+            queryset = queryset.filter(Q(completed_at__lt=completed_at) | Q(completed_at=completed_at, id__lt=pk))
+        return queryset.order_by('-completed_at', '-id')[:self.page_size + 1]
+
+    def get_page(self, fights: list) -> list:
+        """fights - fights after the cursor, newest first, more than page_size if there's a next page"""
+        if len(fights) > self.page_size:
+            last = fights[self.page_size - 1]
+            self.next_position = (last.completed_at, last.pk)
+        return fights[:self.page_size]
+
+    def get_paginated_response(self, data: list) -> Response:
+        next_url = None
+        if self.next_position is not None:
+            next_url = replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                           self.encode_cursor(*self.next_position))
+        return Response({'next': next_url, 'results': data})
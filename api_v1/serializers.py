@@ -1,8 +1,14 @@
+from django.db import transaction
 from django.db.models import Q
 from rest_framework import serializers
 
+from api_v1.utils import ConflictError
+
+from core.business_services.fight_events import publish_fight_status
+from core.business_services.leaderboard import record_fight_result
 from core.business_services.notification_sender import send_fight_call_notification
-from core.models import Taskogotchi, Project, PlayerProfile, FightChallenge, Player, FightStatus
+from core.models import Taskogotchi, Project, PlayerProfile, FightChallenge, Player, FightStatus, PlayerStats
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from core.business_services.fight_status_state_machine import FightStatusStateMachine
 
@@ -26,6 +32,18 @@ class CreatePlayerProfileSerializer(serializers.Serializer):
     project_name = serializers.CharField(max_length=255)
 
 
+class RegisterPlayerEntrySerializer(serializers.Serializer):
+    account_id = serializers.CharField(max_length=128)
+    player_name = serializers.CharField(max_length=200, required=False, allow_null=True, allow_blank=True)
+    email = serializers.EmailField(required=False, allow_null=True, allow_blank=True)
+    project_id = serializers.CharField(max_length=200)
+    project_name = serializers.CharField(max_length=200, required=False, allow_null=True, allow_blank=True)
+
+
+class BulkRegisterPlayersSerializer(serializers.Serializer):
+    players = RegisterPlayerEntrySerializer(many=True, allow_empty=False, max_length=1000)
+
+
 class PlayerProfileSerializer(serializers.ModelSerializer):
     player = PlayerSerializer()
     project = ProjectSerializer()
@@ -37,17 +55,24 @@ class PlayerProfileSerializer(serializers.ModelSerializer):
 
 class OpponentSerializer(serializers.ModelSerializer):
     profile = PlayerProfileSerializer()
-    in_fight = serializers.SerializerMethodField('is_in_fight', read_only=True)
-
-    def is_in_fight(self, obj: Taskogotchi) -> bool:
-        return FightChallenge.objects.filter(Q(opponent=obj.profile) | Q(initiator=obj.profile)) \
-            .exclude(status__in=[FightStatus.COMPLETED, FightStatus.CANCELED]).exists()
+    in_fight = serializers.BooleanField(read_only=True)  # annotated by OpponentsListView
+    health = serializers.IntegerField(source='current_health', read_only=True)
 
     class Meta:
         model = Taskogotchi
         fields = ('id', 'profile', 'in_fight', 'health', 'strength')
 
 
+class LeaderboardEntrySerializer(serializers.ModelSerializer):
+    rank = serializers.IntegerField(read_only=True)  # set by LeaderboardView
+    account_id = serializers.CharField(source='profile.player.account_id', read_only=True)
+    name = serializers.CharField(source='profile.player.name', read_only=True)
+
+    class Meta:
+        model = PlayerStats
+        fields = ('rank', 'account_id', 'name', 'rating', 'wins', 'losses', 'draws', 'streak')
+
+
 class CreateFightChallengeSerializer(serializers.Serializer):
     project_id = serializers.CharField(required=True)
     account_id = serializers.CharField(required=True)
@@ -71,6 +96,7 @@ class FightChallengeSerializer(serializers.ModelSerializer):
     winner = PlayerProfileSerializer(required=False)
     status_description = serializers.CharField(source='get_status_display', read_only=True)
     status = serializers.CharField(read_only=True)
+    completed_at = serializers.DateTimeField(read_only=True)
     account_id = serializers.CharField(write_only=True)
     project_id = serializers.CharField(write_only=True)
     opponent_id = serializers.CharField(write_only=True, required=False)
@@ -86,20 +112,29 @@ class FightChallengeSerializer(serializers.ModelSerializer):
         account_id = validated_data.pop('account_id')
         project_id = validated_data.pop('project_id')
         opponent_id = validated_data.pop('opponent_id')
-        initiator_profile = get_object_or_404(PlayerProfile, player__account_id=account_id,
-                                              project__project_id=project_id)
-        opponent_profile = get_object_or_404(PlayerProfile, player__account_id=opponent_id,
-                                             project__project_id=project_id)
+        # both profiles are loaded and locked (in the same order for every request) until the fight is created,
+        # concurrent challenges of the same players wait here and see the created fight
+        profiles = {profile.player.account_id: profile for profile in PlayerProfile.objects
+                    .select_for_update(of=('self',))
+                    .filter(player__account_id__in=[account_id, opponent_id], project__project_id=project_id)
+                    .select_related('player', 'project', 'taskogotchi').order_by('pk')}
+        if account_id not in profiles or opponent_id not in profiles:
+            raise Http404('No PlayerProfile matches the given query.')
+        initiator_profile, opponent_profile = profiles[account_id], profiles[opponent_id]
+        if FightChallenge.objects.active().filter(Q(initiator__in=[initiator_profile, opponent_profile])
+                                                  | Q(opponent__in=[initiator_profile, opponent_profile])).exists():
+            raise ConflictError('You or your opponent are already in fight.')
         validated_data['initiator'] = initiator_profile
         validated_data['opponent'] = opponent_profile
         validated_data['status'] = FightStatus.WAITING_ACCEPT
-        validated_data['initiator_health'] = initiator_profile.taskogotchi.health
+        validated_data['initiator_health'] = initiator_profile.taskogotchi.current_health
         validated_data['initiator_strength'] = initiator_profile.taskogotchi.strength
-        validated_data['opponent_health'] = opponent_profile.taskogotchi.health
+        validated_data['opponent_health'] = opponent_profile.taskogotchi.current_health
         validated_data['opponent_strength'] = opponent_profile.taskogotchi.strength
         validated_data = self.filter_validated_data(FightChallenge(), validated_data)
         result = super().create(validated_data)
         send_fight_call_notification(result)
+        publish_fight_status(result, created=True)
         return result
 
     def update(self, instance: FightChallenge, validated_data):
@@ -109,24 +144,33 @@ class FightChallengeSerializer(serializers.ModelSerializer):
                 if winner_account_id not in [instance.initiator.player.account_id, instance.opponent.player.account_id]:
                     raise serializers.ValidationError(
                         detail="winner_account_id must be either initiator or opponent account_id")
-                winner_profile = get_object_or_404(PlayerProfile, player__account_id=winner_account_id,
-                                                   project=instance.initiator.project)
-                validated_data['winner'] = winner_profile
+                if winner_account_id == instance.initiator.player.account_id:
+                    validated_data['winner'] = instance.initiator
+                else:
+                    validated_data['winner'] = instance.opponent
                 validated_data['draw'] = False
             else:
                 validated_data['draw'] = True
 
-        try:
-            instance = FightStatusStateMachine.process_action(action, instance, save=False)
-        except ValueError as e:
-            raise serializers.ValidationError(str(e))
-        validated_data = self.filter_validated_data(FightChallenge(), validated_data)
-        return super().update(instance, validated_data)
+        with transaction.atomic():
+            # the fight can be completed by the fight consumer meanwhile, lock it and check the actual status
+            instance.status = FightChallenge.objects.select_for_update().values_list('status', flat=True) \
+                .get(pk=instance.pk)
+            try:
+                instance = FightStatusStateMachine.process_action(action, instance, save=False)
+            except ValueError as e:
+                raise serializers.ValidationError(str(e))
+            validated_data = self.filter_validated_data(FightChallenge(), validated_data)
+            instance = super().update(instance, validated_data)
+            if instance.status == FightStatus.COMPLETED:
+                record_fight_result(instance)
+        return instance
 
     class Meta:
         model = FightChallenge
         fields = ('id', 'initiator', 'initiator_health', 'initiator_strength', 'opponent', 'opponent_health',
-                  'opponent_strength', 'status', 'status_description', 'winner', 'draw', 'account_id', 'project_id',
+                  'opponent_strength', 'status', 'status_description', 'winner', 'draw', 'completed_at', 'account_id',
+                  'project_id',
                   'opponent_id', 'action', 'winner_account_id')
 
 
@@ -135,9 +179,11 @@ class TaskogotchiSerializer(serializers.ModelSerializer):
     account_id = serializers.CharField(write_only=True)
     project_id = serializers.CharField(write_only=True)
     last_updated = serializers.DateTimeField(read_only=True)
+    health = serializers.IntegerField(source='current_health', required=False)
 
     def create(self, validated_data):
-        player_profile = get_object_or_404(PlayerProfile, player__account_id=validated_data.pop('account_id'),
+        player_profile = get_object_or_404(PlayerProfile.objects.select_related('player', 'project'),
+                                           player__account_id=validated_data.pop('account_id'),
                                            project__project_id=validated_data.pop('project_id'))
         validated_data['profile'] = player_profile
         return super().create(validated_data)
@@ -1,3 +1,387 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.models import Project, Player, PlayerProfile, Taskogotchi, FightChallenge, FightStatus, PlayerStats
+from game.game_logic.action_log import make_action_log, pack_record
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Number of database queries of every endpoint is pinned, so a new N+1 fails here instead of in production.
+    If a change needs more queries on purpose, raise the budget in the same commit and explain why.
+    Counts include the savepoints of atomic blocks, TestCase runs every test in a transaction.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(project_id='project', name='Project')
+        cls.profiles = []
+        for i in range(4):
+            player = Player.objects.create(account_id=f'account{i}', name=f'Player {i}', email=f'player{i}@test.com')
+            profile = PlayerProfile.objects.create(player=player, project=cls.project)
+            Taskogotchi.objects.create(profile=profile)
+            cls.profiles.append(profile)
+
+    def send(self, method: str, path: str, data: dict, budget: int, status: int = 200, **headers):
+        with self.assertNumQueries(budget):
+            if method == 'get':
+                response = self.client.get(path, data, **headers)
+            else:
+                response = getattr(self.client, method)(path, json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, status, getattr(response, 'content', None))
+        return response
+
+    def create_fight(self, status: str, initiator: int = 0, opponent: int = 1, **kwargs) -> FightChallenge:
+        return FightChallenge.objects.create(initiator=self.profiles[initiator], opponent=self.profiles[opponent],
+                                             status=status, **kwargs)
+
+    def test_register_player(self):
+        self.send('post', '/api/v1/register-player', {'account_id': 'new', 'project_id': 'project',
+                                                      'player_name': 'New player'}, budget=14)
+
+    def test_register_players(self):
+        players = [{'account_id': f'new{i}', 'project_id': 'project'} for i in range(10)]
+        self.send('post', '/api/v1/register-players', {'players': players}, budget=10)
+
+    def test_get_taskogotchi(self):
+        response = self.send('get', '/api/v1/taskogotchi', {'account_id': 'account0', 'project_id': 'project'},
+                             budget=2)
+        self.send('get', '/api/v1/taskogotchi', {'account_id': 'account0', 'project_id': 'project'}, budget=1,
+                  status=304, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_create_taskogotchi(self):
+        Taskogotchi.objects.filter(profile=self.profiles[0]).delete()
+        self.send('post', '/api/v1/taskogotchi', {'account_id': 'account0', 'project_id': 'project'}, budget=4,
+                  status=201)
+
+    def test_update_taskogotchi(self):
+        self.send('put', '/api/v1/taskogotchi', {'account_id': 'account0', 'project_id': 'project', 'health': 50},
+                  budget=2)
+
+    def test_available_opponents(self):
+        self.create_fight(FightStatus.PENDING, 1, 2)
+        response = self.send('get', '/api/v1/available-opponents', {'account_id': 'account0', 'project_id': 'project'},
+                             budget=1)
+        self.assertEqual(len(response.json()), 3)
+        self.send('get', '/api/v1/available-opponents', {'account_id': 'account0', 'project_id': 'project',
+                                                         'page_size': 2}, budget=1)
+
+    def test_create_fight(self):
+        self.send('post', '/api/v1/fight', {'account_id': 'account0', 'project_id': 'project',
+                                            'opponent_id': 'account1'}, budget=7, status=201)
+
+    def test_get_fight(self):
+        self.create_fight(FightStatus.WAITING_ACCEPT)
+        self.send('get', '/api/v1/fight', {'account_id': 'account0', 'project_id': 'project'}, budget=2)
+
+    def test_accept_fight(self):
+        self.create_fight(FightStatus.WAITING_ACCEPT)
+        self.send('put', '/api/v1/fight', {'account_id': 'account1', 'project_id': 'project', 'action': 'accept'},
+                  budget=5)
+
+    def test_complete_fight(self):
+        self.create_fight(FightStatus.PENDING)
+        self.send('put', '/api/v1/fight', {'account_id': 'account1', 'project_id': 'project', 'action': 'complete',
+                                           'winner_account_id': 'account1'}, budget=8)
+
+    def test_fight_history(self):
+        for opponent in (1, 2, 3):
+            self.create_fight(FightStatus.CANCELED, 0, opponent)
+            self.create_fight(FightStatus.CANCELED, opponent, 0)
+        FightChallenge.objects.update(completed_at='2023-01-01T00:00:00Z')
+        # a query for every side and status of the fight, see FightHistoryView
+        response = self.send('get', '/api/v1/fights/history', {'account_id': 'account0', 'project_id': 'project',
+                                                                'page_size': 4}, budget=5)
+        self.send('get', response.json()['next'], {}, budget=5)
+        # a query for every status, see FightHistoryView
+        self.send('get', '/api/v1/fights/history', {'project_id': 'project'}, budget=2)
+
+    def test_leaderboard(self):
+        self.create_fight(FightStatus.PENDING)
+        self.send('put', '/api/v1/fight', {'account_id': 'account1', 'project_id': 'project', 'action': 'complete',
+                                           'winner_account_id': 'account1'}, budget=8)
+        self.send('get', '/api/v1/leaderboard', {'project_id': 'project', 'account_id': 'account0'}, budget=3)
+
+    def test_fight_replay(self):
+        fight = self.create_fight(FightStatus.COMPLETED, draw=True, action_log=b'\x01')
+        self.send('get', f'/api/v1/fight/{fight.pk}/replay', {'account_id': 'account0'}, budget=1)
+
+
+class FightChallengeViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        project = Project.objects.create(project_id='project', name='Project')
+        cls.profiles = []
+        for i in range(3):
+            profile = PlayerProfile.objects.create(player=Player.objects.create(account_id=f'account{i}'),
+                                                   project=project)
+            Taskogotchi.objects.create(profile=profile)
+            cls.profiles.append(profile)
+
+    def challenge(self, initiator: int, opponent: int):
+        return self.client.post('/api/v1/fight', {'account_id': f'account{initiator}', 'project_id': 'project',
+                                                  'opponent_id': f'account{opponent}'},
+                                content_type='application/json')
+
+    def act(self, account: int, action: str, **data):
+        return self.client.put('/api/v1/fight', {'account_id': f'account{account}', 'project_id': 'project',
+                                                 'action': action, **data}, content_type='application/json')
+
+    def test_lifecycle(self):
+        self.assertEqual(self.challenge(0, 1).status_code, 201)
+        fight = FightChallenge.objects.get()
+        self.assertEqual(fight.status, FightStatus.WAITING_ACCEPT)
+        for action, status in (('accept', FightStatus.ACCEPTED), ('start', FightStatus.PENDING)):
+            self.assertEqual(self.act(1, action).status_code, 200)
+            fight.refresh_from_db()
+            self.assertEqual(fight.status, status)
+
+        self.assertEqual(self.act(1, 'complete', winner_account_id='account0').status_code, 200)
+        fight.refresh_from_db()
+        self.assertEqual((fight.status, fight.winner, fight.draw), (FightStatus.COMPLETED, self.profiles[0], False))
+        self.assertIsNotNone(fight.completed_at)
+        # the fight isn't active anymore
+        self.assertEqual(self.act(1, 'cancel').status_code, 404)
+
+    def test_invalid_transition(self):
+        self.challenge(0, 1)
+        self.assertEqual(self.act(0, 'start').status_code, 400)
+        self.assertEqual(self.act(0, 'complete').status_code, 400)
+        self.assertEqual(FightChallenge.objects.get().status, FightStatus.WAITING_ACCEPT)
+
+    def test_cancel(self):
+        self.challenge(0, 1)
+        self.assertEqual(self.act(1, 'cancel').status_code, 200)
+        self.assertEqual(FightChallenge.objects.get().status, FightStatus.CANCELED)
+        # both players are free again
+        self.assertEqual(self.challenge(1, 0).status_code, 201)
+
+    def test_initiator_busy(self):
+        self.challenge(0, 1)
+        self.assertEqual(self.challenge(0, 2).status_code, 409)
+
+    def test_opponent_busy(self):
+        self.challenge(0, 1)
+        self.assertEqual(self.challenge(2, 1).status_code, 409)
+        self.assertEqual(self.challenge(2, 0).status_code, 409)
+        self.assertEqual(FightChallenge.objects.count(), 1)
+
+
+@override_settings(TASKOGOTCHI_HEALTH_DECAY_PER_HOUR=5)
+class ConditionalGetTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        project = Project.objects.create(project_id='project', name='Project')
+        cls.profiles = []
+        for i in range(2):
+            profile = PlayerProfile.objects.create(player=Player.objects.create(account_id=f'account{i}'),
+                                                   project=project)
+            Taskogotchi.objects.create(profile=profile)
+            cls.profiles.append(profile)
+
+    def get(self, path: str, **headers):
+        return self.client.get(path, {'account_id': 'account0', 'project_id': 'project'}, **headers)
+
+    def test_taskogotchi(self):
+        response = self.get('/api/v1/taskogotchi')
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.get('/api/v1/taskogotchi', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get('/api/v1/taskogotchi', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        self.client.put('/api/v1/taskogotchi', {'account_id': 'account0', 'project_id': 'project', 'health': 50},
+                        content_type='application/json')
+        response = self.get('/api/v1/taskogotchi', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['health'], 50)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_taskogotchi_decay(self):
+        response = self.get('/api/v1/taskogotchi')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        # the stored row is the same, but an hour later the health has decayed
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(hours=1)):
+            response = self.get('/api/v1/taskogotchi', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['health'], 95)
+            self.assertEqual(self.get('/api/v1/taskogotchi', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_fight(self):
+        fight = FightChallenge.objects.create(initiator=self.profiles[0], opponent=self.profiles[1],
+                                              status=FightStatus.WAITING_ACCEPT)
+        etag = self.get('/api/v1/fight')['ETag']
+        self.assertEqual(self.get('/api/v1/fight', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.put('/api/v1/fight', {'account_id': 'account1', 'project_id': 'project', 'action': 'accept'},
+                        content_type='application/json')
+        response = self.get('/api/v1/fight', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], FightStatus.ACCEPTED)
+
+        # changes made with QuerySet.update bump the version too
+        etag = response['ETag']
+        FightChallenge.objects.filter(pk=fight.pk).update(status=FightStatus.PENDING, version=F('version') + 1)
+        self.assertEqual(self.get('/api/v1/fight', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class OpponentsPaginationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        project = Project.objects.create(project_id='project', name='Project')
+        for i in range(6):
+            profile = PlayerProfile.objects.create(player=Player.objects.create(account_id=f'account{i}'),
+                                                   project=project)
+            Taskogotchi.objects.create(profile=profile)
+
+    def get(self, path: str = '/api/v1/available-opponents', **params):
+        return self.client.get(path, {'account_id': 'account0', 'project_id': 'project', **params})
+
+    def test_pages(self):
+        expected = list(Taskogotchi.objects.exclude(profile__player__account_id='account0')
+                        .order_by('id').values_list('id', flat=True))
+        response = self.get(page_size=2)
+        ids = []
+        while True:
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page['results']), 2)
+            ids += [opponent['id'] for opponent in page['results']]
+            if page['next'] is None:
+                break
+            response = self.client.get(page['next'])
+        self.assertEqual(ids, expected)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get(cursor='not-a-cursor').status_code, 404)
+
+    def test_invalid_page_size(self):
+        self.assertEqual(self.get(page_size='ten').status_code, 400)
+        self.assertEqual(self.get(page_size=0).status_code, 400)
+        self.assertEqual(len(self.get(page_size=1000).json()['results']), 5)
+
+
+class FightHistoryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        project = Project.objects.create(project_id='project', name='Project')
+        profiles = [PlayerProfile.objects.create(player=Player.objects.create(account_id=f'account{i}'),
+                                                 project=project) for i in range(3)]
+        completed_at = timezone.now() - timedelta(days=1)
+        cls.fights = []
+        # the 4th and 5th fights are completed at the same time and are on different pages, ordered by id
+        minutes = [0, 1, 2, 3, 3, 4]
+        for i, (initiator, opponent) in enumerate([(0, 1), (1, 0), (0, 2), (2, 1), (2, 0), (0, 1)]):
+            fight = FightChallenge.objects.create(initiator=profiles[initiator], opponent=profiles[opponent],
+                                                  status=FightStatus.COMPLETED if i % 2 else FightStatus.CANCELED,
+                                                  winner=profiles[initiator] if i % 2 else None,
+                                                  completed_at=completed_at + timedelta(minutes=minutes[i]))
+            cls.fights.append(fight)
+
+    def get_all(self, **params) -> list[int]:
+        response = self.client.get('/api/v1/fights/history', {'project_id': 'project', 'page_size': 2, **params})
+        ids = []
+        while True:
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page['results']), 2)
+            ids += [fight['id'] for fight in page['results']]
+            if page['next'] is None:
+                return ids
+            response = self.client.get(page['next'])
+
+    def test_project_history(self):
+        self.assertEqual(self.get_all(), [fight.pk for fight in reversed(self.fights)])
+
+    def test_player_history(self):
+        fights = [self.fights[i].pk for i in (5, 4, 2, 1, 0)]
+        self.assertEqual(self.get_all(account_id='account0'), fights)
+        self.assertEqual(self.get_all(account_id='account0', outcome='win'), [self.fights[5].pk])
+        self.assertEqual(self.get_all(account_id='account0', status=FightStatus.CANCELED),
+                         [self.fights[i].pk for i in (4, 2, 0)])
+
+    def test_canceled_fights_have_no_outcome(self):
+        for outcome in ('win', 'loss', 'draw'):
+            response = self.client.get('/api/v1/fights/history', {'project_id': 'project', 'account_id': 'account0',
+                                                                  'outcome': outcome, 'status': FightStatus.CANCELED})
+            self.assertEqual(response.status_code, 400)
+        # canceled fights of the player aren't losses
+        self.assertEqual(self.get_all(account_id='account0', outcome='loss'), [self.fights[1].pk])
+        self.assertEqual(self.get_all(account_id='account1', outcome='loss', status=FightStatus.COMPLETED),
+                         [self.fights[5].pk, self.fights[3].pk])
+
+    def test_project_history_query_uses_index(self):
+        fights = FightChallenge.objects.filter(project__project_id='project', status=FightStatus.COMPLETED) \
+            .order_by('-completed_at', '-id')[:3]
+        plan = fights.explain()
+        self.assertIn('fight_history_project_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/fights/history', {'project_id': 'project', 'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_page_size(self):
+        for page_size in ('ten', 0):
+            response = self.client.get('/api/v1/fights/history', {'project_id': 'project', 'page_size': page_size})
+            self.assertEqual(response.status_code, 400)
+
+
+class LeaderboardViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        project = Project.objects.create(project_id='project', name='Project')
+        for i, rating in enumerate([1000, 1040, 990, 1040]):
+            profile = PlayerProfile.objects.create(player=Player.objects.create(account_id=f'account{i}'),
+                                                   project=project)
+            PlayerStats.objects.create(profile=profile, project=project, rating=rating)
+
+    def get(self, **params):
+        return self.client.get('/api/v1/leaderboard', {'project_id': 'project', **params})
+
+    def test_leaderboard(self):
+        response = self.get(limit=3, account_id='account2')
+        self.assertEqual(response.status_code, 200)
+        top = [(entry['rank'], entry['account_id']) for entry in response.json()['top']]
+        self.assertEqual(top, [(1, 'account1'), (2, 'account3'), (3, 'account0')])
+        self.assertEqual(response.json()['me']['rank'], 4)
+        self.assertIsNone(self.get(account_id='stranger').json()['me'])
+
+    def test_invalid_limit(self):
+        self.assertEqual(self.get(limit='ten').status_code, 400)
+        self.assertEqual(self.get(limit=0).status_code, 400)
+
+
+class FightReplayViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        project = Project.objects.create(project_id='project', name='Project')
+        profiles = [PlayerProfile.objects.create(player=Player.objects.create(account_id=f'account{i}'),
+                                                 project=project) for i in range(3)]
+        cls.action_log = make_action_log(pack_record(5120, 1, 'punch', 100, 90) + pack_record(6000, 2, 'kick', 80, 90))
+        cls.fight = FightChallenge.objects.create(initiator=profiles[0], opponent=profiles[1],
+                                                  status=FightStatus.COMPLETED, winner=profiles[0],
+                                                  action_log=cls.action_log)
+
+    def get(self, account_id: str, **params):
+        return self.client.get(f'/api/v1/fight/{self.fight.pk}/replay', {'account_id': account_id, **params})
+
+    def test_replay(self):
+        response = self.get('account1')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines, [
+            {'fight_id': self.fight.pk, 'initiator': 'account0', 'opponent': 'account1', 'hp': [100, 100]},
+            {'t': 5120, 'actor': 'initiator', 'action': 'punch', 'hp': [100, 90]},
+            {'t': 6000, 'actor': 'opponent', 'action': 'kick', 'hp': [80, 90]},
+        ])
+
+    def test_binary(self):
+        self.assertEqual(self.get('account0', binary='true').content, self.action_log)
+
+    def test_not_a_player(self):
+        self.assertEqual(self.get('account2').status_code, 404)
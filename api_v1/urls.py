@@ -1,7 +1,12 @@
 from django.urls import re_path
-from .views import RegisterPlayerView, TaskogotchiView, OpponentsListView, FightChallengeView
+from .views import RegisterPlayerView, RegisterPlayersView, TaskogotchiView, OpponentsListView, FightChallengeView, \
+    FightReplayView, LeaderboardView, FightHistoryView
 
 urlpatterns = [
+    re_path(r'^fight/(?P<pk>\d+)/replay/?$', FightReplayView.as_view(), name='fight-replay'),
+    re_path(r'^fights/history/?$', FightHistoryView.as_view(), name='fight-history'),
+    re_path(r'^leaderboard/?$', LeaderboardView.as_view(), name='leaderboard'),
+    re_path(r'^register-players/?$', RegisterPlayersView.as_view(), name='register-players'),
     re_path(r'register-player/?', RegisterPlayerView.as_view(), name='register-player'),
     re_path(r'taskogotchi/?', TaskogotchiView.as_view(), name='taskogotchi'),
     re_path(r'available-opponents/?', OpponentsListView.as_view(), name='available-opponents'),
@@ -1,4 +1,13 @@
-from rest_framework.exceptions import ValidationError
+from datetime import datetime
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.exceptions import ValidationError, APIException
+
+
+class ConflictError(APIException):
+    status_code = 409
+    default_detail = 'Conflict with the current state of the resource.'
 
 
 def validate_request(request, *field_names):
@@ -9,3 +18,37 @@ def validate_request(request, *field_names):
     for field_name in field_names:
         if field_name not in request.data and field_name not in request.GET:
             raise ValidationError(f'{field_name} not found in request data')
+
+
+def parse_int(value: str, field_name: str) -> int:
+    """Parse query parameter as int. Raises ValidationError if it's not a number"""
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError(f'{field_name} must be an integer')
+
+
+def parse_bool(value: str, field_name: str) -> bool:
+    """Parse query parameter as bool. Raises ValidationError if it's not true/false"""
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValidationError(f'{field_name} must be true or false')
+
+
+def make_etag(*parts) -> str:
+    return quote_etag('-'.join(str(part) for part in parts))
+
+
+def get_not_modified_response(request, etag: str, last_modified: datetime | None = None):
+    """Returns 304 response if the client's copy (If-None-Match / If-Modified-Since) is up-to-date, otherwise None"""
+    return get_conditional_response(request, etag=etag,
+                                    last_modified=int(last_modified.timestamp()) if last_modified else None)
+
+
+def set_validators(response, etag: str, last_modified: datetime | None = None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
@@ -1,7 +1,10 @@
+import heapq
+import json
+
 from django.shortcuts import get_object_or_404
 from drf_spectacular.utils import extend_schema, OpenApiParameter
-from django.db.models import Q
-from django.http import Http404
+from django.db import transaction, IntegrityError
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from rest_framework.exceptions import ValidationError
 from rest_framework.generics import CreateAPIView, UpdateAPIView, RetrieveAPIView, ListAPIView, GenericAPIView
 from rest_framework.permissions import AllowAny
@@ -9,9 +12,16 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from api_v1.serializers import TaskogotchiSerializer, PlayerProfileSerializer, FightChallengeSerializer, \
-    OpponentSerializer, CreatePlayerProfileSerializer, CreateFightChallengeSerializer, UpdateFightChallengeSerializer
-from api_v1.utils import validate_request
-from core.models import Taskogotchi, PlayerProfile, Project, FightChallenge, Player, FightStatus
+    OpponentSerializer, CreatePlayerProfileSerializer, CreateFightChallengeSerializer, UpdateFightChallengeSerializer, \
+    BulkRegisterPlayersSerializer, LeaderboardEntrySerializer
+from api_v1.pagination import OpponentsCursorPagination, FightHistoryPagination
+from api_v1.utils import validate_request, parse_int, parse_bool, ConflictError, make_etag, \
+    get_not_modified_response, set_validators
+from core.business_services.leaderboard import get_rank
+from core.business_services.player_registration import register_players
+from core.models import Taskogotchi, PlayerProfile, Project, FightChallenge, Player, FightStatus, PlayerStats, \
+    FINISHED_FIGHT_STATUSES
+from game.game_logic.action_log import iter_action_log
 
 
 @extend_schema(
@@ -52,7 +62,7 @@ from core.models import Taskogotchi, PlayerProfile, Project, FightChallenge, Pla
 class TaskogotchiView(CreateAPIView, RetrieveAPIView, UpdateAPIView, GenericAPIView):
     permission_classes = (AllowAny,)
     serializer_class = TaskogotchiSerializer
-    queryset = Taskogotchi.objects.all()
+    queryset = Taskogotchi.objects.select_related('profile__player', 'profile__project')
 
     def create(self, request, *args, **kwargs):
         validate_request(request, 'project_id', 'account_id')
@@ -67,18 +77,31 @@ class TaskogotchiView(CreateAPIView, RetrieveAPIView, UpdateAPIView, GenericAPIV
 
     def retrieve(self, request, *args, **kwargs):
         validate_request(request, 'project_id', 'account_id')
-        return super().retrieve(request, *args, **kwargs)
+        # validators are computed from a few columns of the taskogotchi row, without joined profile, player and project
+        try:
+            pk, health, health_updated_at, last_updated = self.filter_by_profile(self.get_queryset()) \
+                .values_list('pk', 'health', 'health_updated_at', 'last_updated').get()
+        except Taskogotchi.DoesNotExist:
+            raise Http404("Taskogotchi does not exist")
+        taskogotchi = Taskogotchi(pk=pk, health=health, health_updated_at=health_updated_at)
+        etag = make_etag(pk, taskogotchi.current_health, last_updated.timestamp())
+        last_modified = max(taskogotchi.get_health_changed_at(), last_updated)
+        if (not_modified := get_not_modified_response(request, etag, last_modified)) is not None:
+            return not_modified
+        return set_validators(super().retrieve(request, *args, **kwargs), etag, last_modified)
 
     def update(self, request, *args, **kwargs):
         validate_request(request, 'project_id', 'account_id')
         return super().update(request, *args, **kwargs)
 
-    def get_object(self):
+    def filter_by_profile(self, queryset):
         project_id = self.request.data.get('project_id') or self.request.GET.get('project_id')
         account_id = self.request.data.get('account_id') or self.request.GET.get('account_id')
+        return queryset.filter(profile__player__account_id=account_id, profile__project__project_id=project_id)
+
+    def get_object(self):
         try:
-            return self.get_queryset().get(profile__player__account_id=account_id,
-                                           profile__project__project_id=project_id)
+            return self.filter_by_profile(self.get_queryset()).get()
         except Taskogotchi.DoesNotExist:
             raise Http404("Taskogotchi does not exist")
 
@@ -129,29 +152,101 @@ class RegisterPlayerView(APIView):
         return Response(PlayerProfileSerializer(user_profile).data)
 
 
+@extend_schema(
+    methods=['POST'],
+    request=BulkRegisterPlayersSerializer(),
+)
+class RegisterPlayersView(APIView):
+    """
+    Bulk version of register-player, for onboarding of a whole Jira project. Accepts up to 1000 players
+    of one or more projects. Players and projects that are already stored with the same data are not updated.
+
+    Request data example:
+    ```
+    {
+        "players": [
+            {
+                "account_id": "5b10ac8d82e05b22cc7d4ef5",
+                "player_name": "test",
+                "email": "example@email.com",
+                "project_id": "75fe4dcc22b50e28d8ca01b5",
+                "project_name": "test project"
+            }
+        ]
+    }
+    ```
+
+    Response contains profile ids by project_id and account_id:
+    ```
+    {
+        "profiles": {
+            "75fe4dcc22b50e28d8ca01b5": {"5b10ac8d82e05b22cc7d4ef5": 1}
+        }
+    }
+    ```
+    """
+
+    serializer_class = BulkRegisterPlayersSerializer
+    permission_classes = (AllowAny,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkRegisterPlayersSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response({'profiles': register_players(serializer.validated_data['players'])})
+
+
 @extend_schema(
     methods=['GET'],
     parameters=[
         OpenApiParameter('account_id', type=str, required=True),
-        OpenApiParameter('project_id', type=str, required=True)
+        OpenApiParameter('project_id', type=str, required=True),
+        OpenApiParameter('health_min', type=int, required=False),
+        OpenApiParameter('health_max', type=int, required=False),
+        OpenApiParameter('in_fight', type=bool, required=False),
+        OpenApiParameter('name', type=str, required=False, description='Player name prefix'),
+        OpenApiParameter('page_size', type=int, required=False),
+        OpenApiParameter('cursor', type=str, required=False),
     ],
-    description='List of all opponents for a given project'
+    description='List of all opponents for a given project\n\n'
+                'If **page_size** or **cursor** is provided, the response is paginated: '
+                '`{"next": ..., "previous": ..., "results": [...]}`, '
+                'follow the **next** link to get the next page. Otherwise all opponents are returned as a list.'
 )
 class OpponentsListView(ListAPIView, GenericAPIView):
     permission_classes = (AllowAny,)
     serializer_class = OpponentSerializer
     queryset = Taskogotchi.objects.all()
+    pagination_class = OpponentsCursorPagination
 
     def list(self, request, *args, **kwargs):
         validate_request(request, 'project_id', 'account_id')
-        serializer = self.get_serializer(self.get_queryset(), many=True)
+        queryset = self.filter_queryset(self.get_queryset())
+        if 'cursor' in request.GET or 'page_size' in request.GET:
+            page = self.paginate_queryset(queryset)
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
     def get_queryset(self):
         project_id = self.request.data.get('project_id') or self.request.GET.get('project_id')
         account_id = self.request.data.get('account_id') or self.request.GET.get('account_id')
         return super().get_queryset().filter(profile__project__project_id=project_id) \
-            .exclude(profile__player__account_id=account_id).select_related('profile', 'profile__player')
+            .exclude(profile__player__account_id=account_id) \
+            .with_decayed_health() \
+            .with_in_fight() \
+            .select_related('profile', 'profile__player', 'profile__project')
+
+    def filter_queryset(self, queryset):
+        params = self.request.GET
+        if (health_min := params.get('health_min')) is not None:
+            queryset = queryset.filter(decayed_health__gte=parse_int(health_min, 'health_min'))
+        if (health_max := params.get('health_max')) is not None:
+            queryset = queryset.filter(decayed_health__lte=parse_int(health_max, 'health_max'))
+        if (in_fight := params.get('in_fight')) is not None:
+            queryset = queryset.filter(in_fight=parse_bool(in_fight, 'in_fight'))
+        if name := params.get('name'):
+            queryset = queryset.filter(profile__player__name__istartswith=name)
+        return queryset
 
 
 @extend_schema(
@@ -192,7 +287,11 @@ class FightChallengeView(CreateAPIView, RetrieveAPIView, UpdateAPIView, GenericA
         validate_request(request, 'project_id', 'account_id', 'opponent_id')
         if self.get_queryset().exists():
             return Response({'error': "You're already in fight."}, status=409)
-        return super().create(request, *args, **kwargs)
+        try:
+            with transaction.atomic():
+                return super().create(request, *args, **kwargs)
+        except (ConflictError, IntegrityError):  # lost the race for one of the profiles
+            return Response({'error': "You or your opponent are already in fight."}, status=409)
 
     @extend_schema(
         parameters=[
@@ -202,24 +301,191 @@ class FightChallengeView(CreateAPIView, RetrieveAPIView, UpdateAPIView, GenericA
     )
     def retrieve(self, request, *args, **kwargs):
         validate_request(request, 'account_id')
-        return super().retrieve(request, *args, **kwargs)
+        versions = list(self.get_queryset().values_list('pk', 'version')[:2])
+        if len(versions) == 1:
+            etag = make_etag(*versions[0])
+            if (not_modified := get_not_modified_response(request, etag)) is not None:
+                return not_modified
+            return set_validators(super().retrieve(request, *args, **kwargs), etag)
+        return super().retrieve(request, *args, **kwargs)  # get_object() raises the error
 
     def update(self, request, *args, **kwargs):
         validate_request(request, 'project_id', 'account_id', 'action')
         return super().update(request, *args, **kwargs)
 
     def get_object(self):
-        queryset = self.get_queryset()
-        if queryset.count() > 1:
+        try:
+            return self.get_queryset().get()
+        except FightChallenge.MultipleObjectsReturned:
             raise ValidationError(detail='Something went wrong. More than one pending fight challenge exists', code=500)
-        elif queryset.count() == 0:
+        except FightChallenge.DoesNotExist:
             raise Http404('No pending fight challenge exists')
-        return self.get_queryset().first()
 
     def get_queryset(self):
         account_id = self.request.data.get('account_id') or self.request.GET.get('account_id')
-        print(account_id)
-        return super().get_queryset().filter(Q(opponent__player__account_id=account_id)
-                                             | Q(initiator__player__account_id=account_id)) \
-            .exclude(status__in=[FightStatus.COMPLETED, FightStatus.CANCELED]) \
-            .select_related('initiator', 'opponent', 'initiator__player', 'opponent__player')
+        return super().get_queryset().for_account(account_id).active() \
+            .select_related('initiator__player', 'initiator__project', 'opponent__player', 'opponent__project')
+
+
+@extend_schema(
+    methods=['GET'],
+    parameters=[
+        OpenApiParameter('account_id', type=str, required=True),
+        OpenApiParameter('binary', type=bool, required=False),
+    ],
+    description="Replay of a finished fight, available to its players\n\n"
+                "Streams newline-delimited JSON: the first line describes the fight, "
+                "every next line is an action applied during the fight:\n\n"
+                "```\n"
+                '{"fight_id": 1, "initiator": "5b10ac8d82e05b22cc7d4ef5", "opponent": "...", "hp": [100, 100]}\n'
+                '{"t": 5120, "actor": "initiator", "action": "punch", "hp": [100, 90.0]}\n'
+                "```\n\n"
+                "**t** is milliseconds since the fight start (including the countdown), "
+                "**hp** is health of the initiator and the opponent after the action.\n\n"
+                "With **binary=true** the stored log is returned as is (application/octet-stream), "
+                "see game/game_logic/action_log.py for the format."
+)
+class FightReplayView(APIView):
+    permission_classes = (AllowAny,)
+    actors = {1: 'initiator', 2: 'opponent'}
+
+    def get(self, request, pk, *args, **kwargs):
+        validate_request(request, 'account_id')
+        try:
+            action_log, initiator_id, opponent_id, initiator_health, opponent_health = \
+                FightChallenge.objects.for_account(request.GET['account_id']).filter(pk=pk) \
+                .exclude(action_log=None) \
+                .values_list('action_log', 'initiator__player__account_id', 'opponent__player__account_id',
+                             'initiator_health', 'opponent_health').get()
+        except FightChallenge.DoesNotExist:
+            raise Http404('No replay of this fight exists')
+        action_log = bytes(action_log)
+        if parse_bool(request.GET.get('binary', 'false'), 'binary'):
+            return HttpResponse(action_log, content_type='application/octet-stream')
+
+        def lines():
+            yield json.dumps({'fight_id': int(pk), 'initiator': initiator_id, 'opponent': opponent_id,
+                              'hp': [initiator_health, opponent_health]}) + '\n'
+            for record in iter_action_log(action_log):
+                yield json.dumps({'t': record.offset_ms, 'actor': self.actors[record.actor], 'action': record.action,
+                                  'hp': [round(record.player1_health, 2), round(record.player2_health, 2)]}) + '\n'
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+
+@extend_schema(
+    methods=['GET'],
+    parameters=[
+        OpenApiParameter('project_id', type=str, required=True),
+        OpenApiParameter('account_id', type=str, required=False, description='Player to return the rank of'),
+        OpenApiParameter('limit', type=int, required=False, description='Number of top players, 10 by default'),
+    ],
+    description="Leaderboard of a project, players are ordered by Elo rating\n\n"
+                "Response contains the top players and, if **account_id** is provided, the player's own position "
+                "(null if the player hasn't completed any fight yet):\n\n"
+                "```\n"
+                "{\n\n"
+                '\t"top": [{"rank": 1, "account_id": "...", "name": "...", "rating": 1016, "wins": 1, "losses": 0, '
+                '"draws": 0, "streak": 1}],\n\n'
+                '\t"me": {"rank": 7, ...}\n\n'
+                "}\n"
+                "```"
+)
+class LeaderboardView(APIView):
+    permission_classes = (AllowAny,)
+    serializer_class = LeaderboardEntrySerializer
+    max_limit = 100
+
+    def get(self, request, *args, **kwargs):
+        validate_request(request, 'project_id')
+        project_id = request.GET['project_id']
+        limit = min(parse_int(request.GET.get('limit', '10'), 'limit'), self.max_limit)
+        if limit < 1:
+            raise ValidationError('limit must be positive')
+        stats = PlayerStats.objects.filter(project__project_id=project_id).select_related('profile__player')
+
+        top = list(stats.order_by('-rating', 'id')[:limit])
+        for rank, player_stats in enumerate(top, 1):
+            player_stats.rank = rank
+        me = None
+        if account_id := request.GET.get('account_id'):
+            me = stats.filter(profile__player__account_id=account_id).first()
+            if me is not None:
+                me.rank = get_rank(me)
+        return Response({
+            'top': LeaderboardEntrySerializer(top, many=True).data,
+            'me': LeaderboardEntrySerializer(me).data if me is not None else None,
+        })
+
+
+@extend_schema(
+    methods=['GET'],
+    parameters=[
+        OpenApiParameter('project_id', type=str, required=True),
+        OpenApiParameter('account_id', type=str, required=False,
+                         description='History of this player, otherwise of the whole project'),
+        OpenApiParameter('status', type=str, required=False, enum=FINISHED_FIGHT_STATUSES,
+                         description='CO - completed, CA - canceled, both by default'),
+        OpenApiParameter('outcome', type=str, required=False, enum=['win', 'loss', 'draw'],
+                         description="Result of the player's completed fights, requires account_id, "
+                                     "can't be combined with status=CA"),
+        OpenApiParameter('page_size', type=int, required=False),
+        OpenApiParameter('cursor', type=str, required=False),
+    ],
+    description='Finished fights of a player or a project, newest first\n\n'
+                'The response is paginated: `{"next": ..., "results": [...]}`, '
+                'follow the **next** link to get the next page.'
+)
+class FightHistoryView(APIView):
+    permission_classes = (AllowAny,)
+    serializer_class = FightChallengeSerializer
+    outcomes = ('win', 'loss', 'draw')
+
+    def get(self, request, *args, **kwargs):
+        validate_request(request, 'project_id')
+        paginator = FightHistoryPagination(request)
+        statuses = self.get_statuses()
+        fights = FightChallenge.objects.filter(completed_at__isnull=False) \
+            .select_related('initiator__player', 'initiator__project', 'opponent__player', 'opponent__project',
+                            'winner__player', 'winner__project') \
+            .defer('action_log')
+        # every side (or the project) and status is a range of a fight history index already in the history order,
+        # each range is read up to the page size and the ranges are merged
+        if account_id := request.GET.get('account_id'):
+            profile = get_object_or_404(PlayerProfile, player__account_id=account_id,
+                                        project__project_id=request.GET['project_id'])
+            fights = self.filter_outcome(fights, profile)
+            ranges = [paginator.filter_queryset(fights.filter(**{side: profile}, status=status))
+                      for side in ('initiator', 'opponent') for status in statuses]
+        else:
+            if 'outcome' in request.GET:
+                raise ValidationError('outcome requires account_id')
+            ranges = [paginator.filter_queryset(fights.filter(project__project_id=request.GET['project_id'],
+                                                              status=status))
+                      for status in statuses]
+        page = list(heapq.merge(*ranges, key=lambda fight: (fight.completed_at, fight.pk), reverse=True))
+        page = paginator.get_page(page)
+        return paginator.get_paginated_response(FightChallengeSerializer(page, many=True).data)
+
+    def get_statuses(self) -> list[str]:
+        status = self.request.GET.get('status')
+        if status is not None and status not in FINISHED_FIGHT_STATUSES:
+            raise ValidationError(f'status must be one of {", ".join(FINISHED_FIGHT_STATUSES)}')
+        if 'outcome' in self.request.GET:
+            # canceled fights have no winner and aren't draws, they have no outcome
+            if status not in (None, FightStatus.COMPLETED):
+                raise ValidationError('outcome is available only for completed fights')
+            return [FightStatus.COMPLETED]
+        return FINISHED_FIGHT_STATUSES if status is None else [status]
+
+    def filter_outcome(self, fights, profile: PlayerProfile):
+        outcome = self.request.GET.get('outcome')
+        if outcome is None:
+            return fights
+        if outcome not in self.outcomes:
+            raise ValidationError(f'outcome must be one of {", ".join(self.outcomes)}')
+        if outcome == 'win':
+            return fights.filter(winner=profile)
+        if outcome == 'draw':
+            return fights.filter(draw=True)
+        return fights.filter(draw=False).exclude(winner=profile)
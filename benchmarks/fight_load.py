@@ -0,0 +1,202 @@
+"""
+Load test of FightConsumer on one event loop, like a single daphne worker. Runs offline:
+in-memory sqlite database, InMemoryChannelLayer and InMemoryFightStorage.
+
+    python -m benchmarks.fight_load --fights 200 --duration 10 --rate 5 --protocol msgpack
+
+Seeds N pending fights, connects 2N sockets, starts the fights and makes every player hit the opponent
+--rate times per second during --duration seconds. Reports hit-to-opponent latency percentiles,
+messages per second and memory allocated per fight while connecting and starting the fights.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tracemalloc
+from collections import deque
+from time import perf_counter
+
+import django
+from django.conf import settings
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'taskogotchi.settings')
+# the database connections are configured by django.setup(), so the settings are replaced before it
+settings.DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}}
+settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer",
+                                       "CONFIG": {"capacity": 10 ** 6}}}
+settings.FIGHT_STORAGE = {"BACKEND": "game.fight_storage.InMemoryFightStorage"}
+django.setup()
+
+from asgiref.sync import sync_to_async  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.db import connection  # noqa: E402
+
+import msgpack  # noqa: E402
+
+from core.models import Project, Player, PlayerProfile, Taskogotchi, FightChallenge, FightStatus  # noqa: E402
+from game.game_logic.constants import ACTION_PUNCH, ACTION_KICK  # noqa: E402
+from game.protocol import SUBPROTOCOL_V2_JSON, SUBPROTOCOL_V2_MSGPACK  # noqa: E402
+from game.routing import websocket_urlpatterns  # noqa: E402
+
+SUBPROTOCOLS = {
+    'v1': None,
+    'json': [SUBPROTOCOL_V2_JSON],
+    'msgpack': [SUBPROTOCOL_V2_MSGPACK],
+}
+# health of the fighters, big enough not to end the fight during the test
+FIGHTER_HEALTH = 10 ** 9
+
+
+@sync_to_async
+def seed_fights(count: int) -> list[tuple[str, str]]:
+    project = Project.objects.create(project_id='load-test', name='Load test')
+    players = Player.objects.bulk_create([Player(account_id=f'load{i}', name=f'Player {i}')
+                                          for i in range(count * 2)])
+    profiles = PlayerProfile.objects.bulk_create([PlayerProfile(player=player, project=project)
+                                                  for player in players])
+    Taskogotchi.objects.bulk_create([Taskogotchi(profile=profile) for profile in profiles])
+    FightChallenge.objects.bulk_create([
+        FightChallenge(project=project, initiator=profiles[i], opponent=profiles[i + 1], status=FightStatus.PENDING,
+                       initiator_health=FIGHTER_HEALTH, opponent_health=FIGHTER_HEALTH)
+        for i in range(0, len(profiles), 2)
+    ])
+    return [(players[i].account_id, players[i + 1].account_id) for i in range(0, len(players), 2)]
+
+
+class LoadPlayer:
+    def __init__(self, application, account_id: str, protocol: str):
+        self.account_id = account_id
+        self.communicator = WebsocketCommunicator(application, f'/ws/fight/{account_id}/',
+                                                  subprotocols=SUBPROTOCOLS[protocol])
+        self.opponent: 'LoadPlayer | None' = None
+        self.sent_at: deque[float] = deque()  # send times of the hits not received by the opponent yet
+        self.latencies: list[float] = []
+        self.sent = self.received = 0
+        self.fight_started = asyncio.Event()
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f'{self.account_id} could not connect')
+        self._reader = asyncio.create_task(self.read())
+
+    async def send(self, action: str):
+        data = {'account_id': self.account_id, 'action': action}
+        self.sent_at.append(perf_counter())
+        self.sent += 1
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def read(self):
+        while True:
+            output = await self.communicator.receive_output(timeout=3600)
+            if output['type'] != 'websocket.send':
+                return
+            self.received += 1
+            if output.get('bytes') is not None:
+                message = msgpack.unpackb(output['bytes'])
+            else:
+                message = json.loads(output['text'])
+            self.handle(message)
+
+    def handle(self, message: dict):
+        if message.get('message') == 'fight_started':
+            self.fight_started.set()
+        elif message.get('type') == 'tick':  # protocol v2, hits coalesced by the fight's tick
+            self.record_hits(message['account_id'], len(message['actions']))
+        elif message.get('type') == 'action':
+            self.record_hits(message['account_id'], 1)
+        elif 'actions' in message:  # protocol v1
+            self.record_hits(json.loads(message['data'])['account_id'], len(message['actions']))
+        elif 'data' in message:
+            self.record_hits(json.loads(message['data'])['account_id'], 1)
+
+    def record_hits(self, account_id: str, count: int):
+        if account_id != self.opponent.account_id:
+            return
+        received_at = perf_counter()
+        for _ in range(min(count, len(self.opponent.sent_at))):
+            self.latencies.append(received_at - self.opponent.sent_at.popleft())
+
+    async def hit(self, count: int, interval: float):
+        actions = (ACTION_PUNCH, ACTION_KICK)
+        for i in range(count):
+            await self.send(actions[i % 2])
+            await asyncio.sleep(interval)
+
+    async def disconnect(self):
+        self._reader.cancel()
+        await self.communicator.disconnect()
+
+
+def percentile(values: list[float], percent: int) -> float:
+    return statistics.quantiles(values, n=100)[percent - 1] if len(values) > 1 else values[0]
+
+
+async def run(fights: int, duration: float, rate: float, protocol: str) -> dict:
+    fighters = await seed_fights(fights)
+    application = URLRouter(websocket_urlpatterns)
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    players = []
+    for initiator_id, opponent_id in fighters:
+        initiator = LoadPlayer(application, initiator_id, protocol)
+        opponent = LoadPlayer(application, opponent_id, protocol)
+        initiator.opponent, opponent.opponent = opponent, initiator
+        players += [initiator, opponent]
+    for player in players:
+        await player.connect()
+    await asyncio.gather(*(player.send('start_game') for player in players[::2]))
+    await asyncio.gather(*(player.fight_started.wait() for player in players))
+    memory_per_fight = (tracemalloc.get_traced_memory()[0] - memory_before) / fights
+    tracemalloc.stop()
+    for player in players:  # start and waiting messages aren't hits
+        player.sent_at.clear()
+        player.sent = player.received = 0
+
+    hits = max(int(duration * rate), 1)
+    started = perf_counter()
+    await asyncio.gather(*(player.hit(hits, 1 / rate) for player in players))
+    await asyncio.sleep(1)  # let the last hits reach the opponents
+    elapsed = perf_counter() - started
+    for player in players:
+        await player.disconnect()
+
+    latencies = [latency * 1000 for player in players for latency in player.latencies]
+    sent = sum(player.sent for player in players)
+    received = sum(player.received for player in players)
+    return {
+        'fights': fights,
+        'sockets': len(players),
+        'protocol': protocol,
+        'hits_sent': sent,
+        'hits_delivered': len(latencies),
+        'messages_per_second': round((sent + received) / elapsed),
+        'latency_ms': {f'p{p}': round(percentile(latencies, p), 2) for p in (50, 95, 99)} if latencies else None,
+        'memory_per_fight_kb': round(memory_per_fight / 1024, 1),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Load test of FightConsumer on one event loop')
+    parser.add_argument('--fights', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of hitting')
+    parser.add_argument('--rate', type=float, default=5, help='Hits per second of every player')
+    parser.add_argument('--protocol', choices=SUBPROTOCOLS, default='v1')
+    args = parser.parse_args(argv)
+
+    test_database = connection.creation.create_test_db(verbosity=0)
+    try:
+        result = asyncio.run(run(args.fights, args.duration, args.rate, args.protocol))
+    finally:
+        connection.creation.destroy_test_db(test_database, verbosity=0)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
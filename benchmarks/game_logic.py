@@ -0,0 +1,168 @@
+"""
+Micro-benchmarks of the fight hot path: code that runs on every websocket message.
+
+    python -m benchmarks.game_logic                   # run and print the results
+    python -m benchmarks.game_logic --compare         # compare with benchmarks/baseline.json, exit 1 on regression
+    python -m benchmarks.game_logic --save-baseline   # store the results as the new baseline
+
+Numbers depend on the machine and the python version, compare only results from the same box.
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+from pathlib import Path
+from time import time
+
+from game.game_logic.actions_mapping import map_action
+from game.game_logic.constants import ACTION_PUNCH, FIGHT_DURATION, FIGHT_COUNTDOWN_DURATION
+from game.game_logic.fight import Fight, FightPlayer, FightTimer
+from game.protocol import DeltaFightProtocol
+
+BASELINE_PATH = Path(__file__).with_name('baseline.json')
+DEFAULT_THRESHOLD = 0.2
+
+
+def create_fight() -> Fight:
+    # huge health, so the fight isn't ended by the benchmarks
+    return Fight(
+        FightPlayer('5b10ac8d82e05b22cc7d4ef5', 10 ** 12, 100, 'Initiator'),
+        FightPlayer('5b10ac8d82e05b22cc7d4ef6', 10 ** 12, 100, 'Opponent'),
+        FightTimer(time() - FIGHT_COUNTDOWN_DURATION, FIGHT_DURATION, FIGHT_COUNTDOWN_DURATION),
+    )
+
+
+def bench_player_attack():
+    fight = create_fight()
+    return lambda: fight.player1.attack(fight.player2)
+
+
+def bench_fight_attack():
+    fight = create_fight()
+    return lambda: fight.attack(fight.player1, fight.player2)
+
+
+def bench_map_action_hit():
+    fight = create_fight()
+    return lambda: map_action(fight.player2.account_id, ACTION_PUNCH, fight=fight)
+
+
+def bench_map_action_default():
+    fight = create_fight()
+    return lambda: map_action(fight.player1.account_id, 'waiting', fight=fight)
+
+
+def bench_apply_hit():
+    fight = create_fight()
+    return lambda: map_action(fight.player1.account_id, ACTION_PUNCH, fight=fight).do_action()
+
+
+def bench_fight_state():
+    fight = create_fight()
+    return fight.get_state
+
+
+def bench_fight_to_json():
+    fight = create_fight()
+    return fight.to_json
+
+
+def bench_fight_to_json_dumps():
+    fight = create_fight()
+    return lambda: json.dumps(fight.to_json())
+
+
+def bench_fight_from_json():
+    data = create_fight().to_json()
+    return lambda: Fight.from_json(data)
+
+
+def bench_delta_frame():
+    fight = create_fight()
+    protocol = DeltaFightProtocol(binary=True)
+    protocol.encode_server_info('fight_started', fight.to_json())
+
+    def run():
+        fight.player1.attack(fight.player2)
+        protocol.encode_opponent_action(fight.to_json(), fight.player1.account_id, ACTION_PUNCH, '')
+    return run
+
+
+BENCHMARKS = {
+    'player_attack': bench_player_attack,
+    'fight_attack': bench_fight_attack,
+    'map_action_hit': bench_map_action_hit,
+    'map_action_default': bench_map_action_default,
+    'apply_hit': bench_apply_hit,
+    'fight_state': bench_fight_state,
+    'fight_to_json': bench_fight_to_json,
+    'fight_to_json_dumps': bench_fight_to_json_dumps,
+    'fight_from_json': bench_fight_from_json,
+    'delta_frame_msgpack': bench_delta_frame,
+}
+
+
+def run_benchmark(setup, repeat: int) -> float:
+    """Best time of one call in nanoseconds"""
+    timer = timeit.Timer(setup())
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def run(names: list[str], repeat: int) -> dict[str, float]:
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(BENCHMARKS[name], repeat)
+        print(f'{name:<24} {results[name]:>10.0f} ns')
+    return results
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """Returns names of the benchmarks that are slower than the baseline by more than threshold"""
+    regressions = []
+    print(f'\n{"benchmark":<24} {"baseline":>10} {"current":>10} {"change":>8}')
+    for name, value in results.items():
+        if name not in baseline:
+            print(f'{name:<24} {"-":>10} {value:>10.0f} {"new":>8}')
+            continue
+        change = value / baseline[name] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<24} {baseline[name]:>10.0f} {value:>10.0f} {change:>+8.1%}{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks of game/game_logic')
+    parser.add_argument('names', nargs='*', help=f'Benchmarks to run, all by default: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--compare', action='store_true', help=f'Compare with {BASELINE_PATH.name}')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Allowed slowdown before a benchmark is reported as a regression (0.2 = 20%%)')
+    parser.add_argument('--save-baseline', action='store_true', help=f'Write the results to {BASELINE_PATH.name}')
+    args = parser.parse_args(argv)
+    if unknown := set(args.names) - BENCHMARKS.keys():
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    results = run(args.names or list(BENCHMARKS), args.repeat)
+
+    if args.compare:
+        baseline = json.loads(BASELINE_PATH.read_text())
+        if baseline['python'] != platform.python_version():
+            print(f'\nWarning: baseline was measured on python {baseline["python"]}')
+        if regressions := compare(results, baseline['results'], args.threshold):
+            print(f'\n{len(regressions)} regression(s): {", ".join(regressions)}')
+            return 1
+
+    if args.save_baseline:
+        BASELINE_PATH.write_text(json.dumps({
+            'python': platform.python_version(),
+            'results': {name: round(value, 1) for name, value in results.items()},
+        }, indent=2) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
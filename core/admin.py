@@ -1,10 +1,11 @@
 from django.contrib import admin
-from core.models import Taskogotchi, Project, PlayerProfile, FightChallenge, Player
+from core.models import Taskogotchi, Project, PlayerProfile, FightChallenge, Player, Notification, PlayerStats
 
 
 @admin.register(Taskogotchi)
 class TaskogotchiAdmin(admin.ModelAdmin):
     list_display = ('id', 'profile', 'last_updated', 'health', 'strength')
+    list_select_related = ('profile__player', 'profile__project')
 
 
 @admin.register(Project)
@@ -20,9 +21,25 @@ class PlayerAdmin(admin.ModelAdmin):
 @admin.register(PlayerProfile)
 class PlayerProfileAdmin(admin.ModelAdmin):
     list_display = ('id', 'player', 'project')
+    list_select_related = ('player', 'project')
 
 
 @admin.register(FightChallenge)
 class FightChallengeAdmin(admin.ModelAdmin):
     list_display = ('id', 'initiator', 'opponent', 'status', 'winner', 'draw')
     list_editable = ('status', 'draw')
+    list_select_related = ('initiator__player', 'initiator__project', 'opponent__player', 'opponent__project',
+                           'winner__player', 'winner__project')
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'recipient', 'subject', 'status', 'attempts', 'next_attempt_at', 'claimed_at', 'sent_at')
+    list_filter = ('status',)
+
+
+@admin.register(PlayerStats)
+class PlayerStatsAdmin(admin.ModelAdmin):
+    list_display = ('id', 'profile', 'project', 'rating', 'wins', 'losses', 'draws', 'streak')
+    list_select_related = ('profile__player', 'profile__project', 'project')
+    list_filter = ('project',)
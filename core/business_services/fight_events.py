@@ -0,0 +1,61 @@
+import logging
+from functools import partial
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from core.models import FightChallenge, FINISHED_FIGHT_STATUSES
+
+logger = logging.getLogger(__name__)
+
+
+def presence_group_name(project_pk: int) -> str:
+    """Channel layer group of the presence sockets of the project, see game.consumers.PresenceConsumer"""
+    return f"presence_{project_pk}"
+
+
+def player_group_name(account_id: str) -> str:
+    """Channel layer group of the player's notification sockets, see game.consumers.NotificationConsumer"""
+    return f"player_{account_id}"
+
+
+def get_fight_status_event(fight: FightChallenge) -> dict:
+    """The initiator and opponent players must be loaded with the fight"""
+    initiator_id, opponent_id = fight.initiator.player.account_id, fight.opponent.player.account_id
+    if fight.winner_id is None:
+        winner_id = None
+    else:
+        winner_id = initiator_id if fight.winner_id == fight.initiator_id else opponent_id
+    return {
+        "type": "fight_status",
+        "fight_id": fight.pk,
+        "status": fight.status,
+        "account_ids": [initiator_id, opponent_id],
+        "in_fight": fight.status not in FINISHED_FIGHT_STATUSES,
+        "winner_account_id": winner_id,
+        "draw": fight.draw,
+    }
+
+
+def _send_fight_status(fight: FightChallenge, created: bool) -> None:
+    event = get_fight_status_event(fight)
+    groups = [player_group_name(account_id) for account_id in event['account_ids']]
+    if created or fight.status in FINISHED_FIGHT_STATUSES:
+        groups.append(presence_group_name(fight.initiator.project_id))
+    send = async_to_sync(get_channel_layer().group_send)
+    for group in groups:
+        try:
+            send(group, event)
+        except Exception:  # the change is committed already, a failed push must not fail the request
+            logger.exception('Failed to send %s to %s', event['type'], group)
+
+
+def publish_fight_status(fight: FightChallenge, created: bool = False) -> None:
+    """
+    Push the fight's status to the notification sockets of both players once the current transaction is committed,
+    the event is made from the fight as it was committed. The creation and the end of a fight change whether
+    its players are in fight, these are also pushed to the project's presence sockets.
+    The initiator and opponent players must be loaded with the fight.
+    """
+    transaction.on_commit(partial(_send_fight_status, fight, created))
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.business_services.fight_status_state_machine import FightStatusStateMachine
+from core.models import FightChallenge
+
+
+def expire_fights_batch(status: str, ttl: timedelta, batch_size: int = 100) -> list[FightChallenge]:
+    """
+    Cancel up to batch_size fights that have been in the status for longer than ttl, with the state machine's
+    cancel rules, one UPDATE for the batch. Rows locked by a concurrent transition are skipped.
+    Both players get the change once it's committed. Returns the canceled fights.
+    """
+    with transaction.atomic():
+        fights = list(FightChallenge.objects.select_for_update(skip_locked=True, of=('self',))
+                      .filter(status=status, status_changed_at__lt=timezone.now() - ttl)
+                      .select_related('initiator__player', 'opponent__player')
+                      .order_by('status_changed_at')[:batch_size])
+        for fight in fights:
+            FightStatusStateMachine.process_action('cancel', fight, save=False)
+            fight.version = F('version') + 1
+        FightChallenge.objects.bulk_update(fights, ['status', 'status_changed_at', 'completed_at', 'version'])
+    return fights
+
+
+def expire_fights(batch_size: int = 100):
+    """Cancel fights expired in every status of settings.FIGHT_STATUS_TTL, yields batches of canceled fights"""
+    for status, ttl in settings.FIGHT_STATUS_TTL.items():
+        while fights := expire_fights_batch(status, timedelta(seconds=ttl), batch_size):
+            yield fights
+            if len(fights) < batch_size:
+                break
@@ -1,4 +1,9 @@
-from core.models import FightStatus, FightChallenge
+from django.db import transaction
+from django.utils import timezone
+
+from core.business_services.fight_events import publish_fight_status
+from core.business_services.leaderboard import record_fight_result
+from core.models import FightStatus, FightChallenge, FINISHED_FIGHT_STATUSES
 from rest_framework.exceptions import ValidationError
 
 
@@ -30,43 +35,49 @@ class FightStatusStateMachine:
             raise ValidationError('The fight is already over.')
         return completed
 
+    def _set_status(self, status: str) -> FightChallenge:
+        """
+        Set the status, save the fight and publish the change once the transaction is committed.
+        If save is False, call the action in the transaction that saves the fight.
+        """
+        self._fight.status = status
+        self._fight.status_changed_at = timezone.now()
+        if status in FINISHED_FIGHT_STATUSES:
+            self._fight.completed_at = self._fight.status_changed_at
+        with transaction.atomic(savepoint=False):
+            if self._save:
+                self._fight.save()
+                if status == FightStatus.COMPLETED:
+                    record_fight_result(self._fight)
+            publish_fight_status(self._fight)
+        return self._fight
+
     def accept(self) -> FightChallenge:
         """Accept the fight challenge."""
         self._check_fight_ended(raise_exception=True)
         if self._fight.status == FightStatus.WAITING_ACCEPT:
-            self._fight.status = FightStatus.ACCEPTED
-            if self._save:
-                self._fight.save()
-            return self._fight
+            return self._set_status(FightStatus.ACCEPTED)
         raise ValidationError('The fight is not in WAITING_ACCEPT status, so can\'t accept it.')
 
     def start(self) -> FightChallenge:
         """Start the fight."""
         self._check_fight_ended(raise_exception=True)
         if self._fight.status == FightStatus.ACCEPTED:
-            self._fight.status = FightStatus.PENDING
-            if self._save:
-                self._fight.save()
-            return self._fight
+            return self._set_status(FightStatus.PENDING)
         raise ValidationError('The fight is not in ACCEPTED status, so can\'t start it.')
 
     def complete(self) -> FightChallenge:
         """
         Complete the fight.
         If winner is None, the fight is a draw. Otherwise, the winner is the player profile.
+        If save is False, the caller must save the fight and call record_fight_result in one transaction.
         """
         self._check_fight_ended(raise_exception=True)
         if self._fight.status == FightStatus.PENDING:
-            self._fight.status = FightStatus.COMPLETED
-            if self._save:
-                self._fight.save()
-            return self._fight
+            return self._set_status(FightStatus.COMPLETED)
         raise ValidationError('The fight is not in PROGRESS status, so can\'t complete it.')
 
     def cancel(self) -> FightChallenge:
         """Cancel the fight."""
         self._check_fight_ended(raise_exception=True)
-        self._fight.status = FightStatus.CANCELED
-        if self._save:
-            self._fight.save()
-        return self._fight
+        return self._set_status(FightStatus.CANCELED)
@@ -0,0 +1,85 @@
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.models import FightChallenge, FightStatus, PlayerStats
+
+ELO_K_FACTOR = 32
+WIN, DRAW, LOSS = 1.0, 0.5, 0.0
+
+
+def apply_result(stats: PlayerStats, opponent_stats: PlayerStats, score: float) -> None:
+    """Update counters, streak and Elo rating of both players, score is the result of the first one"""
+    expected = 1 / (1 + 10 ** ((opponent_stats.rating - stats.rating) / 400))
+    change = round(ELO_K_FACTOR * (score - expected))
+    stats.rating += change
+    opponent_stats.rating -= change
+    for player_stats, player_score in ((stats, score), (opponent_stats, 1 - score)):
+        if player_score == WIN:
+            player_stats.wins += 1
+            player_stats.streak = player_stats.streak + 1 if player_stats.streak > 0 else 1
+        elif player_score == LOSS:
+            player_stats.losses += 1
+            player_stats.streak = player_stats.streak - 1 if player_stats.streak < 0 else -1
+        else:
+            player_stats.draws += 1
+            player_stats.streak = 0
+
+
+def get_initiator_score(fight: FightChallenge) -> float:
+    if fight.draw:
+        return DRAW
+    return WIN if fight.winner_id == fight.initiator_id else LOSS
+
+
+def record_fight_result(fight: FightChallenge) -> None:
+    """
+    Add the result of the completed fight to the stats of both players.
+    Must be called in the transaction that completes the fight, so every result is counted exactly once.
+    """
+    assert fight.status == FightStatus.COMPLETED, "Only completed fights have results"
+    project_id = fight.initiator.project_id
+    PlayerStats.objects.bulk_create([PlayerStats(profile_id=fight.initiator_id, project_id=project_id),
+                                     PlayerStats(profile_id=fight.opponent_id, project_id=project_id)],
+                                    ignore_conflicts=True)
+    # rows are locked in the same order by every fight, so concurrent fights of the same players don't deadlock
+    stats = {player_stats.profile_id: player_stats for player_stats in PlayerStats.objects.select_for_update()
+             .filter(profile_id__in=[fight.initiator_id, fight.opponent_id]).order_by('profile_id')}
+    apply_result(stats[fight.initiator_id], stats[fight.opponent_id], get_initiator_score(fight))
+    now = timezone.now()
+    for player_stats in stats.values():
+        player_stats.updated_at = now  # bulk_update doesn't set auto_now fields
+    PlayerStats.objects.bulk_update(stats.values(), ['wins', 'losses', 'draws', 'streak', 'rating', 'updated_at'])
+
+
+def get_rank(stats: PlayerStats) -> int:
+    """Position in the project's leaderboard, counted on the leaderboard index"""
+    return PlayerStats.objects.filter(project_id=stats.project_id).filter(
+        Q(rating__gt=stats.rating) | Q(rating=stats.rating, id__lt=stats.id)
+    ).count() + 1
+
+
+@transaction.atomic
+def rebuild_leaderboard(project_id: str | None = None) -> int:
+    """
+    Recompute stats from all completed fights, of one project if project_id is given. Returns number of stats.
+    Elo depends on the order of results, fights are replayed in the order they were completed, as they were recorded.
+    """
+    fights = FightChallenge.objects.filter(status=FightStatus.COMPLETED) \
+        .order_by(F('completed_at').asc(nulls_first=True), 'id') \
+        .values_list('initiator_id', 'opponent_id', 'winner_id', 'draw', 'initiator__project_id')
+    stats_to_delete = PlayerStats.objects.all()
+    if project_id is not None:
+        fights = fights.filter(initiator__project__project_id=project_id)
+        stats_to_delete = stats_to_delete.filter(project__project_id=project_id)
+    stats_to_delete.delete()
+
+    stats: dict[int, PlayerStats] = {}
+    for initiator_id, opponent_id, winner_id, draw, fight_project_id in fights.iterator(chunk_size=2000):
+        for profile_id in (initiator_id, opponent_id):
+            if profile_id not in stats:
+                stats[profile_id] = PlayerStats(profile_id=profile_id, project_id=fight_project_id)
+        score = DRAW if draw else WIN if winner_id == initiator_id else LOSS
+        apply_result(stats[initiator_id], stats[opponent_id], score)
+    PlayerStats.objects.bulk_create(stats.values(), batch_size=1000)
+    return len(stats)
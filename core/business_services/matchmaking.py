@@ -0,0 +1,46 @@
+from django.db import transaction
+from django.db.models import Q
+
+from core.business_services.fight_events import publish_fight_status
+from core.models import FightChallenge, FightStatus, PlayerProfile
+
+
+class PlayerInFight(Exception):
+    """The player already has an active fight and can't be matched"""
+
+    def __init__(self, account_id: str):
+        super().__init__(f'Player {account_id} is already in fight')
+        self.account_id = account_id
+
+
+@transaction.atomic
+def create_matched_fight(project_id: str, account_id: str, opponent_account_id: str) -> FightChallenge:
+    """
+    Create an accepted fight of two players paired by matchmaking, both agreed to fight by entering the queue.
+    Profiles are locked in the same order as on challenge creation, so concurrent challenges of the players
+    wait here and see the created fight. Raises PlayerInFight if one of the players got a fight meanwhile.
+    """
+    profiles = {profile.player.account_id: profile for profile in PlayerProfile.objects
+                .select_for_update(of=('self',))
+                .filter(player__account_id__in=[account_id, opponent_account_id], project__project_id=project_id)
+                .select_related('player', 'taskogotchi').order_by('pk')}
+    initiator, opponent = profiles[account_id], profiles[opponent_account_id]
+    busy = FightChallenge.objects.active().filter(Q(initiator__in=[initiator, opponent])
+                                                  | Q(opponent__in=[initiator, opponent])) \
+        .values_list('initiator_id', 'opponent_id')
+    busy_profile_ids = {profile_id for fight in busy for profile_id in fight}
+    if initiator.pk in busy_profile_ids:
+        raise PlayerInFight(account_id)
+    if opponent.pk in busy_profile_ids:
+        raise PlayerInFight(opponent_account_id)
+    fight = FightChallenge.objects.create(
+        initiator=initiator,
+        initiator_health=initiator.taskogotchi.current_health,
+        initiator_strength=initiator.taskogotchi.strength,
+        opponent=opponent,
+        opponent_health=opponent.taskogotchi.current_health,
+        opponent_strength=opponent.taskogotchi.strength,
+        status=FightStatus.ACCEPTED,
+    )
+    publish_fight_status(fight, created=True)
+    return fight
@@ -1,19 +1,107 @@
-from django.core.mail import send_mail
-from core.models import FightChallenge, FightStatus
+from datetime import timedelta
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.models import FightChallenge, FightStatus, Notification, NotificationStatus
+
+NOTIFICATION_FROM_EMAIL = "notification@backend.guard-lite.com"
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = timedelta(seconds=30)
+RETRY_MAX_DELAY = timedelta(hours=1)
+# a notification claimed for longer than this is considered abandoned by its worker and is sent again
+CLAIM_TIMEOUT = timedelta(minutes=10)
 
 
 def send_fight_call_notification(fight: FightChallenge):
+    """
+    Put the notification to the outbox, it is sent by the sendnotifications command.
+    Call it in the transaction that creates the fight, so the notification is stored only if the fight is.
+    """
     if not fight.status == FightStatus.WAITING_ACCEPT or not fight.opponent.player.email:
         return
 
-    send_mail(
+    message = f"You were challenged to a fight by " \
+              f"{fight.initiator.player.name or fight.initiator.player.email} " \
+              f"in project {fight.initiator.project.name or '<b>not accessible</b>'}."
+    Notification.objects.create(
         subject="New fight challenge",
-        message=f"You were challenged to a fight by "
-                f"{fight.initiator.player.name or fight.initiator.player.email} "
-                f"in project {fight.initiator.project.name or '<b>not accessible</b>'}.",
-        html_message=f"You were challenged to a fight by "
-                     f"{fight.initiator.player.name or fight.initiator.player.email} "
-                     f"in project {fight.initiator.project.name or '<b>not accessible</b>'}.",
-        from_email="notification@backend.guard-lite.com",
-        recipient_list=[fight.opponent.player.email],
+        message=message,
+        html_message=message,
+        from_email=NOTIFICATION_FROM_EMAIL,
+        recipient=fight.opponent.player.email,
     )
+
+
+def get_retry_delay(attempts: int) -> timedelta:
+    """Exponential backoff: 30s, 1m, 2m, ... but not more than an hour"""
+    return min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+
+
+def claim_notifications(batch_size: int = 100) -> list[Notification]:
+    """
+    Mark a batch of due notifications as sending in a short transaction and return them.
+    Rows are locked with SKIP LOCKED, so several workers can drain the outbox at the same time.
+    Notifications claimed longer than CLAIM_TIMEOUT ago are claimed again, their worker is considered dead.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(Notification.objects.select_for_update(skip_locked=True)
+                     .filter(Q(status=NotificationStatus.PENDING, next_attempt_at__lte=now)
+                             | Q(status=NotificationStatus.SENDING, claimed_at__lt=now - CLAIM_TIMEOUT))
+                     .order_by('next_attempt_at')[:batch_size])
+        if batch:
+            # attempts are counted on claim, so a notification that kills its worker runs out of them too
+            Notification.objects.filter(pk__in=[notification.pk for notification in batch]) \
+                .update(status=NotificationStatus.SENDING, claimed_at=now, attempts=F('attempts') + 1)
+    for notification in batch:
+        notification.status, notification.claimed_at = NotificationStatus.SENDING, now
+        notification.attempts += 1
+    return batch
+
+
+def mark_notification(notification: Notification, **fields) -> None:
+    """Store the result of the send, unless the notification was claimed again by another worker meanwhile"""
+    Notification.objects.filter(pk=notification.pk, status=NotificationStatus.SENDING,
+                                claimed_at=notification.claimed_at).update(**fields)
+
+
+def send_pending_notifications(batch_size: int = 100) -> tuple[int, int]:
+    """
+    Send a batch of due notifications over one mail connection.
+    The batch is claimed first and sent outside of any transaction, every notification is marked
+    as soon as it's sent, so a crash in the middle of the batch doesn't send the delivered ones again.
+    Failed notifications are retried with backoff, after MAX_ATTEMPTS they are marked as failed.
+    Returns numbers of sent and failed notifications.
+    """
+    sent = failed = 0
+    batch = claim_notifications(batch_size)
+    if not batch:
+        return sent, failed
+
+    with get_connection() as connection:
+        for notification in batch:
+            email = EmailMultiAlternatives(
+                subject=notification.subject,
+                body=notification.message,
+                from_email=notification.from_email,
+                to=[notification.recipient],
+                connection=connection,
+            )
+            if notification.html_message:
+                email.attach_alternative(notification.html_message, 'text/html')
+            try:
+                email.send()
+            except Exception as e:
+                failed += 1
+                if notification.attempts >= MAX_ATTEMPTS:
+                    mark_notification(notification, status=NotificationStatus.FAILED, last_error=str(e))
+                else:
+                    mark_notification(notification, status=NotificationStatus.PENDING, last_error=str(e),
+                                      next_attempt_at=timezone.now() + get_retry_delay(notification.attempts))
+            else:
+                sent += 1
+                mark_notification(notification, status=NotificationStatus.SENT, sent_at=timezone.now())
+    return sent, failed
@@ -0,0 +1,60 @@
+from django.db import models, transaction
+
+from core.models import Project, Player, PlayerProfile
+
+BULK_BATCH_SIZE = 500
+
+
+def _upsert(model: type[models.Model], key_field: str, rows: dict[str, dict]) -> dict[str, int]:
+    """
+    Create or update rows identified by a unique key_field. Rows that are stored with the same values are not written.
+    Returns ids of all rows by key.
+    """
+    fields = list(next(iter(rows.values())).keys())
+    existing = {getattr(obj, key_field): obj
+                for obj in model.objects.filter(**{f'{key_field}__in': rows.keys()}).only(key_field, *fields)}
+    changed = [model(**{key_field: key}, **values) for key, values in rows.items()
+               if key not in existing or any(getattr(existing[key], f) != v for f, v in values.items())]
+    if changed:
+        model.objects.bulk_create(changed, batch_size=BULK_BATCH_SIZE, update_conflicts=True,
+                                  unique_fields=[key_field], update_fields=fields)
+
+    ids = {key: obj.pk for key, obj in existing.items()}
+    if new_keys := [key for key in rows if key not in existing]:
+        ids.update(model.objects.filter(**{f'{key_field}__in': new_keys}).values_list(key_field, 'pk'))
+    return ids
+
+
+@transaction.atomic
+def register_players(entries: list[dict]) -> dict[str, dict[str, int]]:
+    """
+    Bulk version of player registration. Creates or updates projects and players and creates missing profiles.
+    Every entry must contain account_id and project_id, player_name, email and project_name are stored as provided.
+    If the same player or project is in several entries, the last entry wins.
+    Returns profile ids as {project_id: {account_id: profile_id}}
+    """
+    if not entries:
+        return {}
+    project_ids = _upsert(Project, 'project_id', {
+        entry['project_id']: {'name': entry.get('project_name')} for entry in entries
+    })
+    player_ids = _upsert(Player, 'account_id', {
+        entry['account_id']: {'name': entry.get('player_name'), 'email': entry.get('email')} for entry in entries
+    })
+
+    wanted = {(player_ids[entry['account_id']], project_ids[entry['project_id']]) for entry in entries}
+    profiles = PlayerProfile.objects.filter(player_id__in=player_ids.values(), project_id__in=project_ids.values())
+    profile_ids = {(player_id, project_id): pk for player_id, project_id, pk
+                   in profiles.values_list('player_id', 'project_id', 'pk')}
+    if missing := wanted - profile_ids.keys():
+        PlayerProfile.objects.bulk_create([PlayerProfile(player_id=player_id, project_id=project_id)
+                                           for player_id, project_id in missing],
+                                          batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+        profile_ids.update({(player_id, project_id): pk for player_id, project_id, pk
+                            in profiles.values_list('player_id', 'project_id', 'pk')})
+
+    result = {}
+    for entry in entries:
+        key = (player_ids[entry['account_id']], project_ids[entry['project_id']])
+        result.setdefault(entry['project_id'], {})[entry['account_id']] = profile_ids[key]
+    return result
@@ -1,11 +1,61 @@
-from django.db.models import F
+import time
 
-from core.models import Taskogotchi
+from django.db import transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest, Now
 
+from core.models import Taskogotchi, MaintenanceCheckpoint
 
-def set_stats_full(stdout, style):
-    Taskogotchi.objects.all().update(health=100, strength=100)
 
+def add_batch_arguments(parser):
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Rows updated in one transaction')
+    parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to wait between chunks')
+    parser.add_argument('--project', dest='project_id', help='Update only taskogotchies of the project (project_id)')
+    parser.add_argument('--resume', action='store_true', help='Continue the interrupted run from its checkpoint')
 
-def decrease_health(stdout, style, decrease_value=5):
-    Taskogotchi.objects.filter(health__gt=0).update(health=F('health') - decrease_value)
+
+def run_batched_update(job_name, stdout, style, values: dict, filters: Q = Q(), project_id=None, chunk_size=1000,
+                       sleep=0.05, resume=False) -> int:
+    """
+    Update taskogotchies in chunks ordered by id, every chunk is a short transaction that also saves a checkpoint,
+    so row locks are held only for a chunk and an interrupted run can be resumed.
+    Returns the number of updated rows.
+    """
+    queryset = Taskogotchi.objects.filter(filters)
+    if project_id:
+        queryset = queryset.filter(profile__project__project_id=project_id)
+    checkpoint_name = f'{job_name}:{project_id or "*"}'
+
+    last_id = 0
+    if resume:
+        checkpoint = MaintenanceCheckpoint.objects.filter(name=checkpoint_name).first()
+        if checkpoint is not None:
+            last_id = checkpoint.last_id
+            stdout.write(f'Resuming from id {last_id}')
+
+    total = 0
+    started = time.monotonic()
+    while ids := list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size]):
+        with transaction.atomic():
+            total += Taskogotchi.objects.filter(filters, id__in=ids).update(**values)
+            MaintenanceCheckpoint.objects.update_or_create(name=checkpoint_name, defaults={'last_id': ids[-1]})
+        last_id = ids[-1]
+        elapsed = time.monotonic() - started
+        stdout.write(f'{total} rows updated, last id {last_id}, {total / elapsed:.0f} rows/s')
+        if sleep:
+            time.sleep(sleep)
+
+    MaintenanceCheckpoint.objects.filter(name=checkpoint_name).delete()
+    return total
+
+
+def set_stats_full(stdout, style, **options):
+    # health_updated_at is the start of the health decay
+    return run_batched_update('setstatsfull', stdout, style, {'health': 100, 'strength': 100, 'last_updated': Now(),
+                                                              'health_updated_at': Now()}, **options)
+
+
+def decrease_health(stdout, style, decrease_value=5, **options):
+    return run_batched_update('decreasestats', stdout, style,
+                              {'health': Greatest(F('health') - decrease_value, Value(0))},
+                              filters=Q(health__gt=0), **options)
@@ -1,11 +1,15 @@
-from django.core.management.base import BaseCommand, CommandError
-from ._logic import decrease_health
+from django.core.management.base import BaseCommand
+from ._logic import decrease_health, add_batch_arguments
 
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('decrease_value', nargs='?', type=int, default=5)
+        add_batch_arguments(parser)
 
     def handle(self, *args, **options):
-        decrease_health(self.stdout, self.style, options['decrease_value'])
-        self.stdout.write(self.style.SUCCESS('Successfully decreased health by %s' % options['decrease_value']))
+        updated = decrease_health(self.stdout, self.style, options['decrease_value'],
+                                  project_id=options['project_id'], chunk_size=options['chunk_size'],
+                                  sleep=options['sleep'], resume=options['resume'])
+        self.stdout.write(self.style.SUCCESS('Successfully decreased health by %s for %s taskogotchies'
+                                             % (options['decrease_value'], updated)))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core.business_services.leaderboard import rebuild_leaderboard
+
+
+class Command(BaseCommand):
+    help = 'Recompute player stats of the leaderboard from completed fights'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', dest='project_id', help='Rebuild only the leaderboard of this project_id')
+
+    def handle(self, *args, **options):
+        count = rebuild_leaderboard(options['project_id'])
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt stats of %s players' % count))
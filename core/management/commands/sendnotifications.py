@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.business_services.notification_sender import send_pending_notifications
+
+
+class Command(BaseCommand):
+    help = 'Send notifications from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='Keep sending new notifications until stopped')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait when the outbox is empty')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = send_pending_notifications(options['batch_size'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write('Sent %s, failed %s notifications' % (sent, failed))
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
+
+        self.stdout.write(self.style.SUCCESS('Successfully sent %s notifications, %s failed'
+                                             % (total_sent, total_failed)))
@@ -1,11 +1,15 @@
-from django.core.management.base import BaseCommand, CommandError
-from ._logic import set_stats_full
+from django.core.management.base import BaseCommand
+from ._logic import set_stats_full, add_batch_arguments
 
 
 class Command(BaseCommand):
     help = 'Set all taskogotchies\' stats to 100'
 
+    def add_arguments(self, parser):
+        add_batch_arguments(parser)
+
     def handle(self, *args, **options):
-        set_stats_full(self.stdout, self.style)
+        updated = set_stats_full(self.stdout, self.style, project_id=options['project_id'],
+                                 chunk_size=options['chunk_size'], sleep=options['sleep'], resume=options['resume'])
 
-        self.stdout.write(self.style.SUCCESS('Successfully set all stats to 100'))
+        self.stdout.write(self.style.SUCCESS('Successfully set stats to 100 for %s taskogotchies' % updated))
@@ -0,0 +1,135 @@
+"""
+In-process metrics in the Prometheus text format, served at /metrics.
+Every worker process has its own values, Prometheus must scrape every worker (or sum them by instance).
+Updating a metric is a dict update under a lock, cheap enough for the fight hot path.
+"""
+import threading
+from bisect import bisect_left
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def format_labels(self, labelvalues: tuple, **extra) -> str:
+        labels = [f'{name}="{escape_label(str(value))}"' for name, value in zip(self.labelnames, labelvalues)]
+        labels += [f'{name}="{value}"' for name, value in extra.items()]
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{self.format_labels(labels)} {value}' for labels, value in values]
+
+
+class Gauge(Metric):
+    """Value that goes up and down. If function is given, the value is read from it on every scrape"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 function: Callable[[], float] | None = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._function = function
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value: float, *labelvalues) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def samples(self) -> list[str]:
+        if self._function is not None:
+            return [f'{self.name} {self._function()}']
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{self.format_labels(labels)} {value}' for labels, value in values]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        self._values: dict[tuple, list[float]] = {}  # labels -> count of every bucket, +Inf bucket, sum
+
+    def observe(self, value: float, *labelvalues) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labelvalues)
+            if values is None:
+                values = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bucket, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.format_labels(labels, le=bucket)} {cumulative}')
+            lines.append(f'{self.name}_sum{self.format_labels(labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{self.format_labels(labels)} {cumulative}')
+        return lines
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY: list[Metric] = []
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+http_request_duration = Histogram('http_request_duration_seconds', 'Duration of HTTP requests',
+                                  ('view', 'method', 'status'))
+http_request_db_queries = Histogram('http_request_db_queries', 'Database queries per HTTP request', ('view',),
+                                    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+websocket_connections = Gauge('websocket_connections', 'Open websocket connections', ('consumer',))
+websocket_events = Counter('websocket_events_total', 'Websocket connects, rejected connects, messages '
+                                                     'and disconnects', ('consumer', 'event'))
+websocket_receive_duration = Histogram('websocket_receive_duration_seconds', 'Duration of handling a received '
+                                                                             'websocket message', ('consumer',))
+fight_group_send_duration = Histogram('fight_group_send_duration_seconds', 'Duration of sending a fight event '
+                                                                           'to a seat of the fight', ('delivery',))
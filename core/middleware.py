@@ -0,0 +1,80 @@
+import logging
+from collections import Counter
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from core.metrics import http_request_duration, http_request_db_queries
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK')
+
+
+class MetricsMiddleware:
+    """Records latency and number of database queries of every request by view name, see core.metrics"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        started = perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        duration = perf_counter() - started
+
+        view = request.resolver_match.view_name if request.resolver_match is not None else 'unresolved'
+        http_request_duration.observe(duration, view, request.method, response.status_code)
+        http_request_db_queries.observe(queries, view)
+        return response
+
+
+class QueryProfilingMiddleware:
+    """
+    Opt-in profiling of database queries, enabled by settings.QUERY_PROFILING (QUERY_PROFILING=1 env variable).
+    Adds X-DB-Query-Count, X-DB-Duplicate-Queries and X-DB-Time (ms) headers to every response and logs them.
+    Duplicate queries are executions of the same SQL with any parameters beyond the first one, usually an N+1.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = Counter()
+        duration = 0.0
+
+        def profile_query(execute, sql, params, many, context):
+            nonlocal duration
+            started = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                duration += perf_counter() - started
+                queries[sql] += 1
+
+        with connection.execute_wrapper(profile_query):
+            response = self.get_response(request)
+
+        count = sum(queries.values())
+        duplicates = sum(executions - 1 for sql, executions in queries.items() if sql not in TRANSACTION_STATEMENTS)
+        response['X-DB-Query-Count'] = count
+        response['X-DB-Duplicate-Queries'] = duplicates
+        response['X-DB-Time'] = f'{duration * 1000:.2f}'
+        log = logger.warning if duplicates else logger.info
+        log('%s %s: %d queries, %d duplicate, %.2f ms', request.method, request.path, count, duplicates,
+            duration * 1000)
+        for sql, executions in queries.items():
+            if executions > 1 and sql not in TRANSACTION_STATEMENTS:
+                logger.warning('Executed %d times: %s', executions, sql)
+        return response
@@ -0,0 +1,35 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+def cancel_duplicate_active_fights(apps, schema_editor):
+    """Keep only the latest active fight of every profile, so the unique constraints can be created"""
+    FightChallenge = apps.get_model('core', 'FightChallenge')
+    busy_profiles = set()
+    duplicates = []
+    for fight in FightChallenge.objects.exclude(status__in=['CO', 'CA']).order_by('-id'):
+        if fight.initiator_id in busy_profiles or fight.opponent_id in busy_profiles:
+            duplicates.append(fight.id)
+        else:
+            busy_profiles.update((fight.initiator_id, fight.opponent_id))
+    FightChallenge.objects.filter(id__in=duplicates).update(status='CA')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_player_email'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_duplicate_active_fights, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='fightchallenge',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['CO', 'CA']), _negated=True), fields=('initiator',), name='one_active_fight_per_initiator'),
+        ),
+        migrations.AddConstraint(
+            model_name='fightchallenge',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['CO', 'CA']), _negated=True), fields=('opponent',), name='one_active_fight_per_opponent'),
+        ),
+    ]
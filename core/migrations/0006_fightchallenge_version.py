@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_maintenancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fightchallenge',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_fightchallenge_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fightchallenge',
+            name='action_log',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_fightchallenge_action_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wins', models.PositiveIntegerField(default=0)),
+                ('losses', models.PositiveIntegerField(default=0)),
+                ('draws', models.PositiveIntegerField(default=0)),
+                ('streak', models.IntegerField(default=0)),
+                ('rating', models.IntegerField(default=1000)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('profile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='core.playerprofile')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='player_stats', to='core.project')),
+            ],
+            options={
+                'verbose_name': 'Player stats',
+                'verbose_name_plural': 'Player stats',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='playerstats',
+            index=models.Index(fields=['project', '-rating', 'id'], name='leaderboard_idx'),
+        ),
+    ]
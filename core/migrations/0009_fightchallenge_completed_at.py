@@ -0,0 +1,34 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:28
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_completed_at(apps, schema_editor):
+    """Finish time of the existing fights is unknown, they are dated by the migration and ordered by id"""
+    FightChallenge = apps.get_model('core', 'FightChallenge')
+    FightChallenge.objects.filter(status__in=['CO', 'CA']).update(completed_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_playerstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fightchallenge',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_completed_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='fightchallenge',
+            index=models.Index(fields=['initiator', 'status', '-completed_at', '-id'], name='fight_history_initiator_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fightchallenge',
+            index=models.Index(fields=['opponent', 'status', '-completed_at', '-id'], name='fight_history_opponent_idx'),
+        ),
+    ]
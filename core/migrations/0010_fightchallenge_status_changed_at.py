@@ -0,0 +1,28 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_fightchallenge_completed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fightchallenge',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='fightchallenge',
+            name='status_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='fightchallenge',
+            index=models.Index(fields=['status', 'status_changed_at'], name='fight_status_changed_idx'),
+        ),
+    ]
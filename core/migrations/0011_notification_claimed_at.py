@@ -0,0 +1,23 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_fightchallenge_status_changed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Sending'), ('S', 'Sent'), ('F', 'Failed')], default='P', max_length=1),
+        ),
+    ]
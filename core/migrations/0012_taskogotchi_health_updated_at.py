@@ -0,0 +1,27 @@
+# Generated by Django 4.1.4 on 2026-10-18 15:07
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def copy_last_updated(apps, schema_editor):
+    """Until now the decay started at last_updated"""
+    Taskogotchi = apps.get_model('core', 'Taskogotchi')
+    Taskogotchi.objects.update(health_updated_at=F('last_updated'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_notification_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskogotchi',
+            name='health_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_last_updated, migrations.RunPython.noop),
+    ]
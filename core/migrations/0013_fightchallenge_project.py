@@ -0,0 +1,39 @@
+# Generated by Django 4.1.4 on 2026-10-18 15:12
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def set_project(apps, schema_editor):
+    FightChallenge = apps.get_model('core', 'FightChallenge')
+    PlayerProfile = apps.get_model('core', 'PlayerProfile')
+    FightChallenge.objects.update(project=Subquery(PlayerProfile.objects.filter(pk=OuterRef('initiator'))
+                                                   .values('project')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_taskogotchi_health_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fightchallenge',
+            name='project',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='fights', to='core.project'),
+        ),
+        migrations.RunPython(set_project, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='fightchallenge',
+            name='project',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='fights', to='core.project'),
+        ),
+        migrations.AddIndex(
+            model_name='fightchallenge',
+            index=models.Index(fields=['project', 'status', '-completed_at', '-id'], name='fight_history_project_idx'),
+        ),
+    ]
@@ -1,5 +1,11 @@
+from datetime import timedelta
+from math import floor
+
+from django.conf import settings
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F, Value, Exists, OuterRef
+from django.db.models.functions import Floor, Greatest
+from django.utils import timezone
 
 
 class Project(models.Model):
@@ -41,7 +47,21 @@ class FightStatus(models.TextChoices):
     CANCELED = 'CA', 'Canceled'
 
 
+FINISHED_FIGHT_STATUSES = [FightStatus.COMPLETED, FightStatus.CANCELED]
+
+
+class FightChallengeQuerySet(models.QuerySet):
+    def active(self):
+        """Fights that are not completed or canceled yet"""
+        return self.exclude(status__in=FINISHED_FIGHT_STATUSES)
+
+    def for_account(self, account_id: str):
+        return self.filter(Q(opponent__player__account_id=account_id) | Q(initiator__player__account_id=account_id))
+
+
 class FightChallenge(models.Model):
+    # copy of initiator.project, so the fight history of a project is served by one index
+    project = models.ForeignKey('Project', on_delete=models.CASCADE, related_name='fights', editable=False)
     initiator = models.ForeignKey('PlayerProfile', on_delete=models.CASCADE, related_name='initiated_fights')
     initiator_health = models.IntegerField(default=100)
     initiator_strength = models.IntegerField(default=100)
@@ -52,10 +72,27 @@ class FightChallenge(models.Model):
     winner = models.ForeignKey('PlayerProfile', on_delete=models.CASCADE, related_name='won_fights', null=True,
                                blank=True)
     draw = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+    # moved on every status change, fights that stay in one status longer than FIGHT_STATUS_TTL are canceled
+    status_changed_at = models.DateTimeField(default=timezone.now)
+    # set when the fight gets COMPLETED or CANCELED status, used to order the fight history
+    completed_at = models.DateTimeField(null=True, blank=True)
+    # actions applied during the fight, written once when it's finished, see game.game_logic.action_log
+    action_log = models.BinaryField(null=True, blank=True)
+    # incremented on every change, used as ETag. Don't forget to increment it in QuerySet.update() calls
+    version = models.PositiveIntegerField(default=1)
+
+    objects = FightChallengeQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
         assert self.initiator != self.opponent, "You can't fight with yourself"
-        assert self.initiator.project == self.opponent.project, "You can't fight with someone from another project"
+        assert self.initiator.project_id == self.opponent.project_id, \
+            "You can't fight with someone from another project"
+        self.project_id = self.initiator.project_id
+        if self.pk is not None:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -71,16 +108,180 @@ class FightChallenge(models.Model):
                                    violation_error_message='Draw and winner must be not set until fight is not'
                                                            ' completed. '
                                                            'When completed, draw and winner must not be equal'),
+            # a profile can have only one active fight, these indexes are also used to look up the active fight
+            models.UniqueConstraint(fields=['initiator'], condition=~Q(status__in=FINISHED_FIGHT_STATUSES),
+                                    name='one_active_fight_per_initiator'),
+            models.UniqueConstraint(fields=['opponent'], condition=~Q(status__in=FINISHED_FIGHT_STATUSES),
+                                    name='one_active_fight_per_opponent'),
+        ]
+        indexes = [
+            # fight history of a profile, see FightHistoryView
+            models.Index(fields=['initiator', 'status', '-completed_at', '-id'], name='fight_history_initiator_idx'),
+            models.Index(fields=['opponent', 'status', '-completed_at', '-id'], name='fight_history_opponent_idx'),
+            models.Index(fields=['project', 'status', '-completed_at', '-id'], name='fight_history_project_idx'),
+            # fights expired in a status, see core.business_services.fight_expiry
+            models.Index(fields=['status', 'status_changed_at'], name='fight_status_changed_idx'),
         ]
 
 
+class EpochSeconds(models.Func):
+    """Seconds since the unix epoch of a datetime expression"""
+    output_field = models.FloatField()
+    template = 'EXTRACT(EPOCH FROM %(expressions)s)'
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template='((julianday(%(expressions)s) - 2440587.5) * 86400.0)',
+                              **extra_context)
+
+
+class TaskogotchiQuerySet(models.QuerySet):
+    def with_decayed_health(self, now=None):
+        """Annotates decayed_health, the same value as Taskogotchi.current_health, so it can be used in filters"""
+        now = now or timezone.now()
+        elapsed_hours = (Value(now.timestamp()) - EpochSeconds('health_updated_at')) / 3600
+        decay = Floor(elapsed_hours * settings.TASKOGOTCHI_HEALTH_DECAY_PER_HOUR)
+        return self.annotate(decayed_health=Greatest(F('health') - decay, Value(0.0)))
+
+    def with_in_fight(self):
+        """Annotates in_fight, whether the player of the taskogotchi has an active fight"""
+        active_fights = FightChallenge.objects.active().filter(Q(opponent=OuterRef('profile'))
+                                                               | Q(initiator=OuterRef('profile')))
+        return self.annotate(in_fight=Exists(active_fights))
+
+
 class Taskogotchi(models.Model):
+    """
+    Health decays over time with TASKOGOTCHI_HEALTH_DECAY_PER_HOUR rate.
+    Stored health is the health at health_updated_at, current health is computed on read
+    and is written back only when the taskogotchi is saved anyway.
+    """
     profile = models.OneToOneField('PlayerProfile', on_delete=models.CASCADE, related_name='taskogotchi')
     image = models.JSONField('Image components stored as JSON', null=True, blank=True)
     last_updated = models.DateTimeField(auto_now=True)
+    # the time the stored health is the health at, the decay runs from it
+    health_updated_at = models.DateTimeField(default=timezone.now)
     health = models.IntegerField(default=100)
     strength = models.IntegerField(default=100)
 
+    objects = TaskogotchiQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_health = instance.__dict__.get('health')
+        return instance
+
+    def get_current_health(self, now=None) -> int:
+        if self.health_updated_at is None:
+            return self.health
+        now = now or timezone.now()
+        elapsed_hours = (now - self.health_updated_at).total_seconds() / 3600
+        decay = floor(elapsed_hours * settings.TASKOGOTCHI_HEALTH_DECAY_PER_HOUR)
+        return max(self.health - max(decay, 0), 0)
+
+    def get_health_changed_at(self, now=None):
+        """Time when the current health got its value"""
+        decayed = self.health - self.get_current_health(now)
+        if decayed <= 0:
+            return self.health_updated_at
+        return self.health_updated_at + timedelta(hours=decayed / settings.TASKOGOTCHI_HEALTH_DECAY_PER_HOUR)
+
+    @property
+    def current_health(self) -> int:
+        return self.get_current_health()
+
+    @current_health.setter
+    def current_health(self, value: int):
+        self.health = value
+        self._health_written = True
+
+    def save(self, *args, **kwargs):
+        # a written health (even if it's equal to the stored value) is the health now, otherwise the decay
+        # applied so far is stored and the decay start moves only by whole decayed points, so the fraction
+        # of a point decayed since then isn't lost
+        now = timezone.now()
+        if not getattr(self, '_health_written', False) and self.health == getattr(self, '_stored_health', None):
+            self.health, self.health_updated_at = self.get_current_health(now), self.get_health_changed_at(now)
+        else:
+            self.health_updated_at = now
+        super().save(*args, **kwargs)
+        self._stored_health = self.health
+        self._health_written = False
+
     class Meta:
         verbose_name = 'Taskogotchi'
         verbose_name_plural = 'Taskogotchies'
+
+
+class NotificationStatus(models.TextChoices):
+    PENDING = 'P', 'Pending'
+    SENDING = 'C', 'Sending'
+    SENT = 'S', 'Sent'
+    FAILED = 'F', 'Failed'
+
+
+# outbox of emails, rows are written in the same transaction as the event
+# and sent in batches by the sendnotifications command
+class Notification(models.Model):
+    recipient = models.EmailField()
+    from_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    html_message = models.TextField(null=True, blank=True)
+    status = models.CharField(max_length=1, choices=NotificationStatus.choices, default=NotificationStatus.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # set when a worker takes the notification to send it
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.subject} to {self.recipient}"
+
+    class Meta:
+        verbose_name = 'Notification'
+        verbose_name_plural = 'Notifications'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='notification_queue_idx'),
+        ]
+
+
+# progress of a batched maintenance command, used to resume an interrupted run
+class MaintenanceCheckpoint(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at id {self.last_id}"
+
+
+INITIAL_RATING = 1000
+
+
+# fight results of a profile, updated in the transaction that completes a fight,
+# see core.business_services.leaderboard
+class PlayerStats(models.Model):
+    profile = models.OneToOneField('PlayerProfile', on_delete=models.CASCADE, related_name='stats')
+    # copy of profile.project, so the leaderboard of a project is served by one index
+    project = models.ForeignKey('Project', on_delete=models.CASCADE, related_name='player_stats')
+    wins = models.PositiveIntegerField(default=0)
+    losses = models.PositiveIntegerField(default=0)
+    draws = models.PositiveIntegerField(default=0)
+    # wins in a row if positive, losses in a row if negative
+    streak = models.IntegerField(default=0)
+    # Elo rating
+    rating = models.IntegerField(default=INITIAL_RATING)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Stats of {self.profile}"
+
+    class Meta:
+        verbose_name = 'Player stats'
+        verbose_name_plural = 'Player stats'
+        indexes = [
+            models.Index(fields=['project', '-rating', 'id'], name='leaderboard_idx'),
+        ]
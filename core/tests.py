@@ -1,3 +1,379 @@
-from django.test import TestCase
+import re
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.core.management import call_command
+from django.core.mail import EmailMessage
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.business_services.player_registration import register_players
+from core.business_services.notification_sender import send_pending_notifications, CLAIM_TIMEOUT, MAX_ATTEMPTS
+from core.business_services.leaderboard import apply_result, record_fight_result, rebuild_leaderboard, WIN, DRAW, \
+    LOSS
+from core.management.commands._logic import decrease_health
+from core.metrics import render_metrics, http_request_duration, http_request_db_queries
+from core.models import Project, Player, PlayerProfile, FightChallenge, FightStatus, PlayerStats, INITIAL_RATING, \
+    Taskogotchi, Notification, NotificationStatus, MaintenanceCheckpoint
+
+
+def create_profiles(project_id: str = 'project', count: int = 3) -> list[PlayerProfile]:
+    project = Project.objects.create(project_id=project_id, name=project_id)
+    return [PlayerProfile.objects.create(player=Player.objects.create(account_id=f'{project_id}{i}', name=f'P{i}'),
+                                         project=project) for i in range(count)]
+
+
+class LeaderboardTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.profiles = create_profiles()
+
+    def complete_fight(self, initiator: int, opponent: int, winner: int | None, completed_at=None) -> FightChallenge:
+        fight = FightChallenge.objects.create(
+            initiator=self.profiles[initiator], opponent=self.profiles[opponent], status=FightStatus.COMPLETED,
+            winner=self.profiles[winner] if winner is not None else None, draw=winner is None,
+            completed_at=completed_at or timezone.now(),
+        )
+        record_fight_result(fight)
+        return fight
+
+    def get_ratings(self) -> dict[int, int]:
+        return dict(PlayerStats.objects.values_list('profile_id', 'rating'))
+
+    def test_apply_result(self):
+        stats, opponent_stats = PlayerStats(rating=INITIAL_RATING), PlayerStats(rating=INITIAL_RATING)
+        apply_result(stats, opponent_stats, WIN)
+        self.assertEqual((stats.rating, opponent_stats.rating), (1016, 984))
+        self.assertEqual((stats.wins, stats.streak, opponent_stats.losses, opponent_stats.streak), (1, 1, 1, -1))
+
+        # the favourite gains less for a win than it loses for a loss
+        apply_result(stats, opponent_stats, WIN)
+        self.assertEqual((stats.rating, stats.streak), (1031, 2))
+        apply_result(stats, opponent_stats, LOSS)
+        self.assertEqual((stats.rating, stats.streak, opponent_stats.streak), (1012, -1, 1))
+
+        apply_result(stats, opponent_stats, DRAW)
+        self.assertEqual((stats.rating, opponent_stats.rating, stats.draws, stats.streak), (1011, 989, 1, 0))
+
+    def test_record_fight_result(self):
+        self.complete_fight(0, 1, winner=1)
+        self.complete_fight(1, 2, winner=None)
+        stats = {player_stats.profile_id: player_stats for player_stats in PlayerStats.objects.all()}
+        first, second, third = (stats[profile.pk] for profile in self.profiles)
+        self.assertEqual((first.losses, first.rating), (1, 984))
+        self.assertEqual((second.wins, second.draws, second.rating), (1, 1, 1015))
+        self.assertEqual((third.draws, third.rating), (1, 1001))
+
+    def test_rebuild_replays_fights_in_completion_order(self):
+        now = timezone.now()
+        # created first, but completed last
+        late = FightChallenge.objects.create(initiator=self.profiles[0], opponent=self.profiles[2],
+                                             status=FightStatus.WAITING_ACCEPT)
+        self.complete_fight(0, 1, winner=0, completed_at=now - timedelta(minutes=2))
+        self.complete_fight(1, 2, winner=1, completed_at=now - timedelta(minutes=1))
+        FightChallenge.objects.filter(pk=late.pk).update(status=FightStatus.COMPLETED, winner=self.profiles[2],
+                                                         completed_at=now)
+        late.refresh_from_db()
+        record_fight_result(late)
+        live_ratings = self.get_ratings()
+
+        self.assertEqual(rebuild_leaderboard('project'), 3)
+        self.assertEqual(self.get_ratings(), live_ratings)
+
+
+@override_settings(TASKOGOTCHI_HEALTH_DECAY_PER_HOUR=5)
+class PlayerRegistrationTestCase(TestCase):
+    def get_profile_ids(self) -> dict[str, dict[str, int]]:
+        result = {}
+        for project_id, account_id, pk in PlayerProfile.objects.values_list('project__project_id',
+                                                                             'player__account_id', 'pk'):
+            result.setdefault(project_id, {})[account_id] = pk
+        return result
+
+    def test_new_players(self):
+        result = register_players([
+            {'account_id': 'a', 'project_id': 'p1', 'player_name': 'A', 'email': 'a@test.com', 'project_name': 'P1'},
+            {'account_id': 'b', 'project_id': 'p1', 'project_name': 'P1'},
+            {'account_id': 'a', 'project_id': 'p2', 'player_name': 'A', 'email': 'a@test.com'},
+        ])
+        self.assertEqual(result, self.get_profile_ids())
+        self.assertEqual(set(result['p1']), {'a', 'b'})
+        self.assertEqual(set(result['p2']), {'a'})
+        self.assertEqual(list(Project.objects.order_by('project_id').values_list('name', flat=True)), ['P1', None])
+        self.assertEqual(dict(Player.objects.values_list('account_id', 'email')), {'a': 'a@test.com', 'b': None})
+        self.assertEqual(register_players([]), {})
+
+    def test_existing_profiles(self):
+        profile = create_profiles('p1', 1)[0]
+        result = register_players([{'account_id': 'p10', 'project_id': 'p1', 'player_name': 'P0'},
+                                   {'account_id': 'new', 'project_id': 'p1'}])
+        self.assertEqual(result, {'p1': {'p10': profile.pk,
+                                         'new': PlayerProfile.objects.get(player__account_id='new').pk}})
+        self.assertEqual(PlayerProfile.objects.count(), 2)
+
+    def test_unchanged_rows_not_written(self):
+        create_profiles('p1', 2)
+        Player.objects.filter(account_id='p10').update(email='p10@test.com')
+        with CaptureQueriesContext(connection) as queries:
+            register_players([
+                {'account_id': 'p10', 'project_id': 'p1', 'player_name': 'P0', 'email': 'p10@test.com',
+                 'project_name': 'p1'},
+                {'account_id': 'p11', 'project_id': 'p1', 'player_name': 'Renamed', 'project_name': 'p1'},
+            ])
+        inserts = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        # only the renamed player is written, the project and the profiles are stored already
+        self.assertEqual(len(inserts), 1)
+        self.assertIn('"core_player"', inserts[0])
+        self.assertNotIn("'p10'", inserts[0])
+        self.assertEqual(dict(Player.objects.values_list('account_id', 'name')), {'p10': 'P0', 'p11': 'Renamed'})
+
+    def test_duplicate_entries(self):
+        result = register_players([
+            {'account_id': 'a', 'project_id': 'p1', 'player_name': 'First', 'project_name': 'First'},
+            {'account_id': 'a', 'project_id': 'p1', 'player_name': 'Last', 'project_name': 'Last'},
+        ])
+        self.assertEqual(result, self.get_profile_ids())
+        self.assertEqual(PlayerProfile.objects.count(), 1)
+        # the last entry wins
+        self.assertEqual(Player.objects.get().name, 'Last')
+        self.assertEqual(Project.objects.get().name, 'Last')
+
+
+class TaskogotchiDecayTestCase(TestCase):
+    def setUp(self):
+        profile = create_profiles(count=1)[0]
+        Taskogotchi.objects.create(profile=profile, health=50)
+        # stored health 50, 4 hours of decay
+        Taskogotchi.objects.update(health_updated_at=timezone.now() - timedelta(hours=4))
+        self.taskogotchi = Taskogotchi.objects.get()
+
+    def test_current_health(self):
+        self.assertEqual(self.taskogotchi.current_health, 30)
+
+    def test_save_applies_decay(self):
+        self.taskogotchi.strength = 90
+        self.taskogotchi.save()
+        self.taskogotchi.refresh_from_db()
+        self.assertEqual((self.taskogotchi.health, self.taskogotchi.current_health), (30, 30))
+
+    def test_written_health_equal_to_stored_is_kept(self):
+        self.taskogotchi.current_health = 50
+        self.taskogotchi.save()
+        self.taskogotchi.refresh_from_db()
+        self.assertEqual(self.taskogotchi.current_health, 50)
+
+        # the next save without writing the health decays from the time it was written
+        self.taskogotchi.save()
+        self.taskogotchi.refresh_from_db()
+        self.assertEqual(self.taskogotchi.current_health, 50)
+
+    def test_frequent_saves_keep_decay(self):
+        # saves more often than one point of decay (12 minutes) still decay the health, 4h + 10 * 11 minutes
+        now = timezone.now()
+        for i in range(1, 11):
+            with mock.patch('django.utils.timezone.now', return_value=now + timedelta(minutes=11 * i)):
+                self.taskogotchi.save()
+        self.taskogotchi.refresh_from_db()
+        self.assertEqual(self.taskogotchi.get_current_health(now + timedelta(minutes=110)), 21)
+
+    def test_put_health_equal_to_stored(self):
+        response = self.client.put('/api/v1/taskogotchi', {'account_id': 'project0', 'project_id': 'project',
+                                                           'health': 50}, content_type='application/json')
+        self.assertEqual(response.json()['health'], 50)
+        self.assertEqual(Taskogotchi.objects.get().current_health, 50)
+
+
+class BatchedUpdateTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # 5 taskogotchies in project, one of them with no health to decrease, 2 in other
+        for profile, health in zip(create_profiles('project', 5) + create_profiles('other', 2),
+                                   (50, 0, 50, 50, 50, 100, 100)):
+            Taskogotchi.objects.create(profile=profile, health=health)
+        cls.ids = list(Taskogotchi.objects.filter(profile__project__project_id='project').order_by('id')
+                       .values_list('id', flat=True))
+
+    def get_health(self) -> dict[str, int]:
+        return dict(Taskogotchi.objects.values_list('profile__player__account_id', 'health'))
+
+    def test_chunks_and_checkpoint(self):
+        checkpoints = []  # the checkpoint after every chunk, read while sleeping between chunks
+        with mock.patch('core.management.commands._logic.time.sleep',
+                        side_effect=lambda _: checkpoints.append(MaintenanceCheckpoint.objects.get().last_id)):
+            updated = decrease_health(StringIO(), None, 10, project_id='project', chunk_size=2)
+        self.assertEqual(updated, 4)
+        # keyset chunks of the rows matching the filters, the taskogotchi with no health isn't a chunk row
+        self.assertEqual(checkpoints, [self.ids[2], self.ids[4]])
+        self.assertFalse(MaintenanceCheckpoint.objects.exists())
+        self.assertEqual(self.get_health(), {'project0': 40, 'project1': 0, 'project2': 40, 'project3': 40,
+                                             'project4': 40, 'other0': 100, 'other1': 100})
+
+    def test_all_projects(self):
+        out = StringIO()
+        call_command('decreasestats', '10', '--chunk-size', '4', '--sleep', '0', stdout=out)
+        self.assertIn('Successfully decreased health by 10 for 6 taskogotchies', out.getvalue())
+        self.assertEqual(self.get_health(), {'project0': 40, 'project1': 0, 'project2': 40, 'project3': 40,
+                                             'project4': 40, 'other0': 90, 'other1': 90})
+
+    def test_resume(self):
+        # the interrupted run updated the rows up to the third one of the project
+        Taskogotchi.objects.filter(id__in=self.ids[:3], health__gt=0).update(health=40)
+        MaintenanceCheckpoint.objects.create(name='decreasestats:project', last_id=self.ids[2])
+        MaintenanceCheckpoint.objects.create(name='decreasestats:*', last_id=self.ids[-1])  # not this run's
+        out = StringIO()
+        call_command('decreasestats', '10', '--project', 'project', '--resume', '--sleep', '0', stdout=out)
+        self.assertIn(f'Resuming from id {self.ids[2]}', out.getvalue())
+        self.assertEqual(self.get_health(), {'project0': 40, 'project1': 0, 'project2': 40, 'project3': 40,
+                                             'project4': 40, 'other0': 100, 'other1': 100})
+        self.assertEqual(list(MaintenanceCheckpoint.objects.values_list('name', flat=True)), ['decreasestats:*'])
+
+        # without --resume the checkpoint isn't used
+        MaintenanceCheckpoint.objects.create(name='setstatsfull:project', last_id=self.ids[2])
+        call_command('setstatsfull', '--project', 'project', '--sleep', '0', stdout=StringIO())
+        self.assertEqual(set(Taskogotchi.objects.filter(profile__project__project_id='project')
+                             .values_list('health', flat=True)), {100})
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class NotificationSenderTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.profiles = create_profiles(count=4)
+        for profile in cls.profiles:
+            profile.player.email = f'{profile.player.account_id}@test.com'
+            profile.player.save()
+            Taskogotchi.objects.create(profile=profile)
+
+    def challenge(self, initiator: int, opponent: int):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/fight', {'account_id': f'project{initiator}', 'project_id': 'project',
+                                                          'opponent_id': f'project{opponent}'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_send(self):
+        self.challenge(0, 1)
+        self.assertEqual(mail.outbox, [])
+        savepoints = len(connection.savepoint_ids)
+        send = EmailMessage.send
+
+        def send_outside_transaction(email, *args, **kwargs):
+            self.assertEqual(len(connection.savepoint_ids), savepoints)
+            return send(email, *args, **kwargs)
+
+        with mock.patch.object(EmailMessage, 'send', send_outside_transaction):
+            self.assertEqual(send_pending_notifications(), (1, 0))
+        self.assertEqual([email.to for email in mail.outbox], [['project1@test.com']])
+        notification = Notification.objects.get()
+        self.assertEqual((notification.status, notification.attempts), (NotificationStatus.SENT, 1))
+        self.assertEqual(send_pending_notifications(), (0, 0))
+
+    def test_crash_in_batch_does_not_resend_sent(self):
+        self.challenge(0, 1)
+        self.challenge(2, 3)
+        send = EmailMessage.send
+
+        def send_then_crash(email, *args, **kwargs):
+            if mail.outbox:
+                raise KeyboardInterrupt
+            return send(email, *args, **kwargs)
+
+        with mock.patch.object(EmailMessage, 'send', send_then_crash), self.assertRaises(KeyboardInterrupt):
+            send_pending_notifications()
+        statuses = dict(Notification.objects.values_list('recipient', 'status'))
+        self.assertEqual(statuses, {'project1@test.com': NotificationStatus.SENT,
+                                    'project3@test.com': NotificationStatus.SENDING})
+
+        # the crashed worker's claim is taken over once it's stale
+        self.assertEqual(send_pending_notifications(), (0, 0))
+        Notification.objects.filter(status=NotificationStatus.SENDING) \
+            .update(claimed_at=timezone.now() - CLAIM_TIMEOUT - timedelta(seconds=1))
+        self.assertEqual(send_pending_notifications(), (1, 0))
+        self.assertEqual([email.to for email in mail.outbox], [['project1@test.com'], ['project3@test.com']])
+
+    def test_retry(self):
+        self.challenge(0, 1)
+        with mock.patch.object(EmailMessage, 'send', side_effect=OSError('connection refused')):
+            self.assertEqual(send_pending_notifications(), (0, 1))
+            notification = Notification.objects.get()
+            self.assertEqual((notification.status, notification.attempts, notification.last_error),
+                             (NotificationStatus.PENDING, 1, 'connection refused'))
+            self.assertGreater(notification.next_attempt_at, timezone.now())
+
+            Notification.objects.update(attempts=MAX_ATTEMPTS - 1, next_attempt_at=timezone.now())
+            self.assertEqual(send_pending_notifications(), (0, 1))
+        self.assertEqual(Notification.objects.get().status, NotificationStatus.FAILED)
+
+
+class MetricsTestCase(TestCase):
+    SAMPLE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+    LABEL = re.compile(r'(?P<name>[a-zA-Z_][a-zA-Z0-9_]*)="(?P<value>(?:[^"\\]|\\.)*)"(?:,|$)')
+
+    def parse(self, text: str) -> dict[str, list[tuple[dict, float]]]:
+        """Samples by metric family, fails on anything that isn't the Prometheus text format"""
+        self.assertTrue(text.endswith('\n'))
+        types, samples = {}, {}
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                continue
+            if line.startswith('# TYPE '):
+                _, _, name, type_ = line.split(' ')
+                self.assertIn(type_, ('counter', 'gauge', 'histogram'))
+                self.assertNotIn(name, types)
+                types[name] = type_
+                continue
+            match = self.SAMPLE.match(line)
+            self.assertIsNotNone(match, line)
+            name = match['name']
+            family = name if name in types else re.sub('_(bucket|sum|count)$', '', name)
+            self.assertIn(family, types, line)  # samples follow the TYPE of their family
+            labels = {}
+            if match['labels']:
+                label_matches = list(self.LABEL.finditer(match['labels']))
+                self.assertEqual(''.join(label.group(0) for label in label_matches), match['labels'], line)
+                labels = {label['name']: label['value'] for label in label_matches}
+            samples.setdefault(name, []).append((labels, float(match['value'])))
+        return samples
+
+    def get_count(self, view: str, status: int) -> float:
+        samples = self.parse(render_metrics()).get('http_request_duration_seconds_count', [])
+        return sum(value for labels, value in samples
+                   if labels == {'view': view, 'method': 'GET', 'status': str(status)})
+
+    def test_middleware_records_requests(self):
+        before = self.get_count('taskogotchi', 400), self.get_count('unresolved', 404)
+        self.assertEqual(self.client.get('/api/v1/taskogotchi').status_code, 400)
+        self.assertEqual(self.client.get('/no-such-page').status_code, 404)
+        self.assertEqual((self.get_count('taskogotchi', 400), self.get_count('unresolved', 404)),
+                         (before[0] + 1, before[1] + 1))
+
+    def test_render(self):
+        http_request_duration.observe(0.003, 'view "quoted"\\', 'GET', 200)
+        http_request_db_queries.observe(1000, 'view')
+        samples = self.parse(render_metrics())
+        labels = {'view': 'view \\"quoted\\"\\\\', 'method': 'GET', 'status': '200'}
+        buckets = [(sample_labels['le'], value) for sample_labels, value
+                   in samples['http_request_duration_seconds_bucket']
+                   if {k: v for k, v in sample_labels.items() if k != 'le'} == labels]
+        self.assertEqual(buckets[:3], [('0.001', 0), ('0.0025', 0), ('0.005', 1)])
+        # buckets are cumulative, the +Inf bucket is the count
+        self.assertEqual(buckets[-1], ('+Inf', 1))
+        self.assertEqual([value for _, value in buckets], sorted(value for _, value in buckets))
+        self.assertIn(({'view': 'view'}, 1000), samples['http_request_db_queries_sum'])
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.parse(response.content.decode())
+
+    @override_settings(METRICS_TOKEN='', MODE='PRODUCTION')
+    def test_no_token_outside_dev(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
@@ -1,3 +1,19 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
 
-# Create your views here.
+from core.metrics import render_metrics
+
+
+def metrics_view(request):
+    """
+    Metrics of this worker process in the Prometheus text format.
+    Requires the "Authorization: Bearer <settings.METRICS_TOKEN>" header, without a token metrics are served only
+    in the DEV mode.
+    """
+    if not settings.METRICS_TOKEN:
+        if settings.MODE != 'DEV':
+            raise Http404
+    elif not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'):
+        return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from redis import asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+_backends: dict[str, object] = {}
+
+
+def load_backend(setting_name: str):
+    """
+    Returns the backend configured in settings.<setting_name> as {"BACKEND": dotted path, "OPTIONS": kwargs},
+    one instance per process.
+    """
+    backend = _backends.get(setting_name)
+    if backend is None:
+        config = getattr(settings, setting_name)
+        backend = _backends[setting_name] = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    """Tests can switch a backend with override_settings(<setting_name>=...)"""
+    _backends.pop(setting, None)
+
+
+class RedisBackend:
+    """Base of the backends shared by all workers through redis, OPTIONS are the connection parameters"""
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0):
+        self._redis = aioredis.Redis(host=host, port=port, db=db)
+
+
+class RedisHeartbeatBackend(RedisBackend):
+    """
+    Base of the redis backends keeping entries of open sockets. An entry expires after ttl seconds unless the worker
+    holding the socket refreshes it, which it does every ttl / 3 seconds, so entries of a killed worker
+    (e.g. on a deploy) don't stay forever. Subclasses keep the entries of this worker in _local and refresh them
+    in _refresh.
+    """
+
+    def __init__(self, ttl: float = 60, **options):
+        super().__init__(**options)
+        self._ttl = ttl
+        self._local: dict = {}
+        self._heartbeat: asyncio.Task | None = None
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.get_running_loop().create_task(self._run_heartbeat())
+
+    async def _refresh(self) -> None:
+        raise NotImplementedError
+
+    async def _run_heartbeat(self) -> None:
+        while self._local:
+            await asyncio.sleep(self._ttl / 3)
+            try:
+                await self._refresh()
+            except Exception:  # e.g. redis is restarting, the next beat refreshes them before they expire
+                logger.exception('%s heartbeat failed', type(self).__name__)
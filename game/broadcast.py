@@ -0,0 +1,74 @@
+import logging
+from time import perf_counter
+
+from channels.consumer import AsyncConsumer
+
+from core.metrics import Gauge, fight_group_send_duration
+
+logger = logging.getLogger(__name__)
+
+FIGHT_SEATS = ('initiator', 'opponent')
+
+
+def seat_group_name(fight_group_name: str, seat: str) -> str:
+    """Channel layer group of one player of the fight"""
+    return f"{fight_group_name}.{seat}"
+
+
+class FightBroadcaster:
+    """
+    Delivers fight events to the consumers of both players. Each player's consumer is in the group of its seat,
+    a seat served by this worker gets the event directly in memory, only the seat served by another worker
+    goes through the channel layer. When both players are on the same worker the channel layer isn't used at all.
+    This relies on one socket per seat: a seat with a consumer on this worker isn't sent through the channel layer,
+    so another socket of the same player on another worker would miss the events. FightConsumer closes the older
+    socket of the seat when a new one connects.
+    """
+
+    def __init__(self):
+        self._local: dict[str, set[AsyncConsumer]] = {}  # seat group -> consumers of this worker
+
+    def count_local_fights(self) -> int:
+        """Fights with at least one player on this worker"""
+        return len({group.rsplit('.', 1)[0] for group in self._local})
+
+    def add(self, group: str, consumer: AsyncConsumer) -> None:
+        self._local.setdefault(group, set()).add(consumer)
+
+    def discard(self, group: str, consumer: AsyncConsumer) -> None:
+        consumers = self._local.get(group)
+        if consumers is None:
+            return
+        consumers.discard(consumer)
+        if not consumers:
+            del self._local[group]
+
+    async def group_send(self, channel_layer, fight_group_name: str, event: dict) -> None:
+        for seat in FIGHT_SEATS:
+            group = seat_group_name(fight_group_name, seat)
+            consumers = self._local.get(group)
+            started = perf_counter()
+            if not consumers:
+                await channel_layer.group_send(group, event)
+                fight_group_send_duration.observe(perf_counter() - started, 'channel_layer')
+                continue
+            for consumer in list(consumers):
+                try:
+                    await consumer.dispatch(event)
+                except Exception:  # one broken socket must not keep the event from the other player
+                    logger.exception('Local dispatch of %s to %s failed', event['type'], group)
+            fight_group_send_duration.observe(perf_counter() - started, 'local')
+
+
+_fight_broadcaster: FightBroadcaster | None = None
+
+
+def get_fight_broadcaster() -> FightBroadcaster:
+    global _fight_broadcaster
+    if _fight_broadcaster is None:
+        _fight_broadcaster = FightBroadcaster()
+    return _fight_broadcaster
+
+
+fights_active = Gauge('fights_active', 'Live fights with at least one player on this worker',
+                      function=lambda: get_fight_broadcaster().count_local_fights())
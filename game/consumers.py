@@ -1,36 +1,113 @@
-import asyncio
 import json
+from functools import partial
+from time import perf_counter, time
 
 from channels.db import database_sync_to_async
 from channels.exceptions import DenyConnection
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.db.models import Q
-
-from core.models import FightChallenge, FightStatus, PlayerProfile
-from game.game_logic.actions_mapping import map_action
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Exists, OuterRef
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from core.business_services.fight_events import publish_fight_status, presence_group_name, player_group_name, \
+    get_fight_status_event
+from core.business_services.leaderboard import record_fight_result
+from core.business_services.matchmaking import PlayerInFight, create_matched_fight
+from core.metrics import websocket_connections, websocket_events, websocket_receive_duration
+from core.models import FightChallenge, FightStatus, PlayerProfile, Taskogotchi, Player
+from game.broadcast import get_fight_broadcaster, seat_group_name
+from game.game_logic.action_log import make_action_log
 from game.game_logic.fight import Fight
 from game.game_logic.fight_creator import create_fight_from_fight_challenge
+from game.fight_scheduler import get_fight_scheduler
+from game.fight_storage import get_fight_storage
+from game.fight_ticker import FightTicker, get_fight_ticker
+from game.matchmaking import get_matchmaking_queue, get_matchmaking_score, matchmaking_group_name
+from game.presence import get_presence_store
+from game.protocol import LegacyFightProtocol, negotiate_protocol
 
 
 async def get_fight_by_account_id(account_id: str) -> FightChallenge:
-    queryset = FightChallenge.objects.filter(Q(opponent__player__account_id=account_id)
-                                             | Q(initiator__player__account_id=account_id), status=FightStatus.PENDING)
-    if not await queryset.aexists():
-        raise FightChallenge.DoesNotExist
-    if await queryset.acount() > 1:
-        raise FightChallenge.MultipleObjectsReturned
-    return await queryset.afirst()
+    """Single query, raises DoesNotExist or MultipleObjectsReturned"""
+    return await FightChallenge.objects.for_account(account_id).filter(status=FightStatus.PENDING) \
+        .select_related('initiator__player', 'opponent__player').aget()
 
 
 @database_sync_to_async
-def finish_fight(fight: FightChallenge, winner_id: str):
-    fight.refresh_from_db()
-    fight.status = FightStatus.COMPLETED
-    if winner_id:
-        fight.winner = PlayerProfile.objects.get(player__account_id=winner_id)
+def finish_fight(fight: FightChallenge, winner_id: str | None, action_log: bytes | None = None) -> bool:
+    """
+    Complete the pending fight with a single UPDATE, the winner is one of the fight's players (None is a draw).
+    Returns False if the fight isn't pending anymore, e.g. it was already completed by a concurrent call.
+    The result is added to the leaderboard in the same transaction.
+    """
+    if winner_id is None:
+        winner_profile_id = None
+    elif winner_id == fight.initiator.player.account_id:
+        winner_profile_id = fight.initiator_id
+    elif winner_id == fight.opponent.player.account_id:
+        winner_profile_id = fight.opponent_id
     else:
-        fight.draw = True
-    fight.save()
+        raise ValueError('Winner is not in fight')
+    with transaction.atomic():
+        completed = FightChallenge.objects.filter(pk=fight.pk, status=FightStatus.PENDING).update(
+            status=FightStatus.COMPLETED,
+            winner_id=winner_profile_id,
+            draw=winner_profile_id is None,
+            action_log=action_log,
+            completed_at=Now(),
+            status_changed_at=Now(),
+            version=F('version') + 1,
+        ) == 1
+        if completed:
+            fight.status = FightStatus.COMPLETED
+            fight.winner_id, fight.draw = winner_profile_id, winner_profile_id is None
+            record_fight_result(fight)
+            publish_fight_status(fight)
+    return completed
+
+
+async def pop_fight_result(fight_group_name: str) -> tuple[Fight | None, bytes | None]:
+    """Remove the fight and its action log from the storage. Only one of the concurrent callers gets the fight."""
+    storage = get_fight_storage()
+    fight_object = await storage.pop(fight_group_name)
+    if fight_object is None:
+        return None, None
+    return fight_object, make_action_log(await storage.pop_action_log(fight_group_name))
+
+
+async def start_fight(channel_layer, fight_group_name: str):
+    fight_object = await get_fight_storage().get(fight_group_name)
+    if fight_object is None:
+        return
+    await get_fight_broadcaster().group_send(channel_layer, fight_group_name, {
+        "type": "fight_started",
+        "fight": fight_object.to_json(),
+    })
+
+
+async def end_timed_out_fight(channel_layer, fight_group_name: str, fight: FightChallenge):
+    fight_object, action_log = await pop_fight_result(fight_group_name)
+    if fight_object is None:  # already finished by consumers
+        return
+    now = time()
+    if not fight_object.check_ended(now):
+        fight_object.end_fight()
+    state = fight_object.get_state(now)  # a fight knocked out before the timeout keeps its winner
+    await finish_fight(fight, None if state.is_draw else state.winner.account_id, action_log)
+    await get_fight_broadcaster().group_send(channel_layer, fight_group_name, {
+        "type": "game_over",
+        "fight": fight_object.to_json(now),
+    })
+
+
+def schedule_fight_events(channel_layer, fight_group_name: str, fight: FightChallenge, fight_object: Fight):
+    scheduler = get_fight_scheduler()
+    scheduler.call_at(fight_object.fight_timer.countdown_end_time,
+                      partial(start_fight, channel_layer, fight_group_name))
+    scheduler.call_at(fight_object.fight_timer.end_time,
+                      partial(end_timed_out_fight, channel_layer, fight_group_name, fight))
 
 
 def ensure_json_contains(data: dict, *args) -> bool:
@@ -40,56 +117,62 @@ def ensure_json_contains(data: dict, *args) -> bool:
     return True
 
 
-fight_storage: dict[str, Fight] = {}
+# the socket was replaced by a newer socket of the same player
+SEAT_TAKEN_CLOSE_CODE = 4001
 
 
 # TODO: Refactor this class
 class FightConsumer(AsyncWebsocketConsumer):
     account_id: str
     fight: FightChallenge
-    fight_group_name: str
-    _fight_object: Fight | None = None
-
-    @property
-    def fight_object(self) -> Fight | None:
-        if not self._fight_object:
-            self._fight_object = fight_storage.get(self.fight_group_name)
-        return self._fight_object
-
-    @fight_object.setter
-    def fight_object(self, fight: Fight):
-        fight_storage.setdefault(self.fight_group_name, fight)
-        self._fight_object = fight_storage[self.fight_group_name]
+    fight_group_name: str | None = None
+    seat_group_name: str
+    protocol: LegacyFightProtocol
 
-    def remove_fight_object_from_storage(self):
-        fight_storage.pop(self.fight_group_name, None)
+    async def get_fight_object(self) -> Fight | None:
+        return await get_fight_storage().get(self.fight_group_name)
 
     async def connect(self):
         self.account_id = self.scope["url_route"]["kwargs"]["account_id"]
         try:
             self.fight = await get_fight_by_account_id(self.account_id)
         except (FightChallenge.DoesNotExist, FightChallenge.MultipleObjectsReturned):
+            websocket_events.inc('fight', 'rejected')
             raise DenyConnection
 
-        # self.fight_object = create_fight_from_fight_challenge(self.fight)
-
         self.fight_group_name = f"fight_{self.fight.pk}"
-
-        await self.channel_layer.group_add(self.fight_group_name, self.channel_name)
-        await self.accept()
+        seat = 'initiator' if self.fight.initiator.player.account_id == self.account_id else 'opponent'
+        self.seat_group_name = seat_group_name(self.fight_group_name, seat)
+        self.protocol = negotiate_protocol(self.scope.get("subprotocols", []))
+
+        # one socket per seat (see FightBroadcaster), the older socket of the seat is closed on any worker
+        await self.channel_layer.group_send(self.seat_group_name, {"type": "seat_taken"})
+        await self.channel_layer.group_add(self.seat_group_name, self.channel_name)
+        get_fight_broadcaster().add(self.seat_group_name, self)
+        await self.accept(subprotocol=self.protocol.subprotocol)
+        websocket_events.inc('fight', 'connect')
+        websocket_connections.inc('fight')
 
     async def disconnect(self, close_code):
-        fight_object = self.fight_object
+        if self.fight_group_name is None:
+            return
+        websocket_events.inc('fight', 'disconnect')
+        websocket_connections.dec('fight')
+        fight_object = await self.get_fight_object()
         if fight_object is not None and fight_object.is_ended:
-            self.remove_fight_object_from_storage()
-            if not fight_object.is_draw:
-                await finish_fight(self.fight, fight_object.winner.account_id)
-            else:
-                await finish_fight(self.fight, None)
-        await self.channel_layer.group_discard(self.fight_group_name, self.channel_name)
-
-    async def map_action_to_type(self, action_name: str) -> str:
-        fight_object = self.fight_object
+            # both consumers get here when the fight is over, only the one that removed the fight saves the result
+            fight_object, action_log = await pop_fight_result(self.fight_group_name)
+            if fight_object is not None:
+                state = fight_object.get_state()
+                await finish_fight(self.fight, None if state.is_draw else state.winner.account_id, action_log)
+        get_fight_broadcaster().discard(self.seat_group_name, self)
+        await self.channel_layer.group_discard(self.seat_group_name, self.channel_name)
+
+    async def seat_taken(self, event):
+        get_fight_broadcaster().discard(self.seat_group_name, self)
+        await self.close(code=SEAT_TAKEN_CLOSE_CODE)
+
+    async def map_action_to_type(self, action_name: str, fight_object: Fight | None) -> str:
         if fight_object is not None and fight_object.is_ended:
             return "game_over"
 
@@ -100,37 +183,63 @@ class FightConsumer(AsyncWebsocketConsumer):
                 return "send_to_opponent"
             case "start_game":
                 if fight_object is None:
-                    self.fight_object = await create_fight_from_fight_challenge(self.fight)
-                    return "start_game"
+                    new_fight_object = await create_fight_from_fight_challenge(self.fight)
+                    _, created = await get_fight_storage().add(self.fight_group_name, new_fight_object)
+                    if created:
+                        schedule_fight_events(self.channel_layer, self.fight_group_name, self.fight, new_fight_object)
+                        return "start_game"
                 return "send_to_opponent"
             case _: return "send_to_opponent"
 
     async def receive(self, text_data=None, bytes_data=None):
-        fight_object = self.fight_object
+        websocket_events.inc('fight', 'message')
+        started = perf_counter()
+        try:
+            await self.handle_message(text_data, bytes_data)
+        finally:
+            websocket_receive_duration.observe(perf_counter() - started, 'fight')
+
+    async def handle_message(self, text_data: str | None, bytes_data: bytes | None):
+        fight_object = await self.get_fight_object()
         if fight_object is not None and fight_object.fight_timer.is_countdown:
             return
 
-        try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
+        data = self.protocol.decode(text_data, bytes_data)
+        if data is None:
             return
 
         is_json_valid = ensure_json_contains(data, 'account_id', 'action')
         if not is_json_valid:
             return
+        if text_data is None:
+            try:
+                text_data = json.dumps(data)  # opponent can still use protocol v1
+            except (TypeError, ValueError):  # e.g. msgpack bin values, they can't be forwarded to JSON clients
+                return
 
         account_id = data['account_id']
         action_name = data['action']
-        action = map_action(self.account_id, action_name, fight=fight_object)
-        action.do_action()
+        if fight_object is not None and action_name in FightTicker.QUEUED_ACTIONS:
+            # hits are applied and broadcast by the fight's tick
+            get_fight_ticker().submit(self.channel_layer, self.fight_group_name, self.account_id, action_name,
+                                      text_data)
+            return
+        if fight_object is not None:
+            fight_object = await get_fight_storage().apply_action(self.fight_group_name, self.account_id, action_name)
+
+        event_type = await self.map_action_to_type(action_name, fight_object)
+        if fight_object is None:
+            fight_object = await self.get_fight_object()  # the fight could be just created by start_game
 
-        await self.channel_layer.group_send(
+        await get_fight_broadcaster().group_send(
+            self.channel_layer,
             self.fight_group_name,
             {
-                "type": await self.map_action_to_type(action_name),
+                "type": event_type,
                 "account_id": account_id,
                 "action": action_name,
                 "text_data": text_data,
+                "fight": fight_object.to_json() if fight_object is not None else None,
             }
         )
 
@@ -138,51 +247,265 @@ class FightConsumer(AsyncWebsocketConsumer):
         account_id = event['account_id']
         if account_id == self.account_id:
             return
-        await self.send(text_data=event['text_data'])
+        await self.send(**self.protocol.encode_waiting(account_id, event['action'], event['text_data']))
 
     async def start_game(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "server_info",
-            "message": "game_started",
-            "fight": self.fight_object.to_json(),
-        }))
-        await self.countdown()
-
-    async def countdown(self):
-        fight_object = self.fight_object
-        if not fight_object.fight_timer.is_countdown:
-            return
-        while fight_object.fight_timer.is_countdown:
-            await asyncio.sleep(0.1)
-        await self.send(text_data=json.dumps({
-            "type": "server_info",
-            "message": "fight_started",
-            "fight": fight_object.to_json()
-        }))
+        await self.send(**self.protocol.encode_server_info("game_started", event['fight']))
+
+    async def fight_started(self, event):
+        await self.send(**self.protocol.encode_server_info("fight_started", event['fight']))
 
     async def send_to_opponent(self, event):
         account_id = event['account_id']
         if account_id == self.account_id:
             return
-        if self.fight_object:
-            send_data = json.dumps({
-                "fight": self.fight_object.to_json(),
-                "data": event['text_data']
-            })
-        else:
-            send_data = json.dumps({
-                "fight": None,
-                "data": event['text_data']
-            })
-        await self.send(text_data=send_data)
+        await self.send(**self.protocol.encode_opponent_action(event['fight'], account_id, event['action'],
+                                                               event['text_data']))
+
+    async def fight_tick(self, event):
+        actions = [action for action in event['actions'] if action['account_id'] != self.account_id]
+        if not actions:
+            return
+        await self.send(**self.protocol.encode_tick(event['fight'], actions[0]['account_id'], actions))
 
     async def game_over(self, event):
-        fight_object = self.fight_object
-        if not fight_object.is_ended:
+        # the fight may be already removed from storage by the opponent's consumer, so the event carries it
+        if event['fight'] is None or not event['fight']['ended']:
             return
-        await self.send(text_data=json.dumps({
-            "type": "server_info",
-            "message": "game_over",
-            "fight": fight_object.to_json()
-        }))
+        await self.send(**self.protocol.encode_server_info("game_over", event['fight']))
+        await self.close()
+
+
+@database_sync_to_async
+def get_matchmaking_score_by_account_id(project_id: str, account_id: str) -> float:
+    """
+    Single query. Raises PlayerProfile.DoesNotExist, Taskogotchi.DoesNotExist if the player has no taskogotchi
+    or PlayerInFight if the player already has an active fight.
+    """
+    active_fights = FightChallenge.objects.active().filter(Q(initiator=OuterRef('pk')) | Q(opponent=OuterRef('pk')))
+    profile = PlayerProfile.objects.select_related('taskogotchi').annotate(in_fight=Exists(active_fights)).get(
+        player__account_id=account_id, project__project_id=project_id
+    )
+    if profile.in_fight:
+        raise PlayerInFight(account_id)
+    return get_matchmaking_score(profile.taskogotchi.current_health, profile.taskogotchi.strength)
+
+
+def matched_fight_to_json(fight: FightChallenge) -> dict:
+    return {
+        "id": fight.pk,
+        "status": fight.status,
+        "initiator": {
+            "account_id": fight.initiator.player.account_id,
+            "name": fight.initiator.player.name,
+            "health": fight.initiator_health,
+            "strength": fight.initiator_strength,
+        },
+        "opponent": {
+            "account_id": fight.opponent.player.account_id,
+            "name": fight.opponent.player.name,
+            "health": fight.opponent_health,
+            "strength": fight.opponent_strength,
+        },
+    }
+
+
+class MatchmakingConsumer(AsyncWebsocketConsumer):
+    """
+    Connecting puts the player to the matchmaking queue of the project, closing the socket takes it out.
+    When a player with close health and strength is waiting, an accepted fight is created and both players get
+    match_found with the fight, then their sockets are closed and they start the fight as usual.
+    """
+    project_id: str
+    account_id: str
+    group_name: str | None = None
+
+    async def connect(self):
+        self.project_id = self.scope["url_route"]["kwargs"]["project_id"]
+        self.account_id = self.scope["url_route"]["kwargs"]["account_id"]
+        try:
+            score = await get_matchmaking_score_by_account_id(self.project_id, self.account_id)
+        except (PlayerProfile.DoesNotExist, Taskogotchi.DoesNotExist, PlayerInFight):
+            websocket_events.inc('matchmaking', 'rejected')
+            raise DenyConnection
+
+        self.group_name = matchmaking_group_name(self.project_id, self.account_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        websocket_events.inc('matchmaking', 'connect')
+        websocket_connections.inc('matchmaking')
+        await self.find_opponent(score)
+
+    async def disconnect(self, close_code):
+        if self.group_name is None:
+            return
+        websocket_events.inc('matchmaking', 'disconnect')
+        websocket_connections.dec('matchmaking')
+        await get_matchmaking_queue().remove(self.project_id, self.account_id)
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def find_opponent(self, score: float):
+        queue = get_matchmaking_queue()
+        while (opponent_id := await queue.match(self.project_id, self.account_id, score,
+                                                settings.MATCHMAKING_MAX_DISTANCE)) is not None:
+            try:
+                fight = await database_sync_to_async(create_matched_fight)(self.project_id, self.account_id,
+                                                                           opponent_id)
+            except PlayerInFight as e:
+                await self.channel_layer.group_send(matchmaking_group_name(self.project_id, e.account_id),
+                                                    {"type": "in_fight"})
+                if e.account_id == self.account_id:
+                    return
+                continue  # the opponent got a fight while waiting and is out of the queue now, try the next one
+            event = {"type": "match_found", "fight": matched_fight_to_json(fight)}
+            for account_id in (self.account_id, opponent_id):
+                await self.channel_layer.group_send(matchmaking_group_name(self.project_id, account_id), event)
+            return
+        await self.send(json.dumps({"type": "queued", "score": score}))
+
+    async def match_found(self, event):
+        await self.send(json.dumps({"type": "match_found", "fight": event['fight']}))
+        await self.close()
+
+    async def in_fight(self, event):
+        await self.send(json.dumps({"type": "in_fight"}))
         await self.close()
+
+
+@database_sync_to_async
+def get_project_pk_by_account_id(project_id: str, account_id: str) -> int:
+    """Single query, raises PlayerProfile.DoesNotExist"""
+    return PlayerProfile.objects.values_list('project_id', flat=True) \
+        .get(player__account_id=account_id, project__project_id=project_id)
+
+
+@database_sync_to_async
+def get_presence_players(project_pk: int) -> list[dict]:
+    """Single query. Players of the project that have a taskogotchi, in the same order as the opponents list"""
+    now = timezone.now()
+    return [{
+        "account_id": taskogotchi.profile.player.account_id,
+        "name": taskogotchi.profile.player.name,
+        "health": taskogotchi.get_current_health(now),
+        "strength": taskogotchi.strength,
+        "in_fight": taskogotchi.in_fight,
+    } for taskogotchi in Taskogotchi.objects.filter(profile__project_id=project_pk).with_in_fight()
+        .select_related('profile__player').order_by('pk')]
+
+
+class PresenceConsumer(AsyncWebsocketConsumer):
+    """
+    Availability of opponents in the project, a push replacement of polling the opponents list.
+    On connect the player gets a snapshot of the opponents with their online and in_fight flags, then only changes:
+    join and leave when players open their first and close their last presence socket,
+    and in_fight when a fight of the project is created or finished (see core.business_services.fight_events).
+    """
+    project_pk: int | None = None
+    account_id: str
+    group_name: str
+
+    async def connect(self):
+        project_id = self.scope["url_route"]["kwargs"]["project_id"]
+        self.account_id = self.scope["url_route"]["kwargs"]["account_id"]
+        try:
+            self.project_pk = await get_project_pk_by_account_id(project_id, self.account_id)
+        except PlayerProfile.DoesNotExist:
+            websocket_events.inc('presence', 'rejected')
+            raise DenyConnection
+
+        # join the group before taking the snapshot, so no change after the snapshot is missed
+        self.group_name = presence_group_name(self.project_pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        websocket_events.inc('presence', 'connect')
+        websocket_connections.inc('presence')
+
+        store = get_presence_store()
+        players = await get_presence_players(self.project_pk)
+        online = await store.get_online(self.project_pk)
+        me = None
+        opponents = []
+        for player in players:
+            if player['account_id'] == self.account_id:
+                me = player
+                continue
+            player['online'] = player['account_id'] in online
+            opponents.append(player)
+        await self.send(json.dumps({"type": "snapshot", "opponents": opponents}))
+
+        if await store.join(self.project_pk, self.account_id, self.channel_name) and me is not None:
+            await self.channel_layer.group_send(self.group_name, {
+                "type": "presence_join",
+                "player": {**me, "online": True},
+            })
+
+    async def disconnect(self, close_code):
+        if self.project_pk is None:
+            return
+        websocket_events.inc('presence', 'disconnect')
+        websocket_connections.dec('presence')
+        if await get_presence_store().leave(self.project_pk, self.account_id, self.channel_name):
+            await self.channel_layer.group_send(self.group_name, {
+                "type": "presence_leave",
+                "account_id": self.account_id,
+            })
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def presence_join(self, event):
+        if event['player']['account_id'] == self.account_id:
+            return
+        await self.send(json.dumps({"type": "join", "player": event['player']}))
+
+    async def presence_leave(self, event):
+        if event['account_id'] == self.account_id:
+            return
+        await self.send(json.dumps({"type": "leave", "account_id": event['account_id']}))
+
+    async def fight_status(self, event):
+        account_ids = [account_id for account_id in event['account_ids'] if account_id != self.account_id]
+        await self.send(json.dumps({"type": "in_fight", "account_ids": account_ids, "in_fight": event['in_fight']}))
+
+
+@database_sync_to_async
+def get_active_fight_status_event(account_id: str) -> dict | None:
+    """Two queries. Raises Player.DoesNotExist"""
+    if not Player.objects.filter(account_id=account_id).exists():
+        raise Player.DoesNotExist
+    fight = FightChallenge.objects.for_account(account_id).active() \
+        .select_related('initiator__player', 'opponent__player').first()
+    return get_fight_status_event(fight) if fight is not None else None
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    Lifecycle of the player's fights. Every status change of a fight is pushed to both players once it's committed,
+    so the other player learns that the challenge was created, accepted, started or finished without polling GET /fight.
+    On connect the player gets the status of its active fight, if any, so no change is missed between a GET and connect.
+    """
+    group_name: str | None = None
+
+    async def connect(self):
+        account_id = self.scope["url_route"]["kwargs"]["account_id"]
+        try:
+            event = await get_active_fight_status_event(account_id)
+        except Player.DoesNotExist:
+            websocket_events.inc('notifications', 'rejected')
+            raise DenyConnection
+
+        self.group_name = player_group_name(account_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        websocket_events.inc('notifications', 'connect')
+        websocket_connections.inc('notifications')
+        if event is not None:
+            await self.fight_status(event)
+
+    async def disconnect(self, close_code):
+        if self.group_name is None:
+            return
+        websocket_events.inc('notifications', 'disconnect')
+        websocket_connections.dec('notifications')
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def fight_status(self, event):
+        await self.send(json.dumps({key: value for key, value in event.items() if key != 'in_fight'}))
@@ -0,0 +1,60 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from time import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class FightScheduler:
+    """
+    Timer heap of a worker. Runs a single asyncio task that sleeps until the nearest deadline,
+    so the number of wakeups doesn't depend on the number of connected sockets.
+    Deadlines are unix timestamps, the same clock FightTimer uses.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, Callable[[], Awaitable[None]]]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def call_at(self, when: float, callback: Callable[[], Awaitable[None]]) -> None:
+        """Run the coroutine function at the given time."""
+        heapq.heappush(self._heap, (when, next(self._counter), callback))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        elif self._heap[0][0] == when:
+            self._wakeup.set()  # the new deadline is the nearest one
+
+    async def _run(self) -> None:
+        while self._heap:
+            when = self._heap[0][0]
+            delay = when - time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, callback = heapq.heappop(self._heap)
+            task = asyncio.get_running_loop().create_task(callback())
+            task.add_done_callback(self._log_exception)
+
+    @staticmethod
+    def _log_exception(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Scheduled fight callback failed', exc_info=task.exception())
+
+
+_fight_scheduler: FightScheduler | None = None
+
+
+def get_fight_scheduler() -> FightScheduler:
+    global _fight_scheduler
+    if _fight_scheduler is None:
+        _fight_scheduler = FightScheduler()
+    return _fight_scheduler
@@ -0,0 +1,175 @@
+import json
+from abc import ABC, abstractmethod
+from time import time
+
+from redis.exceptions import ResponseError
+
+from game.backends import load_backend, RedisBackend
+from game.game_logic.action_log import ACTION_CODES, pack_record
+from game.game_logic.actions_mapping import map_action
+from game.game_logic.fight import Fight, STRENGTH_COEFFICIENT
+
+
+class BaseFightStorage(ABC):
+    """
+    Storage of live fights, keyed by the fight group name.
+    Every worker that serves a player of the fight must see the same state, so consumers never keep
+    their own copy of a Fight and always go through the storage.
+    Applied hits are also recorded as action log records (see game.game_logic.action_log).
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Fight | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add(self, key: str, fight: Fight) -> tuple[Fight, bool]:
+        """Store the fight unless one is already stored. Returns the stored fight and whether it was created."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def apply_action(self, key: str, account_id: str, action_name: str) -> Fight | None:
+        """Atomically apply the player's action to the stored fight. Returns the fight after the action."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def pop_action_log(self, key: str) -> bytes:
+        """Remove and return the action log records of the fight"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def pop(self, key: str) -> Fight | None:
+        """Remove the fight. Only one of the concurrent callers gets the fight, others get None."""
+        raise NotImplementedError
+
+
+class InMemoryFightStorage(BaseFightStorage):
+    """Process-local storage. Works only when both players of a fight are served by the same worker."""
+
+    def __init__(self):
+        self._fights: dict[str, Fight] = {}
+        self._action_logs: dict[str, bytearray] = {}
+
+    async def get(self, key: str) -> Fight | None:
+        return self._fights.get(key)
+
+    async def add(self, key: str, fight: Fight) -> tuple[Fight, bool]:
+        stored = self._fights.setdefault(key, fight)
+        if stored is fight:
+            self._action_logs[key] = bytearray()
+        return stored, stored is fight
+
+    async def apply_action(self, key: str, account_id: str, action_name: str) -> Fight | None:
+        fight = self._fights.get(key)
+        if fight is None or fight.is_ended:
+            return fight
+        map_action(account_id, action_name, fight=fight).do_action()
+        if action_name in ACTION_CODES:
+            self._action_logs[key] += pack_record(
+                int((time() - fight.fight_timer.start_time) * 1000), 1 if account_id == fight.player1.account_id else 2,
+                action_name, fight.player1.health, fight.player2.health
+            )
+        return fight
+
+    async def pop_action_log(self, key: str) -> bytes:
+        return bytes(self._action_logs.pop(key, b''))
+
+    async def pop(self, key: str) -> Fight | None:
+        return self._fights.pop(key, None)
+
+
+class RedisFightStorage(BaseFightStorage, RedisBackend):
+    """
+    Storage shared by all workers. Fights are kept as Fight.to_json() documents,
+    hits are applied by a Lua script, so concurrent hits from both sockets never overwrite each other.
+    Action log records of a fight are pushed by the same script to a list next to the fight.
+    """
+    KEY_PREFIX = 'fight_storage:'
+
+    # KEYS[1] - fight key, KEYS[2] - action log key,
+    # ARGV[1] - attacker account_id, ARGV[2] - current time, ARGV[3] - strength coefficient, ARGV[4] - action code,
+    # ARGV[5] - action log ttl. The record format must match game.game_logic.action_log.RECORD
+    ATTACK_SCRIPT = """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then
+        return nil
+    end
+    local fight = cjson.decode(raw)
+    local player1, player2 = fight['player1'], fight['player2']
+    local attacker, receiver, actor
+    if player1['account_id'] == ARGV[1] then
+        attacker, receiver, actor = player1, player2, 1
+    elseif player2['account_id'] == ARGV[1] then
+        attacker, receiver, actor = player2, player1, 2
+    else
+        return redis.error_reply('Account id is not in fight')
+    end
+    local timer = fight['fight_timer']
+    local end_time = timer['start_time'] + timer['countdown_duration'] + timer['duration']
+    if fight['ended'] == true or player1['health'] <= 0 or player2['health'] <= 0
+            or tonumber(ARGV[2]) >= end_time then
+        return raw
+    end
+    receiver['health'] = math.max(receiver['health'] - attacker['strength'] * tonumber(ARGV[3]), 0)
+    raw = cjson.encode(fight)
+    redis.call('SET', KEYS[1], raw, 'KEEPTTL')
+    local offset = math.floor((tonumber(ARGV[2]) - timer['start_time']) * 1000)
+    redis.call('RPUSH', KEYS[2], struct.pack('<I4BBff', offset, actor, tonumber(ARGV[4]),
+                                             player1['health'], player2['health']))
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    return raw
+    """
+
+    def __init__(self, ttl: int = 3600, **options):
+        super().__init__(**options)
+        self._ttl = ttl
+        self._attack = self._redis.register_script(self.ATTACK_SCRIPT)
+
+    def _key(self, key: str) -> str:
+        return self.KEY_PREFIX + key
+
+    def _action_log_key(self, key: str) -> str:
+        return self.KEY_PREFIX + key + ':log'
+
+    @staticmethod
+    def _load(raw: bytes | None) -> Fight | None:
+        if raw is None:
+            return None
+        return Fight.from_json(json.loads(raw))
+
+    async def get(self, key: str) -> Fight | None:
+        return self._load(await self._redis.get(self._key(key)))
+
+    async def add(self, key: str, fight: Fight) -> tuple[Fight, bool]:
+        created = await self._redis.set(self._key(key), json.dumps(fight.to_json()), ex=self._ttl, nx=True)
+        if created:
+            await self._redis.delete(self._action_log_key(key))
+            return fight, True
+        stored = await self.get(key)
+        if stored is None:  # expired between SET and GET
+            return await self.add(key, fight)
+        return stored, False
+
+    async def apply_action(self, key: str, account_id: str, action_name: str) -> Fight | None:
+        if action_name not in ACTION_CODES:
+            return await self.get(key)
+        try:
+            raw = await self._attack(keys=[self._key(key), self._action_log_key(key)],
+                                     args=[account_id, time(), STRENGTH_COEFFICIENT, ACTION_CODES[action_name],
+                                           self._ttl])
+        except ResponseError as e:
+            raise ValueError(str(e))
+        return self._load(raw)
+
+    async def pop(self, key: str) -> Fight | None:
+        return self._load(await self._redis.getdel(self._key(key)))
+
+    async def pop_action_log(self, key: str) -> bytes:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            records, _ = await pipe.lrange(self._action_log_key(key), 0, -1).delete(self._action_log_key(key)).execute()
+        return b''.join(records)
+
+
+def get_fight_storage() -> BaseFightStorage:
+    """Returns the storage configured in settings.FIGHT_STORAGE, one instance per process."""
+    return load_backend('FIGHT_STORAGE')
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+from game.broadcast import get_fight_broadcaster
+from game.fight_storage import get_fight_storage
+from game.game_logic.constants import ACTION_KICK, ACTION_PUNCH
+
+logger = logging.getLogger(__name__)
+
+
+class FightInputs:
+    """Inputs of a fight received since the previous tick"""
+    __slots__ = ('actions', 'counts')
+
+    def __init__(self):
+        self.actions: list[tuple[str, str, str]] = []  # (account_id, action, text_data) in order of arrival
+        self.counts: dict[str, int] = {}
+
+    def add(self, account_id: str, action: str, text_data: str, max_inputs: int) -> bool:
+        count = self.counts.get(account_id, 0)
+        if count >= max_inputs:
+            return False
+        self.counts[account_id] = count + 1
+        self.actions.append((account_id, action, text_data))
+        return True
+
+
+class FightTicker:
+    """
+    Fixed-rate tick loops of the live fights of a worker. Hits are queued instead of being broadcast one by one,
+    every tick applies the queued hits in order of arrival and sends one group event with all of them
+    and the resulting fight, so channel layer traffic of a fight is bounded by the tick rate, not by click speed.
+
+    The loop of a fight runs only while it has inputs: the first hit is applied on the next loop iteration,
+    later hits wait for the next tick. When both players are served by different workers,
+    every worker ticks the inputs of its own player.
+    """
+    QUEUED_ACTIONS = (ACTION_PUNCH, ACTION_KICK)
+
+    def __init__(self, rate: int, max_inputs_per_tick: int):
+        self._interval = 1 / rate
+        self._max_inputs = max_inputs_per_tick
+        self._inputs: dict[str, FightInputs] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def submit(self, channel_layer, fight_group_name: str, account_id: str, action: str, text_data: str) -> bool:
+        """Queue the player's action for the next tick. Returns False if the player is over the input cap."""
+        inputs = self._inputs.get(fight_group_name)
+        if inputs is None:
+            inputs = self._inputs[fight_group_name] = FightInputs()
+        accepted = inputs.add(account_id, action, text_data, self._max_inputs)
+        if fight_group_name not in self._tasks:
+            task = asyncio.get_running_loop().create_task(self._run(channel_layer, fight_group_name))
+            task.add_done_callback(self._log_exception)
+            self._tasks[fight_group_name] = task
+        return accepted
+
+    async def _run(self, channel_layer, fight_group_name: str) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while inputs := self._inputs.pop(fight_group_name, None):
+                started = loop.time()
+                await self._tick(channel_layer, fight_group_name, inputs)
+                await asyncio.sleep(max(self._interval - (loop.time() - started), 0))
+        finally:
+            self._tasks.pop(fight_group_name, None)
+
+    async def _tick(self, channel_layer, fight_group_name: str, inputs: FightInputs) -> None:
+        storage = get_fight_storage()
+        fight_object = None
+        for account_id, action, _ in inputs.actions:
+            fight_object = await storage.apply_action(fight_group_name, account_id, action)
+            if fight_object is None:  # the fight is already finished and removed
+                return
+        fight = fight_object.to_json()
+        await get_fight_broadcaster().group_send(channel_layer, fight_group_name, {
+            "type": "game_over" if fight['ended'] else "fight_tick",
+            "actions": [{"account_id": account_id, "action": action, "text_data": text_data}
+                        for account_id, action, text_data in inputs.actions],
+            "fight": fight,
+        })
+
+    @staticmethod
+    def _log_exception(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Fight tick failed', exc_info=task.exception())
+
+
+_fight_ticker: FightTicker | None = None
+
+
+def get_fight_ticker() -> FightTicker:
+    global _fight_ticker
+    if _fight_ticker is None:
+        _fight_ticker = FightTicker(settings.FIGHT_TICK_RATE, settings.FIGHT_MAX_INPUTS_PER_TICK)
+    return _fight_ticker
@@ -0,0 +1,39 @@
+import struct
+from typing import Iterator, NamedTuple
+
+from game.game_logic.constants import ACTION_KICK, ACTION_PUNCH
+
+# Binary log of the actions applied during a fight: a version byte, then fixed size little-endian records
+# of the offset from the fight start in ms, actor (1 - player1/initiator, 2 - player2/opponent), action code
+# and health of both players after the action. RedisFightStorage packs the same records in Lua.
+ACTION_LOG_VERSION = 1
+HEADER = struct.Struct('<B')
+RECORD = struct.Struct('<IBBff')
+
+ACTION_CODES = {ACTION_PUNCH: 1, ACTION_KICK: 2}
+ACTION_NAMES = {code: name for name, code in ACTION_CODES.items()}
+
+
+class ActionLogRecord(NamedTuple):
+    offset_ms: int
+    actor: int
+    action: str
+    player1_health: float
+    player2_health: float
+
+
+def pack_record(offset_ms: int, actor: int, action: str, player1_health: float, player2_health: float) -> bytes:
+    return RECORD.pack(offset_ms, actor, ACTION_CODES[action], player1_health, player2_health)
+
+
+def make_action_log(records: bytes) -> bytes:
+    return HEADER.pack(ACTION_LOG_VERSION) + records
+
+
+def iter_action_log(action_log: bytes) -> Iterator[ActionLogRecord]:
+    """Raises ValueError if the log is written by an unknown version"""
+    version, = HEADER.unpack_from(action_log)
+    if version != ACTION_LOG_VERSION:
+        raise ValueError(f'Unknown action log version {version}')
+    for offset_ms, actor, code, player1_health, player2_health in RECORD.iter_unpack(action_log[HEADER.size:]):
+        yield ActionLogRecord(offset_ms, actor, ACTION_NAMES[code], player1_health, player2_health)
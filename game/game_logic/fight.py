@@ -1,4 +1,5 @@
 from time import time
+from typing import NamedTuple
 
 from game.game_logic.exceptions import FightEndedException
 from game.game_logic.json_serializable import JsonSerializable
@@ -6,10 +7,15 @@ from game.game_logic.json_serializable import JsonSerializable
 STRENGTH_COEFFICIENT = 0.1
 
 
+# Methods that depend on the current time accept `now`, so one operation (e.g. a snapshot of the fight)
+# reads the clock once and all its values describe the same instant. If `now` is None, the clock is read.
+
+
 class FightTimer(JsonSerializable):
+    __slots__ = ('start_time', 'duration', 'countdown_duration')
     start_time: float
-    duration: int = 30
-    countdown_duration: int = 3
+    duration: int
+    countdown_duration: int
 
     def __init__(self, start_time: float = None, duration: int = 30, countdown_duration: int = 3):
         if start_time is None:
@@ -18,39 +24,53 @@ class FightTimer(JsonSerializable):
         self.duration = duration
         self.countdown_duration = countdown_duration
 
+    @property
+    def countdown_end_time(self) -> float:
+        return self.start_time + self.countdown_duration
+
     @property
     def end_time(self) -> float:
         return self.start_time + self.countdown_duration + self.duration
 
+    def get_time_left(self, now: float = None) -> float:
+        return self.end_time - (time() if now is None else now)
+
     @property
     def time_left(self) -> float:
-        return self.end_time - time()
+        return self.get_time_left()
+
+    def check_countdown(self, now: float = None) -> bool:
+        return (time() if now is None else now) < self.start_time + self.countdown_duration
 
     @property
     def is_countdown(self) -> bool:
-        return time() < self.start_time + self.countdown_duration
+        return self.check_countdown()
 
-    def check_timeout(self) -> bool:
-        return time() >= self.end_time
+    def check_timeout(self, now: float = None) -> bool:
+        return (time() if now is None else now) >= self.end_time
 
-    def to_json(self) -> dict:
+    def to_json(self, now: float = None) -> dict:
+        if now is None:
+            now = time()
+        end_time = self.start_time + self.countdown_duration + self.duration
         return {
             'start_time': self.start_time,
             'duration': self.duration,
             'countdown_duration': self.countdown_duration,
-            'is_countdown': self.is_countdown,
-            'end_time': self.end_time,
-            'time_left': self.time_left,
+            'is_countdown': now < self.start_time + self.countdown_duration,
+            'end_time': end_time,
+            'time_left': end_time - now,
         }
 
     @staticmethod
     def from_json(data: dict):
-        return FightTimer(data['start_time'], data['duration'])
+        return FightTimer(data['start_time'], data['duration'], data['countdown_duration'])
 
 
 class FightPlayer(JsonSerializable):
+    __slots__ = ('account_id', 'name', 'health', 'strength')
     account_id: str
-    name: str = None
+    name: str | None
     health: int
     strength: int
 
@@ -71,7 +91,7 @@ class FightPlayer(JsonSerializable):
 
     @property
     def is_alive(self) -> bool:
-        return not self.is_dead
+        return self.health > 0
 
     def to_json(self) -> dict:
         return {
@@ -91,56 +111,94 @@ class FightPlayer(JsonSerializable):
         )
 
 
+class FightState(NamedTuple):
+    ended: bool
+    winner: FightPlayer | None
+    is_draw: bool
+
+
 class Fight(JsonSerializable):
+    __slots__ = ('player1', 'player2', 'fight_timer', '_ended', '_final_state')
     player1: FightPlayer
     player2: FightPlayer
     fight_timer: FightTimer
-    _ended: bool = False  # used if fight must be ended before somebody dies or time runs out
+    _ended: bool  # used if fight must be ended before somebody dies or time runs out
+    _final_state: FightState | None  # state is cached when the fight is ended, it can't change anymore
 
     def __init__(self, player1: FightPlayer, player2: FightPlayer, fight_timer: FightTimer):
         self.player1 = player1
         self.player2 = player2
         self.fight_timer = fight_timer
+        self._ended = False
+        self._final_state = None
+
+    def get_state(self, now: float = None) -> FightState:
+        """Ended flag, winner and draw flag, evaluated at the same instant"""
+        if self._final_state is not None:
+            return self._final_state
+        player1_dead = self.player1.health <= 0
+        player2_dead = self.player2.health <= 0
+        timeout = self.fight_timer.check_timeout(now)
+        ended = self._ended or player1_dead or player2_dead or timeout
+        # hits are rejected once the fight is ended, so a dead player was knocked out before the timeout
+        is_draw = not player1_dead and not player2_dead
+        if is_draw or not ended:
+            winner = None
+        else:
+            winner = self.player2 if player1_dead else self.player1
+        state = FightState(ended, winner, is_draw)
+        if ended:
+            self._final_state = state
+        return state
+
+    def check_ended(self, now: float = None) -> bool:
+        """Cheaper than get_state() when the winner isn't needed"""
+        if self._ended or self._final_state is not None:
+            return True
+        return self.player1.health <= 0 or self.player2.health <= 0 or self.fight_timer.check_timeout(now)
 
     @property
     def is_ended(self) -> bool:
-        if not self._ended:
-            return any([self.player1.is_dead, self.player2.is_dead, self.fight_timer.check_timeout()])
-        return self._ended
+        return self.check_ended()
 
-    def attack(self, attacker: FightPlayer, opponent: FightPlayer) -> None:
-        if self.is_ended:
+    def attack(self, attacker: FightPlayer, opponent: FightPlayer, now: float = None) -> None:
+        if self.check_ended(now):
             raise FightEndedException('Fight is already ended')
         attacker.attack(opponent)
 
     def end_fight(self) -> None:
+        """End the fight before somebody dies or time runs out, the result of an already ended fight is kept"""
+        if self._final_state is not None:
+            return
         self._ended = True
 
-    def to_json(self) -> dict:
+    def to_json(self, now: float = None) -> dict:
+        if now is None:
+            now = time()
+        state = self.get_state(now)
         return {
             'player1': self.player1.to_json(),
             'player2': self.player2.to_json(),
-            'fight_timer': self.fight_timer.to_json(),
-            'winner': self.winner.to_json() if self.winner else None,
-            'ended': self.is_ended
+            'fight_timer': self.fight_timer.to_json(now),
+            'winner': state.winner.to_json() if state.winner else None,
+            'ended': state.ended
         }
 
     @staticmethod
     def from_json(data: dict):
-        return Fight(
+        fight = Fight(
             FightPlayer.from_json(data['player1']),
             FightPlayer.from_json(data['player2']),
             FightTimer.from_json(data['fight_timer'])
         )
+        if data.get('ended'):
+            fight.end_fight()
+        return fight
 
     @property
     def is_draw(self) -> bool:
-        return not self.player1.is_dead and not self.player2.is_dead or self.fight_timer.check_timeout()
+        return self.get_state().is_draw
 
     @property
     def winner(self) -> FightPlayer | None:
-        if self.is_draw or not self.is_ended:
-            return None
-        if self.player1.is_dead:
-            return self.player2
-        return self.player1
+        return self.get_state().winner
@@ -2,6 +2,8 @@ from abc import ABC, abstractmethod
 
 
 class JsonSerializable(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def to_json(self):
         raise NotImplementedError
@@ -0,0 +1,35 @@
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management.base import BaseCommand
+
+from core.business_services.fight_expiry import expire_fights
+from game.fight_storage import get_fight_storage
+
+
+async def pop_live_fights(fight_pks: list[int]) -> None:
+    """Live state of canceled fights is not needed anymore, only pending fights have it"""
+    storage = get_fight_storage()
+    for pk in fight_pks:
+        await storage.pop(f"fight_{pk}")
+        await storage.pop_action_log(f"fight_{pk}")
+
+
+class Command(BaseCommand):
+    help = 'Cancel fights that stay in one status longer than settings.FIGHT_STATUS_TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        # the storage's client is bound to the event loop it was first used on, async_to_sync runs every call
+        # on a new loop, so the whole drain runs on one loop and the batches are cancelled through sync_to_async
+        total = async_to_sync(self.handle_async)(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Successfully canceled %s expired fights' % total))
+
+    async def handle_async(self, batch_size: int) -> int:
+        total = 0
+        batches = expire_fights(batch_size)
+        next_batch = sync_to_async(next)
+        while fights := await next_batch(batches, None):
+            await pop_live_fights([fight.pk for fight in fights])
+            total += len(fights)
+        return total
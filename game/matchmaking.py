@@ -0,0 +1,160 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from time import time
+
+from game.backends import load_backend, RedisHeartbeatBackend
+
+
+def matchmaking_group_name(project_id: str, account_id: str) -> str:
+    """Channel layer group of the player's matchmaking sockets"""
+    return f"matchmaking_{project_id}_{account_id}"
+
+
+def get_matchmaking_score(health: int, strength: int) -> float:
+    """Players are paired by the distance of their scores"""
+    return health + strength
+
+
+class BaseMatchmakingQueue(ABC):
+    """
+    Players of a project waiting for an opponent, ordered by their matchmaking score.
+    Every worker must see the same queue, so two players connected to different workers are paired.
+    """
+
+    @abstractmethod
+    async def match(self, project_id: str, account_id: str, score: float, max_distance: float) -> str | None:
+        """
+        Atomically take the waiting player with the closest score, not farther than max_distance, out of the queue
+        and return its account_id. If there is no such player, the player is queued and None is returned.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove(self, project_id: str, account_id: str) -> None:
+        raise NotImplementedError
+
+
+class InMemoryMatchmakingQueue(BaseMatchmakingQueue):
+    """Process-local queue. Pairs only players served by the same worker."""
+
+    def __init__(self):
+        self._queues: dict[str, list[tuple[float, str]]] = {}  # project_id -> sorted (score, account_id)
+        self._scores: dict[tuple[str, str], float] = {}  # (project_id, account_id) -> score in the queue
+
+    async def match(self, project_id: str, account_id: str, score: float, max_distance: float) -> str | None:
+        await self.remove(project_id, account_id)  # the player can't be matched with its other socket
+        queue = self._queues.setdefault(project_id, [])
+        index = bisect_left(queue, (score, ''))
+        candidates = [i for i in (index - 1, index) if 0 <= i < len(queue) and abs(queue[i][0] - score) <= max_distance]
+        if not candidates:
+            insort(queue, (score, account_id))
+            self._scores[project_id, account_id] = score
+            return None
+        _, opponent_id = queue.pop(min(candidates, key=lambda i: abs(queue[i][0] - score)))
+        del self._scores[project_id, opponent_id]
+        if not queue:
+            del self._queues[project_id]
+        return opponent_id
+
+    async def remove(self, project_id: str, account_id: str) -> None:
+        score = self._scores.pop((project_id, account_id), None)
+        if score is None:
+            return
+        queue = self._queues[project_id]
+        del queue[bisect_left(queue, (score, account_id))]
+        if not queue:
+            del self._queues[project_id]
+
+
+class RedisMatchmakingQueue(BaseMatchmakingQueue, RedisHeartbeatBackend):
+    """
+    Queue shared by all workers, a sorted set per project scored by the matchmaking score, and a sorted set
+    of the same players scored by the time their entry expires at, so players of a killed worker
+    are dropped from the queue when their entries stop being refreshed.
+    Looking up the closest player and taking it out is done by a Lua script, so a waiting player
+    is never paired twice by concurrent workers.
+    """
+    KEY_PREFIX = 'matchmaking:'
+
+    # KEYS[1] - queue of the project, KEYS[2] - expiry of its entries,
+    # ARGV[1] - account_id, ARGV[2] - score, ARGV[3] - max distance, ARGV[4] - now, ARGV[5] - expiry
+    MATCH_SCRIPT = """
+    local score, max_distance = tonumber(ARGV[2]), tonumber(ARGV[3])
+    for _, expired in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[4])) do
+        redis.call('ZREM', KEYS[1], expired)
+        redis.call('ZREM', KEYS[2], expired)
+    end
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    local below = redis.call('ZREVRANGEBYSCORE', KEYS[1], score, score - max_distance, 'WITHSCORES', 'LIMIT', 0, 1)
+    local above = redis.call('ZRANGEBYSCORE', KEYS[1], score, score + max_distance, 'WITHSCORES', 'LIMIT', 0, 1)
+    local closest = nil
+    if #below > 0 then
+        closest = below
+    end
+    if #above > 0 and (closest == nil or tonumber(above[2]) - score < score - tonumber(closest[2])) then
+        closest = above
+    end
+    if closest == nil then
+        redis.call('ZADD', KEYS[1], score, ARGV[1])
+        redis.call('ZADD', KEYS[2], ARGV[5], ARGV[1])
+        redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(ARGV[5])))
+        redis.call('EXPIREAT', KEYS[2], math.ceil(tonumber(ARGV[5])))
+        return nil
+    end
+    redis.call('ZREM', KEYS[1], closest[1])
+    redis.call('ZREM', KEYS[2], closest[1])
+    return closest[1]
+    """
+
+    # KEYS[1] - queue of the project, KEYS[2] - expiry of its entries, ARGV[1] - expiry, ARGV[2..] - account_ids.
+    # Players paired meanwhile are out of the queue and stay out
+    REFRESH_SCRIPT = """
+    for i = 2, #ARGV do
+        redis.call('ZADD', KEYS[2], 'XX', ARGV[1], ARGV[i])
+    end
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(ARGV[1])))
+        redis.call('EXPIREAT', KEYS[2], math.ceil(tonumber(ARGV[1])))
+    end
+    """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._match = self._redis.register_script(self.MATCH_SCRIPT)
+        self._refresh_entries = self._redis.register_script(self.REFRESH_SCRIPT)
+        self._local: dict[tuple[str, str], None] = {}  # (project_id, account_id) queued by this worker
+
+    def _keys(self, project_id: str) -> list[str]:
+        return [self.KEY_PREFIX + project_id, f'{self.KEY_PREFIX}{project_id}:expires']
+
+    async def match(self, project_id: str, account_id: str, score: float, max_distance: float) -> str | None:
+        now = time()
+        opponent_id = await self._match(keys=self._keys(project_id),
+                                        args=[account_id, score, max_distance, now, now + self._ttl])
+        if opponent_id is not None:
+            self._local.pop((project_id, account_id), None)
+            return opponent_id.decode()
+        self._local[project_id, account_id] = None
+        self._start_heartbeat()
+        return None
+
+    async def remove(self, project_id: str, account_id: str) -> None:
+        self._local.pop((project_id, account_id), None)
+        async with self._redis.pipeline() as pipe:
+            for key in self._keys(project_id):
+                pipe.zrem(key, account_id)
+            await pipe.execute()
+
+    async def _refresh(self) -> None:
+        projects: dict[str, list[str]] = {}
+        for project_id, account_id in list(self._local):
+            projects.setdefault(project_id, []).append(account_id)
+        expires_at = time() + self._ttl
+        for project_id, account_ids in projects.items():
+            await self._refresh_entries(keys=self._keys(project_id), args=[expires_at, *account_ids])
+
+
+def get_matchmaking_queue() -> BaseMatchmakingQueue:
+    """Returns the queue configured in settings.MATCHMAKING_QUEUE, one instance per process."""
+    return load_backend('MATCHMAKING_QUEUE')
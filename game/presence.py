@@ -0,0 +1,126 @@
+from abc import ABC, abstractmethod
+from time import time
+
+from game.backends import load_backend, RedisHeartbeatBackend
+
+
+class BasePresenceStore(ABC):
+    """
+    Online players of every project. A player is online while at least one of its presence sockets is open,
+    so the store keeps connections of every player, identified by the consumer's channel name.
+    """
+
+    @abstractmethod
+    async def join(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        """Add the player's connection. Returns True if the player just got online."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def leave(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        """Remove the player's connection. Returns True if the player just got offline."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_online(self, project_pk: int) -> set[str]:
+        raise NotImplementedError
+
+
+class InMemoryPresenceStore(BasePresenceStore):
+    """Process-local store. Sees only players connected to the same worker."""
+
+    def __init__(self):
+        self._connections: dict[int, dict[str, set[str]]] = {}  # project pk -> account_id -> open connections
+
+    async def join(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        connections = self._connections.setdefault(project_pk, {}).setdefault(account_id, set())
+        connections.add(connection_id)
+        return len(connections) == 1
+
+    async def leave(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        players = self._connections.get(project_pk, {})
+        connections = players.get(account_id)
+        if connection_id not in (connections or ()):
+            return False
+        connections.discard(connection_id)
+        if connections:
+            return False
+        del players[account_id]
+        if not players:
+            del self._connections[project_pk]
+        return True
+
+    async def get_online(self, project_pk: int) -> set[str]:
+        return set(self._connections.get(project_pk, ()))
+
+
+class RedisPresenceStore(BasePresenceStore, RedisHeartbeatBackend):
+    """
+    Store shared by all workers. Every connection is a member of a sorted set of its player scored by the time
+    it expires at, and every player is a member of a sorted set of the project scored by its latest expiry,
+    so players of a killed worker get offline when their connections stop being refreshed.
+    """
+    KEY_PREFIX = 'presence:'
+
+    # KEYS[1] - players of the project, KEYS[2] - connections of the player,
+    # ARGV[1] - account_id, ARGV[2] - connection id, ARGV[3] - now, ARGV[4] - expiry.
+    # Returns 1 if the player had no live connection
+    JOIN_SCRIPT = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3])
+    local offline = redis.call('ZCARD', KEYS[2]) == 0
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[2])
+    redis.call('EXPIREAT', KEYS[2], math.ceil(tonumber(ARGV[4])))
+    redis.call('ZADD', KEYS[1], 'GT', ARGV[4], ARGV[1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+    redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(ARGV[4])))
+    return offline and 1 or 0
+    """
+
+    # KEYS[1] - players of the project, KEYS[2] - connections of the player,
+    # ARGV[1] - account_id, ARGV[2] - connection id, ARGV[3] - now. Returns 1 if it was the last live connection
+    LEAVE_SCRIPT = """
+    local removed = redis.call('ZREM', KEYS[2], ARGV[2])
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3])
+    if redis.call('ZCARD', KEYS[2]) > 0 then
+        return 0
+    end
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    return removed
+    """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._join = self._redis.register_script(self.JOIN_SCRIPT)
+        self._leave = self._redis.register_script(self.LEAVE_SCRIPT)
+        self._local: dict[str, tuple[int, str]] = {}  # connection id -> (project pk, account_id) on this worker
+
+    def _keys(self, project_pk: int, account_id: str) -> list[str]:
+        return [f'{self.KEY_PREFIX}{project_pk}', f'{self.KEY_PREFIX}{project_pk}:{account_id}']
+
+    async def _add(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        now = time()
+        return await self._join(keys=self._keys(project_pk, account_id),
+                                args=[account_id, connection_id, now, now + self._ttl]) == 1
+
+    async def join(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        self._local[connection_id] = (project_pk, account_id)
+        self._start_heartbeat()
+        return await self._add(project_pk, account_id, connection_id)
+
+    async def leave(self, project_pk: int, account_id: str, connection_id: str) -> bool:
+        self._local.pop(connection_id, None)
+        return await self._leave(keys=self._keys(project_pk, account_id),
+                                 args=[account_id, connection_id, time()]) == 1
+
+    async def get_online(self, project_pk: int) -> set[str]:
+        return {account_id.decode() for account_id
+                in await self._redis.zrangebyscore(f'{self.KEY_PREFIX}{project_pk}', time(), '+inf')}
+
+    async def _refresh(self) -> None:
+        for connection_id, (project_pk, account_id) in list(self._local.items()):
+            if connection_id in self._local:  # not closed while refreshing the previous ones
+                await self._add(project_pk, account_id, connection_id)
+
+
+def get_presence_store() -> BasePresenceStore:
+    """Returns the store configured in settings.PRESENCE_STORE, one instance per process."""
+    return load_backend('PRESENCE_STORE')
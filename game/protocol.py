@@ -0,0 +1,120 @@
+import json
+
+import msgpack
+
+SUBPROTOCOL_V2_JSON = 'taskogotchi.v2.json'
+SUBPROTOCOL_V2_MSGPACK = 'taskogotchi.v2.msgpack'
+
+
+class LegacyFightProtocol:
+    """
+    Protocol v1, used when the client doesn't ask for a subprotocol.
+    Every message contains the whole fight, opponent's messages are forwarded as is.
+    """
+    subprotocol: str | None = None
+
+    def decode(self, text_data: str | None, bytes_data: bytes | None) -> dict | None:
+        try:
+            return json.loads(text_data)
+        except (json.JSONDecodeError, TypeError):
+            return None
+
+    def encode_server_info(self, message: str, fight: dict | None) -> dict:
+        return {'text_data': json.dumps({
+            "type": "server_info",
+            "message": message,
+            "fight": fight,
+        })}
+
+    def encode_opponent_action(self, fight: dict | None, account_id: str, action: str, text_data: str) -> dict:
+        return {'text_data': json.dumps({
+            "fight": fight,
+            "data": text_data,
+        })}
+
+    def encode_tick(self, fight: dict, account_id: str, actions: list[dict]) -> dict:
+        """Opponent's actions applied in one tick, "data" is the last one, as if it was sent alone"""
+        return {'text_data': json.dumps({
+            "fight": fight,
+            "data": actions[-1]['text_data'],
+            "actions": [action['text_data'] for action in actions],
+        })}
+
+    def encode_waiting(self, account_id: str, action: str, text_data: str) -> dict:
+        return {'text_data': text_data}
+
+
+class DeltaFightProtocol(LegacyFightProtocol):
+    """
+    Protocol v2. Server info messages carry the full fight and reset the client's state,
+    opponent's actions carry only the fields changed since the previous message.
+    Every message has a sequence number, so the client can detect lost frames.
+
+    Opponent's action: {"type": "action", "seq": 5, "account_id": "...", "action": "punch", "hp": [100, 90.0]}
+    Opponent's actions applied in one tick: {"type": "tick", "seq": 6, "account_id": "...", "actions": ["punch", "kick"]}
+    "hp" (health of player1 and player2), "ended" and "winner" are sent only when changed.
+    """
+
+    def __init__(self, binary: bool = False):
+        self.binary = binary
+        self.subprotocol = SUBPROTOCOL_V2_MSGPACK if binary else SUBPROTOCOL_V2_JSON
+        self._seq = 0
+        self._last_fight: dict | None = None
+
+    def decode(self, text_data: str | None, bytes_data: bytes | None) -> dict | None:
+        if bytes_data is None:
+            return super().decode(text_data, bytes_data)
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except (msgpack.UnpackException, ValueError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    def _encode(self, message: dict) -> dict:
+        self._seq += 1
+        message['seq'] = self._seq
+        if self.binary:
+            return {'bytes_data': msgpack.packb(message)}
+        return {'text_data': json.dumps(message, separators=(',', ':'))}
+
+    def encode_server_info(self, message: str, fight: dict | None) -> dict:
+        self._last_fight = fight
+        return self._encode({"type": "server_info", "message": message, "fight": fight})
+
+    def encode_opponent_action(self, fight: dict | None, account_id: str, action: str, text_data: str) -> dict:
+        message = {"type": "action", "account_id": account_id, "action": action}
+        if fight is not None:
+            message.update(self._diff(fight))
+        return self._encode(message)
+
+    def encode_tick(self, fight: dict, account_id: str, actions: list[dict]) -> dict:
+        message = {"type": "tick", "account_id": account_id, "actions": [action['action'] for action in actions]}
+        message.update(self._diff(fight))
+        return self._encode(message)
+
+    def encode_waiting(self, account_id: str, action: str, text_data: str) -> dict:
+        return self._encode({"type": "action", "account_id": account_id, "action": action})
+
+    def _diff(self, fight: dict) -> dict:
+        last_fight, self._last_fight = self._last_fight, fight
+        if last_fight is None:
+            return {"fight": fight}
+        changes = {}
+        hp = [fight['player1']['health'], fight['player2']['health']]
+        if hp != [last_fight['player1']['health'], last_fight['player2']['health']]:
+            changes['hp'] = hp
+        if fight['ended'] != last_fight['ended']:
+            changes['ended'] = fight['ended']
+        if fight['winner'] != last_fight['winner']:
+            changes['winner'] = fight['winner']['account_id'] if fight['winner'] else None
+        return changes
+
+
+def negotiate_protocol(subprotocols: list[str]) -> LegacyFightProtocol:
+    """Pick the protocol from the client's Sec-WebSocket-Protocol list, in the client's order of preference."""
+    for subprotocol in subprotocols:
+        if subprotocol == SUBPROTOCOL_V2_MSGPACK:
+            return DeltaFightProtocol(binary=True)
+        if subprotocol == SUBPROTOCOL_V2_JSON:
+            return DeltaFightProtocol()
+    return LegacyFightProtocol()
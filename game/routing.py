@@ -1,7 +1,10 @@
 from django.urls import re_path
 
-from game.consumers import FightConsumer
+from game.consumers import FightConsumer, MatchmakingConsumer, PresenceConsumer, NotificationConsumer
 
 websocket_urlpatterns = [
     re_path(r"ws/fight/(?P<account_id>(\w|\d)+)/?$", FightConsumer.as_asgi()),
+    re_path(r"ws/matchmaking/(?P<project_id>[\w-]+)/(?P<account_id>(\w|\d)+)/?$", MatchmakingConsumer.as_asgi()),
+    re_path(r"ws/presence/(?P<project_id>[\w-]+)/(?P<account_id>(\w|\d)+)/?$", PresenceConsumer.as_asgi()),
+    re_path(r"ws/notifications/(?P<account_id>(\w|\d)+)/?$", NotificationConsumer.as_asgi()),
 ]
@@ -1,3 +1,610 @@
-from django.test import TestCase
+import asyncio
+from io import StringIO
+from time import time
+from unittest import mock
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+import msgpack
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from core.business_services import fight_status_state_machine
+from core.models import Project, Player, PlayerProfile, FightChallenge, FightStatus, Taskogotchi
+from game.consumers import end_timed_out_fight, get_fight_by_account_id, SEAT_TAKEN_CLOSE_CODE
+from game.fight_storage import get_fight_storage, InMemoryFightStorage
+from game.fight_ticker import FightTicker
+from game.matchmaking import InMemoryMatchmakingQueue, RedisMatchmakingQueue
+from game.presence import InMemoryPresenceStore, RedisPresenceStore
+from game.game_logic.action_log import pack_record, make_action_log, iter_action_log, ActionLogRecord, HEADER, \
+    RECORD
+from game.game_logic.fight import Fight, FightPlayer, FightTimer
+from game.protocol import SUBPROTOCOL_V2_MSGPACK
+from game.routing import websocket_urlpatterns
+
+
+def make_fight(player1_health: float = 100, player2_health: float = 100) -> Fight:
+    # countdown from 0 to 3, fight from 3 to 33
+    return Fight(FightPlayer('player1', player1_health, 100), FightPlayer('player2', player2_health, 100),
+                 FightTimer(start_time=0, duration=30, countdown_duration=3))
+
+
+class FightStateTestCase(SimpleTestCase):
+    def test_in_progress(self):
+        state = make_fight().get_state(now=10)
+        self.assertEqual((state.ended, state.winner, state.is_draw), (False, None, True))
+
+    def test_knockout(self):
+        fight = make_fight(player2_health=10)
+        fight.attack(fight.player1, fight.player2, now=10)
+        state = fight.get_state(now=10)
+        self.assertEqual((state.ended, state.winner, state.is_draw), (True, fight.player1, False))
+
+    def test_knockout_evaluated_after_timeout(self):
+        fight = make_fight(player1_health=0)
+        state = fight.get_state(now=40)
+        self.assertEqual((state.ended, state.winner, state.is_draw), (True, fight.player2, False))
+        # the same fight loaded from the storage
+        state = Fight.from_json(fight.to_json(now=20)).get_state(now=40)
+        self.assertEqual((state.ended, state.winner.account_id, state.is_draw), (True, 'player2', False))
+
+    def test_timeout(self):
+        fight = make_fight(player2_health=50)
+        self.assertFalse(fight.check_ended(now=32))
+        state = fight.get_state(now=33)
+        self.assertEqual((state.ended, state.winner, state.is_draw), (True, None, True))
+
+    def test_forced_end(self):
+        fight = make_fight()
+        fight.end_fight()
+        self.assertTrue(fight.check_ended(now=10))
+        state = fight.get_state(now=10)
+        self.assertEqual((state.ended, state.winner, state.is_draw), (True, None, True))
+
+    def test_forced_end_keeps_knockout(self):
+        fight = make_fight(player1_health=0)
+        self.assertEqual(fight.get_state(now=10).winner, fight.player2)
+        fight.end_fight()
+        state = fight.get_state(now=40)
+        self.assertEqual((state.ended, state.winner, state.is_draw), (True, fight.player2, False))
+
+
+class InMemoryFightStorageTestCase(SimpleTestCase):
+    def setUp(self):
+        self.storage = InMemoryFightStorage()
+        # in progress since a second
+        self.fight = Fight(FightPlayer('player1', 100, 100), FightPlayer('player2', 15, 100),
+                           FightTimer(start_time=time() - 4, duration=30, countdown_duration=3))
+
+    @async_to_sync
+    async def test_add(self):
+        self.assertEqual(await self.storage.add('fight_1', self.fight), (self.fight, True))
+        self.assertEqual(await self.storage.add('fight_1', make_fight()), (self.fight, False))
+        self.assertIs(await self.storage.get('fight_1'), self.fight)
+
+    @async_to_sync
+    async def test_apply_action(self):
+        self.assertIsNone(await self.storage.apply_action('fight_1', 'player1', 'punch'))
+        await self.storage.add('fight_1', self.fight)
+        fight = await self.storage.apply_action('fight_1', 'player1', 'punch')
+        self.assertEqual((fight.player1.health, fight.player2.health), (100, 5))
+        # not a hit
+        fight = await self.storage.apply_action('fight_1', 'player2', 'waiting')
+        self.assertEqual((fight.player1.health, fight.player2.health), (100, 5))
+        with self.assertRaises(ValueError):
+            await self.storage.apply_action('fight_1', 'stranger', 'punch')
+
+        fight = await self.storage.apply_action('fight_1', 'player1', 'kick')
+        self.assertEqual(fight.player2.health, 0)
+        self.assertTrue(fight.is_ended)
+        # hits are rejected once the fight is ended
+        fight = await self.storage.apply_action('fight_1', 'player2', 'punch')
+        self.assertEqual(fight.player1.health, 100)
+
+    @async_to_sync
+    async def test_pop(self):
+        await self.storage.add('fight_1', self.fight)
+        self.assertIs(await self.storage.pop('fight_1'), self.fight)
+        self.assertIsNone(await self.storage.pop('fight_1'))
+        self.assertIsNone(await self.storage.get('fight_1'))
+
+
+class FightTickerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.ticker = FightTicker(rate=20, max_inputs_per_tick=2)
+        # a new storage for every test
+        self.enterContext(override_settings(FIGHT_STORAGE={'BACKEND': 'game.fight_storage.InMemoryFightStorage'}))
+        broadcaster = self.enterContext(mock.patch('game.fight_ticker.get_fight_broadcaster'))
+        self.group_send = broadcaster.return_value.group_send = mock.AsyncMock()
+
+    async def add_fight(self, player2_health: float = 100) -> None:
+        # in progress since a second
+        await get_fight_storage().add('fight_1', Fight(
+            FightPlayer('player1', 100, 100), FightPlayer('player2', player2_health, 100),
+            FightTimer(start_time=time() - 4, duration=30, countdown_duration=3)))
+
+    def submit(self, account_id: str, action: str) -> bool:
+        return self.ticker.submit(None, 'fight_1', account_id, action, f'{account_id} {action}')
+
+    def get_events(self) -> list[dict]:
+        return [call.args[2] for call in self.group_send.await_args_list]
+
+    @async_to_sync
+    async def test_hits_coalesced_in_order_of_arrival(self):
+        await self.add_fight()
+        self.assertTrue(self.submit('player1', 'punch'))
+        self.assertTrue(self.submit('player2', 'kick'))
+        self.assertTrue(self.submit('player1', 'kick'))
+        await self.ticker._tasks['fight_1']
+
+        [event] = self.get_events()
+        self.assertEqual(event['type'], 'fight_tick')
+        self.assertEqual([(action['account_id'], action['action'], action['text_data']) for action in event['actions']],
+                         [('player1', 'punch', 'player1 punch'), ('player2', 'kick', 'player2 kick'),
+                          ('player1', 'kick', 'player1 kick')])
+        self.assertEqual((event['fight']['player1']['health'], event['fight']['player2']['health']), (90, 80))
+        self.assertNotIn('fight_1', self.ticker._tasks)  # the loop stops without inputs
+
+    @async_to_sync
+    async def test_inputs_over_cap_dropped(self):
+        await self.add_fight()
+        self.assertEqual([self.submit('player1', 'punch') for _ in range(3)], [True, True, False])
+        self.assertTrue(self.submit('player2', 'punch'))  # the cap is per player
+        task = self.ticker._tasks['fight_1']
+        await asyncio.sleep(0)  # the first tick
+        self.assertTrue(self.submit('player1', 'punch'))  # the cap is per tick
+        await task
+
+        self.assertEqual([[action['account_id'] for action in event['actions']] for event in self.get_events()],
+                         [['player1', 'player1', 'player2'], ['player1']])
+        self.assertEqual(self.get_events()[-1]['fight']['player2']['health'], 70)
+
+    @async_to_sync
+    async def test_game_over(self):
+        await self.add_fight(player2_health=15)
+        self.submit('player1', 'punch')
+        self.submit('player1', 'kick')
+        self.submit('player2', 'punch')  # after the knockout, it doesn't hit
+        await self.ticker._tasks['fight_1']
+
+        [event] = self.get_events()
+        self.assertEqual(event['type'], 'game_over')
+        self.assertEqual(len(event['actions']), 3)
+        self.assertEqual((event['fight']['player1']['health'], event['fight']['player2']['health']), (100, 0))
+
+    @async_to_sync
+    async def test_removed_fight(self):
+        self.submit('player1', 'punch')
+        await self.ticker._tasks['fight_1']
+        self.assertEqual(self.get_events(), [])
+
+
+class ActionLogTestCase(SimpleTestCase):
+    def test_encoding(self):
+        action_log = make_action_log(pack_record(5120, 1, 'punch', 100, 90) + pack_record(6000, 2, 'kick', 80.5, 90))
+        self.assertEqual(len(action_log), HEADER.size + 2 * RECORD.size)
+        self.assertEqual(list(iter_action_log(action_log)), [ActionLogRecord(5120, 1, 'punch', 100, 90),
+                                                             ActionLogRecord(6000, 2, 'kick', 80.5, 90)])
+        self.assertEqual(list(iter_action_log(make_action_log(b''))), [])
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            list(iter_action_log(b'\x02' + pack_record(0, 1, 'punch', 100, 90)))
+
+    @async_to_sync
+    async def test_storage_records_hits(self):
+        storage = InMemoryFightStorage()
+        fight = Fight(FightPlayer('player1', 100, 100), FightPlayer('player2', 100, 50),
+                      FightTimer(start_time=time() - 4, duration=30, countdown_duration=3))
+        await storage.add('fight_1', fight)
+        await storage.apply_action('fight_1', 'player1', 'punch')
+        await storage.apply_action('fight_1', 'player1', 'waiting')
+        await storage.apply_action('fight_1', 'player2', 'kick')
+
+        records = list(iter_action_log(make_action_log(await storage.pop_action_log('fight_1'))))
+        self.assertEqual([(record.actor, record.action, record.player1_health, record.player2_health)
+                          for record in records], [(1, 'punch', 100, 90), (2, 'kick', 95, 90)])
+        self.assertTrue(all(4000 <= record.offset_ms < 5000 for record in records))
+        self.assertEqual(await storage.pop_action_log('fight_1'), b'')
+
+
+# every backend shared by the workers in memory, so the consumers run without redis
+IN_MEMORY_BACKENDS = {
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'FIGHT_STORAGE': {'BACKEND': 'game.fight_storage.InMemoryFightStorage'},
+    'MATCHMAKING_QUEUE': {'BACKEND': 'game.matchmaking.InMemoryMatchmakingQueue'},
+    'PRESENCE_STORE': {'BACKEND': 'game.presence.InMemoryPresenceStore'},
+}
+
+
+def create_profiles(project: Project, *account_ids: str) -> list[PlayerProfile]:
+    return [PlayerProfile.objects.create(player=Player.objects.create(account_id=account_id), project=project)
+            for account_id in account_ids]
+
+
+@override_settings(**IN_MEMORY_BACKENDS)
+class FightTestCase(TestCase):
+    """player1 and player2, the players of make_fight(), are in a pending fight"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(project_id='project', name='Project')
+        cls.profiles = create_profiles(cls.project, 'player1', 'player2')
+        cls.fight = FightChallenge.objects.create(initiator=cls.profiles[0], opponent=cls.profiles[1],
+                                                  status=FightStatus.PENDING)
+
+    @staticmethod
+    def communicator(path: str, **kwargs) -> WebsocketCommunicator:
+        return WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, **kwargs)
+
+
+class ConsumerQueryBudgetTestCase(FightTestCase):
+    """Connecting is on the hot path of every fight, the number of queries of consumers' connect is pinned"""
+
+    @async_to_sync
+    async def connect(self, path: str) -> bool:
+        communicator = self.communicator(path)
+        connected, _ = await communicator.connect()
+        if connected:
+            await communicator.disconnect()
+        return connected
+
+    def test_connect(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect('/ws/fight/player1/'))
+
+    def test_connect_without_fight(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(self.connect('/ws/fight/stranger/'))
+
+    def test_matchmaking_connect_in_fight(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(self.connect('/ws/matchmaking/project/player1/'))
+
+    def test_presence_connect(self):
+        # the project of the player and the snapshot of the opponents
+        with self.assertNumQueries(2):
+            self.assertTrue(self.connect('/ws/presence/project/player1/'))
+
+    def test_notifications_connect(self):
+        # the player and its active fight
+        with self.assertNumQueries(2):
+            self.assertTrue(self.connect('/ws/notifications/player1/'))
+
+
+class FightTimeoutTestCase(FightTestCase):
+    @async_to_sync
+    async def end_timed_out_fight(self, fight_object: Fight) -> FightChallenge:
+        fight = await get_fight_by_account_id('player1')
+        await get_fight_storage().add(f'fight_{fight.pk}', fight_object)
+        await end_timed_out_fight(get_channel_layer(), f'fight_{fight.pk}', fight)
+        return fight
+
+    def test_timeout_is_draw(self):
+        fight = self.end_timed_out_fight(make_fight())
+        fight.refresh_from_db()
+        self.assertEqual((fight.status, fight.draw, fight.winner_id), (FightStatus.COMPLETED, True, None))
+
+    def test_knockout_not_popped_before_timeout_keeps_winner(self):
+        fight = self.end_timed_out_fight(make_fight(player1_health=0))
+        fight.refresh_from_db()
+        self.assertEqual((fight.status, fight.draw, fight.winner_id),
+                         (FightStatus.COMPLETED, False, self.profiles[1].pk))
+
+
+class FightProtocolTestCase(FightTestCase):
+    @async_to_sync
+    async def test_msgpack_frame_that_is_not_json_is_dropped(self):
+        player1 = self.communicator('/ws/fight/player1/', subprotocols=[SUBPROTOCOL_V2_MSGPACK])
+        player2 = self.communicator('/ws/fight/player2/')
+        self.assertTrue((await player1.connect())[0])
+        self.assertTrue((await player2.connect())[0])
+
+        await player1.send_to(bytes_data=msgpack.packb({'account_id': 'player1', 'action': b'waiting'}))
+        self.assertTrue(await player2.receive_nothing())
+        await player1.send_to(bytes_data=msgpack.packb({'account_id': 'player1', 'action': 'waiting'}))
+        self.assertEqual(await player2.receive_json_from(), {'account_id': 'player1', 'action': 'waiting'})
+        await player1.disconnect()
+        await player2.disconnect()
+
+
+class FightSeatTestCase(FightTestCase):
+    @async_to_sync
+    async def test_new_socket_of_seat_closes_older(self):
+        old = self.communicator('/ws/fight/player1/')
+        new = self.communicator('/ws/fight/player1/')
+        player2 = self.communicator('/ws/fight/player2/')
+        self.assertTrue((await old.connect())[0])
+        self.assertTrue((await new.connect())[0])
+        self.assertEqual(await old.receive_output(), {'type': 'websocket.close', 'code': SEAT_TAKEN_CLOSE_CODE})
+        await old.wait()
+
+        self.assertTrue((await player2.connect())[0])
+        await player2.send_json_to({'account_id': 'player2', 'action': 'waiting'})
+        self.assertEqual(await new.receive_json_from(), {'account_id': 'player2', 'action': 'waiting'})
+        await new.disconnect()
+        await player2.disconnect()
+
+
+class LoopBoundFightStorage(InMemoryFightStorage):
+    """Like a redis client, fails when used on another event loop than the first one"""
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    async def pop(self, key: str) -> Fight | None:
+        loop = asyncio.get_running_loop()
+        if self.loop not in (None, loop):
+            raise RuntimeError('Event loop is closed')
+        self.loop = loop
+        return await super().pop(key)
+
+
+@override_settings(FIGHT_STORAGE={'BACKEND': 'game.tests.LoopBoundFightStorage'},
+                   FIGHT_STATUS_TTL={FightStatus.PENDING: 60})
+class ExpireFightsCommandTestCase(FightTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()  # the fight of player1 and player2 isn't expired yet
+        profiles = create_profiles(cls.project, *(f'player{i}' for i in range(3, 9)))
+        expired_at = timezone.now() - timedelta(minutes=2)
+        for initiator, opponent in zip(profiles[::2], profiles[1::2]):
+            FightChallenge.objects.create(initiator=initiator, opponent=opponent, status=FightStatus.PENDING,
+                                          status_changed_at=expired_at)
+
+    def test_expire_in_batches(self):
+        storage = get_fight_storage()
+        for pk in FightChallenge.objects.values_list('pk', flat=True):
+            async_to_sync(storage.add)(f'fight_{pk}', make_fight())
+
+        call_command('expirefights', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(FightChallenge.objects.filter(status=FightStatus.CANCELED).count(), 3)
+        pending = FightChallenge.objects.get(status=FightStatus.PENDING)
+        self.assertEqual(list(storage._fights), [f'fight_{pending.pk}'])
+
+
+class PresenceStoreTestCase(SimpleTestCase):
+    @async_to_sync
+    async def test_in_memory(self):
+        store = InMemoryPresenceStore()
+        self.assertTrue(await store.join(1, 'player1', 'socket1'))
+        self.assertFalse(await store.join(1, 'player1', 'socket2'))
+        self.assertTrue(await store.join(2, 'player1', 'socket3'))
+        self.assertEqual(await store.get_online(1), {'player1'})
+
+        self.assertFalse(await store.leave(1, 'player1', 'socket1'))
+        self.assertFalse(await store.leave(1, 'player1', 'socket1'))  # closed already
+        self.assertTrue(await store.leave(1, 'player1', 'socket2'))
+        self.assertEqual(await store.get_online(1), set())
+        self.assertEqual(await store.get_online(2), {'player1'})
+
+    @async_to_sync
+    async def test_redis_heartbeat_refreshes_open_connections(self):
+        store = RedisPresenceStore(ttl=0.06)
+        store._join = mock.AsyncMock(return_value=1)
+        store._leave = mock.AsyncMock(return_value=1)
+        await store.join(1, 'player1', 'socket1')
+        await store.join(1, 'player2', 'socket2')
+        await store.leave(1, 'player2', 'socket2')
+        await asyncio.sleep(0.05)  # a heartbeat every ttl / 3
+
+        refreshed = [call.kwargs['args'][:2] for call in store._join.await_args_list[2:]]
+        self.assertTrue(refreshed)
+        self.assertEqual(set(map(tuple, refreshed)), {('player1', 'socket1')})
+        now, expires_at = store._join.await_args.kwargs['args'][2:]
+        self.assertAlmostEqual(expires_at - now, 0.06, places=6)
+
+        # the heartbeat stops with the last connection
+        await store.leave(1, 'player1', 'socket1')
+        await asyncio.sleep(0.04)
+        self.assertTrue(store._heartbeat.done())
+
+
+class PresenceConsumerTestCase(FightTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for profile in cls.profiles:
+            Taskogotchi.objects.create(profile=profile)
+
+    @async_to_sync
+    async def test_join_and_leave(self):
+        player1 = self.communicator('/ws/presence/project/player1/')
+        self.assertTrue((await player1.connect())[0])
+        snapshot = await player1.receive_json_from()
+        self.assertEqual([(opponent['account_id'], opponent['online']) for opponent in snapshot['opponents']],
+                         [('player2', False)])
+
+        player2_tabs = [self.communicator('/ws/presence/project/player2/') for _ in range(2)]
+        for tab in player2_tabs:
+            self.assertTrue((await tab.connect())[0])
+        self.assertEqual((await player1.receive_json_from())['type'], 'join')
+        # the second socket of an online player isn't a join
+        self.assertTrue(await player1.receive_nothing())
+
+        await player2_tabs[0].disconnect()
+        self.assertTrue(await player1.receive_nothing())
+        await player2_tabs[1].disconnect()
+        self.assertEqual(await player1.receive_json_from(), {'type': 'leave', 'account_id': 'player2'})
+        await player1.disconnect()
+
+
+class NotificationConsumerTestCase(FightTestCase):
+    """player3 challenged player4"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.profiles += create_profiles(cls.project, 'player3', 'player4')
+        for profile in cls.profiles[2:]:
+            Taskogotchi.objects.create(profile=profile)
+        cls.challenge = FightChallenge.objects.create(initiator=cls.profiles[2], opponent=cls.profiles[3])
+
+    @sync_to_async
+    def act(self, account_id: str, action: str, **data) -> int:
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.put('/api/v1/fight', {'account_id': account_id, 'project_id': 'project',
+                                                     'action': action, **data},
+                                   content_type='application/json').status_code
+
+    async def connect(self) -> list[WebsocketCommunicator]:
+        communicators = []
+        for account_id in ('player3', 'player4'):
+            communicator = self.communicator(f'/ws/notifications/{account_id}/')
+            self.assertTrue((await communicator.connect())[0])
+            # the status of the active fight on connect
+            self.assertEqual((await communicator.receive_json_from())['status'], FightStatus.WAITING_ACCEPT)
+            communicators.append(communicator)
+        return communicators
+
+    @async_to_sync
+    async def test_fight_status_pushed_to_both_players(self):
+        communicators = await self.connect()
+        for action, status in (('accept', FightStatus.ACCEPTED), ('start', FightStatus.PENDING)):
+            self.assertEqual(await self.act('player4', action), 200)
+            for communicator in communicators:
+                self.assertEqual(await communicator.receive_json_from(), {
+                    'type': 'fight_status', 'fight_id': self.challenge.pk, 'status': status,
+                    'account_ids': ['player3', 'player4'], 'winner_account_id': None, 'draw': False,
+                })
+
+        self.assertEqual(await self.act('player4', 'complete', winner_account_id='player3'), 200)
+        for communicator in communicators:
+            event = await communicator.receive_json_from()
+            self.assertEqual((event['status'], event['winner_account_id'], event['draw']),
+                             (FightStatus.COMPLETED, 'player3', False))
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+    @async_to_sync
+    async def test_nothing_pushed_on_rollback(self):
+        communicators = await self.connect()
+        with mock.patch.object(fight_status_state_machine, 'publish_fight_status',
+                               wraps=fight_status_state_machine.publish_fight_status) as publish, \
+                mock.patch('api_v1.serializers.FightChallengeSerializer.filter_validated_data',
+                           side_effect=RuntimeError('the update failed')):
+            with self.assertRaises(RuntimeError):
+                await self.act('player4', 'accept')
+        publish.assert_called_once()  # the event was published in the rolled back transaction
+        for communicator in communicators:
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+        self.assertEqual((await FightChallenge.objects.aget(pk=self.challenge.pk)).status, FightStatus.WAITING_ACCEPT)
+
+
+class MatchmakingQueueTestCase(SimpleTestCase):
+    @async_to_sync
+    async def test_in_memory_closest(self):
+        queue = InMemoryMatchmakingQueue()
+        for account_id, score in (('player1', 100), ('player2', 130), ('player3', 160)):
+            self.assertIsNone(await queue.match('project', account_id, score, max_distance=20))
+        self.assertIsNone(await queue.match('other', 'player4', 140, max_distance=20))  # other projects aren't seen
+        self.assertEqual(await queue.match('project', 'player5', 140, max_distance=20), 'player2')
+        self.assertEqual(await queue.match('project', 'player6', 145, max_distance=20), 'player3')
+        self.assertEqual(await queue.match('project', 'player7', 95, max_distance=20), 'player1')
+
+    @async_to_sync
+    async def test_in_memory_max_distance(self):
+        queue = InMemoryMatchmakingQueue()
+        self.assertIsNone(await queue.match('project', 'player1', 100, max_distance=20))
+        self.assertIsNone(await queue.match('project', 'player2', 121, max_distance=20))
+        self.assertEqual(await queue.match('project', 'player3', 120, max_distance=20), 'player2')
+        self.assertEqual(await queue.match('project', 'player4', 80, max_distance=20), 'player1')
+
+    @async_to_sync
+    async def test_in_memory_remove(self):
+        queue = InMemoryMatchmakingQueue()
+        self.assertIsNone(await queue.match('project', 'player1', 100, max_distance=20))
+        self.assertIsNone(await queue.match('project', 'player2', 200, max_distance=20))
+        await queue.remove('project', 'player2')
+        await queue.remove('project', 'player3')  # not queued
+        self.assertIsNone(await queue.match('project', 'player4', 200, max_distance=20))
+        self.assertEqual(await queue.match('project', 'player5', 110, max_distance=20), 'player1')
+        # queueing again moves the player instead of pairing it with itself
+        self.assertIsNone(await queue.match('project', 'player6', 400, max_distance=20))
+        self.assertIsNone(await queue.match('project', 'player6', 500, max_distance=20))
+        self.assertEqual(await queue.match('project', 'player7', 500, max_distance=20), 'player6')
+
+    @async_to_sync
+    async def test_redis_heartbeat_refreshes_queued_players(self):
+        queue = RedisMatchmakingQueue(ttl=0.06)
+        queue._match = mock.AsyncMock(side_effect=[None, None, b'player1'])
+        queue._refresh_entries = mock.AsyncMock()
+        queue._redis = mock.MagicMock()
+        queue._redis.pipeline.return_value.__aenter__.return_value = mock.MagicMock(execute=mock.AsyncMock())
+        self.assertIsNone(await queue.match('project', 'player1', 100, max_distance=20))
+        self.assertIsNone(await queue.match('project', 'player2', 200, max_distance=20))
+        await queue.remove('project', 'player2')
+        await asyncio.sleep(0.05)  # a heartbeat every ttl / 3
+
+        self.assertTrue(queue._refresh_entries.await_args_list)
+        for call in queue._refresh_entries.await_args_list:
+            self.assertEqual(call.kwargs['keys'], ['matchmaking:project', 'matchmaking:project:expires'])
+            self.assertEqual(call.kwargs['args'][1:], ['player1'])
+
+        # the heartbeat stops when the socket of the last queued player is closed, paired players close theirs
+        self.assertEqual(await queue.match('project', 'player3', 100, max_distance=20), 'player1')
+        await queue.remove('project', 'player1')
+        await asyncio.sleep(0.04)
+        self.assertTrue(queue._heartbeat.done())
+
+
+class MatchmakingConsumerTestCase(FightTestCase):
+    """player1 and player2 are in a fight, scores of player3..6 are 200, 240, 190 and 300"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.profiles += create_profiles(cls.project, 'player3', 'player4', 'player5', 'player6')
+        for profile, strength in zip(cls.profiles, (100, 100, 100, 140, 90, 200)):
+            Taskogotchi.objects.create(profile=profile, strength=strength)
+
+    @async_to_sync
+    async def test_pairing(self):
+        player3 = self.communicator('/ws/matchmaking/project/player3/')
+        self.assertTrue((await player3.connect())[0])
+        self.assertEqual(await player3.receive_json_from(), {'type': 'queued', 'score': 200})
+        # too far from player3
+        player6 = self.communicator('/ws/matchmaking/project/player6/')
+        self.assertTrue((await player6.connect())[0])
+        self.assertEqual(await player6.receive_json_from(), {'type': 'queued', 'score': 300})
+
+        player4 = self.communicator('/ws/matchmaking/project/player4/')
+        self.assertTrue((await player4.connect())[0])
+        for communicator in (player3, player4):
+            event = await communicator.receive_json_from()
+            self.assertEqual(event['type'], 'match_found')
+            self.assertEqual((event['fight']['status'], event['fight']['initiator']['account_id'],
+                              event['fight']['opponent']['account_id']), (FightStatus.ACCEPTED, 'player4', 'player3'))
+            self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        await player6.disconnect()
+
+    @async_to_sync
+    async def test_player_in_fight(self):
+        player1 = self.communicator('/ws/matchmaking/project/player1/')
+        self.assertFalse((await player1.connect())[0])
+
+    @async_to_sync
+    async def test_opponent_got_fight_while_waiting(self):
+        player3 = self.communicator('/ws/matchmaking/project/player3/')
+        self.assertTrue((await player3.connect())[0])
+        self.assertEqual((await player3.receive_json_from())['type'], 'queued')
+        await FightChallenge.objects.acreate(initiator=self.profiles[2], opponent=self.profiles[5])
+
+        # player3 is taken out and told, player4 is queued instead of being paired with it
+        player4 = self.communicator('/ws/matchmaking/project/player4/')
+        self.assertTrue((await player4.connect())[0])
+        self.assertEqual(await player3.receive_json_from(), {'type': 'in_fight'})
+        self.assertEqual((await player3.receive_output())['type'], 'websocket.close')
+        self.assertEqual(await player4.receive_json_from(), {'type': 'queued', 'score': 240})
+
+        player5 = self.communicator('/ws/matchmaking/project/player5/')
+        self.assertTrue((await player5.connect())[0])
+        self.assertEqual((await player5.receive_json_from())['fight']['opponent']['account_id'], 'player4')
+        self.assertEqual((await player4.receive_json_from())['type'], 'match_found')
@@ -54,6 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.QueryProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -64,6 +66,12 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# adds query count, duplicate queries and DB time headers to responses, see core.middleware
+QUERY_PROFILING = os.environ.get('QUERY_PROFILING', '0') == '1'
+
+# /metrics is served only with the "Authorization: Bearer <METRICS_TOKEN>" header, or without a token in DEV mode
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 ROOT_URLCONF = 'taskogotchi.urls'
 
 TEMPLATES = [
@@ -85,17 +93,66 @@ TEMPLATES = [
 WSGI_APPLICATION = 'taskogotchi.wsgi.application'
 ASGI_APPLICATION = "taskogotchi.asgi.application"
 
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
 # channels config
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("redis", 6379)],
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
         },
     },
 }
 
+# state shared between all ASGI workers, loaded by game.backends.load_backend. Every backend below
+# has an InMemory... version next to the redis one (e.g. game.fight_storage.InMemoryFightStorage),
+# use them to run a single worker without redis
+REDIS_OPTIONS = {
+    "host": REDIS_HOST,
+    "port": REDIS_PORT,
+}
+
+# live fights state
+FIGHT_STORAGE = {
+    "BACKEND": "game.fight_storage.RedisFightStorage",
+    "OPTIONS": REDIS_OPTIONS,
+}
+
+# hits of a fight are applied and broadcast once per tick, FIGHT_TICK_RATE times per second,
+# inputs of a player above FIGHT_MAX_INPUTS_PER_TICK in one tick are dropped
+FIGHT_TICK_RATE = int(os.environ.get('FIGHT_TICK_RATE', 20))
+FIGHT_MAX_INPUTS_PER_TICK = int(os.environ.get('FIGHT_MAX_INPUTS_PER_TICK', 3))
+
+# seconds a fight can stay in a status, expired fights are canceled by the expirefights command
+FIGHT_STATUS_TTL = {
+    'WA': int(os.environ.get('FIGHT_WAITING_ACCEPT_TTL', 24 * 3600)),
+    'AC': int(os.environ.get('FIGHT_ACCEPTED_TTL', 15 * 60)),
+    'P': int(os.environ.get('FIGHT_PENDING_TTL', 15 * 60)),
+}
+
+# seconds entries of sockets of a killed worker stay in the presence store and the matchmaking queue
+SOCKET_ENTRY_TTL = int(os.environ.get('SOCKET_ENTRY_TTL', 60))
+
+# online players of every project
+PRESENCE_STORE = {
+    "BACKEND": "game.presence.RedisPresenceStore",
+    "OPTIONS": {**REDIS_OPTIONS, "ttl": SOCKET_ENTRY_TTL},
+}
+
+# players waiting for an opponent
+MATCHMAKING_QUEUE = {
+    "BACKEND": "game.matchmaking.RedisMatchmakingQueue",
+    "OPTIONS": {**REDIS_OPTIONS, "ttl": SOCKET_ENTRY_TTL},
+}
+# players are paired only if their health + strength differ by no more than this
+MATCHMAKING_MAX_DISTANCE = float(os.environ.get('MATCHMAKING_MAX_DISTANCE', 50))
+
+
 
+# taskogotchi health lost per hour, applied when health is read
+TASKOGOTCHI_HEALTH_DECAY_PER_HOUR = float(os.environ.get('TASKOGOTCHI_HEALTH_DECAY_PER_HOUR', 5))
 
 # Database
 
@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import path, include, re_path
 
+from core.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/', include('api_v1.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]